@@ -0,0 +1,107 @@
+"""Benchmark the framework overhead of `run_agent`, over synthetic action graphs
+of varying size, branching factor and history length.
+
+Uses the deterministic fake LLM (`make_agents.fake.FakeLLM`, with no latency),
+so no network is needed, and the time measured is framework overhead.
+Reports the mean time per step (per message), the throughput, and the memory
+allocated per message (traced with tracemalloc, in a separate run).
+
+Run with: poetry run python benchmarks/agent_overhead.py
+(or with --quick, as in CI, and --max-us-per-step to fail on a regression)
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+
+from pydantic import BaseModel, Field
+
+import make_agents as ma
+from make_agents.fake import FakeLLM
+
+
+class TextArg(BaseModel):
+    text: str = Field(description="Some text")
+
+
+def make_action(i: int):
+    def func(arg: TextArg):
+        return arg.text
+
+    func.__name__ = f"action_{i}"
+    func.__doc__ = f"Action number {i}."
+    return ma.action(func)
+
+
+def synthetic_graph(num_actions: int, branching: int) -> dict:
+    """A graph where action i can be followed by actions i+1, ..., i+branching (mod n)."""
+    actions = [make_action(i) for i in range(num_actions)]
+    graph = {ma.Start: [actions[0]]}
+    for i, x in enumerate(actions):
+        graph[x] = [actions[(i + j) % num_actions] for j in range(1, branching + 1)]
+    return graph
+
+
+def run(action_graph: dict, num_messages: int) -> float:
+    """Run the agent until there are `num_messages` messages, returns the seconds taken."""
+    llm = FakeLLM(prompt_tokens=100)  # fixed, so the fake doesn't serialise the prompt
+    agent = ma.run_agent(action_graph, completion=llm.completion)
+    start = time.perf_counter()
+    for messages in agent:
+        if len(messages) >= num_messages:
+            break
+    return time.perf_counter() - start
+
+
+def bytes_per_message(action_graph: dict, num_messages: int) -> float:
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        llm = FakeLLM(prompt_tokens=100)
+        agent = ma.run_agent(action_graph, completion=llm.completion)
+        for messages in agent:
+            if len(messages) >= num_messages:
+                break
+        after, _ = tracemalloc.get_traced_memory()
+        return (after - before) / num_messages
+    finally:
+        tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes, e.g. for CI")
+    parser.add_argument(
+        "--max-us-per-step",
+        type=float,
+        default=None,
+        help="Exit with an error if any configuration is slower than this",
+    )
+    args = parser.parse_args()
+
+    if args.quick:
+        sizes, branchings, histories = [8], [1, 4], [200, 1_000]
+    else:
+        sizes, branchings, histories = [8, 64], [1, 4, 16], [200, 2_000, 10_000]
+
+    print(
+        f"{'actions':>8} {'branching':>10} {'messages':>9} {'us/step':>9}"
+        f" {'steps/s':>9} {'bytes/msg':>10}"
+    )
+    slowest = 0.0
+    for num_actions in sizes:
+        for branching in branchings:
+            action_graph = synthetic_graph(num_actions, branching)
+            run(action_graph, 100)  # warm up, e.g. build the selector functions
+            for num_messages in histories:
+                seconds = run(action_graph, num_messages)
+                us_per_step = 1e6 * seconds / num_messages
+                slowest = max(slowest, us_per_step)
+                memory = bytes_per_message(action_graph, min(num_messages, 1_000))
+                print(
+                    f"{num_actions:>8} {branching:>10} {num_messages:>9}"
+                    f" {us_per_step:>9.1f} {num_messages / seconds:>9.0f} {memory:>10.0f}"
+                )
+    if args.max_us_per_step is not None and slowest > args.max_us_per_step:
+        print(f"Slowest configuration: {slowest:.1f} us/step > {args.max_us_per_step}")
+        sys.exit(1)
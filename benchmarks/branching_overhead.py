@@ -0,0 +1,71 @@
+"""Benchmark the per-step overhead of `run_agent` at branching nodes,
+with the selector functions made up front (the action graph as a dict, which is compiled),
+and made at every step (the same action graph, as a function).
+
+Uses an instant, scripted completion function, so the time measured is framework overhead.
+
+Run with: poetry run python benchmarks/branching_overhead.py
+"""
+import argparse
+import json
+import time
+
+from pydantic import BaseModel, Field
+
+import make_agents as ma
+
+
+class TextArg(BaseModel):
+    text: str = Field(description="Some text")
+
+
+def make_action(i: int):
+    def func(arg: TextArg):
+        return arg.text
+
+    func.__name__ = f"action_{i}"
+    func.__doc__ = f"Action number {i}."
+    return ma.action(func)
+
+
+def completion(**kwargs):
+    name = kwargs["function_call"]["name"]
+    if name == "select_next_func":
+        (options,) = kwargs["functions"][0]["parameters"]["$defs"].values()
+        arguments = {"thought_process": "", "next_function": options["enum"][0]}
+    else:
+        arguments = {"text": "hi"}
+    message = {
+        "role": "assistant",
+        "content": None,
+        "function_call": {"name": name, "arguments": json.dumps(arguments)},
+    }
+    return {"choices": [{"message": message}]}
+
+
+def time_per_step(action_graph: dict, num_steps: int) -> float:
+    """Returns mean microseconds per step (i.e. per message)."""
+    agent = ma.run_agent(action_graph, completion=completion)
+    start = time.perf_counter()
+    for _, _ in zip(range(num_steps), agent):
+        pass
+    return 1e6 * (time.perf_counter() - start) / num_steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-steps", type=int, default=2_000)
+    args = parser.parse_args()
+
+    print(f"{'branching':>10} {'compiled us/step':>17} {'function us/step':>17}")
+    for branching in [2, 8, 32]:
+        actions = [make_action(i) for i in range(branching)]
+        action_graph = {ma.Start: [actions[0]], **{a: actions for a in actions}}
+        compiled = time_per_step(action_graph, args.num_steps)
+        uncompiled = time_per_step(
+            lambda current_action, current_action_result: action_graph.get(
+                current_action
+            ),
+            args.num_steps // 10,
+        )
+        print(f"{branching:>10} {compiled:>17.1f} {uncompiled:>17.1f}")
@@ -0,0 +1,62 @@
+"""Benchmark the import time of make_agents, using `python -X importtime`,
+e.g. to keep the CLI, and short-lived worker processes, quick to start.
+
+Each statement is run in a fresh interpreter, `--repeats` times, and the median
+is reported, along with the slowest top-level imports of the last statement.
+
+Run with: poetry run python benchmarks/import_time.py
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+STATEMENTS = [
+    "import make_agents",
+    "import make_agents.cli",
+    "import make_agents; make_agents.action",
+    "import make_agents; make_agents.gpt",
+]
+
+
+def import_times(statement: str) -> dict[str, int]:
+    """The cumulative import time (us) of each top-level import of `statement`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name[1:].startswith(" "):  # top-level, not imported by another module
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def import_time(statement: str, baseline: dict[str, int]) -> tuple[float, dict]:
+    """The total import time (ms) of `statement`, minus what's imported at startup."""
+    times = import_times(statement)
+    times = {k: v for k, v in times.items() if k not in baseline}
+    return sum(times.values()) / 1e3, times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    baseline = import_times("pass")
+    print(f"{'statement':<40} {'import ms':>10}")
+    for statement in STATEMENTS:
+        results = [import_time(statement, baseline) for _ in range(args.repeats)]
+        median = statistics.median(ms for ms, _ in results)
+        print(f"{statement:<40} {median:>10.1f}")
+    print(f"\nSlowest top-level imports of {statement!r}:")
+    _, times = results[-1]
+    for name, us in sorted(times.items(), key=lambda x: -x[1])[: args.top]:
+        print(f"{name:<40} {us / 1e3:>10.1f}")
@@ -0,0 +1,122 @@
+"""Load test the network path of the completion functions (`gpt.get_completion_func`,
+`gpt.get_acompletion_func`): N concurrent agents, against a local mock of the OpenAI API
+with a latency distribution and injected rate limit (429) errors and timeouts.
+
+Use it to tune concurrency, timeouts and retries without calling the real API.
+
+Run with: poetry run python benchmarks/load_test.py --agents 64 --concurrency 16
+"""
+import argparse
+import inspect
+import statistics
+import threading
+import time
+
+from pydantic import BaseModel, Field
+
+import make_agents as ma
+from make_agents import fleet, gpt
+from make_agents.fake import FakeLLM
+from make_agents.mock_server import MockOpenAIServer, lognormal_latency
+
+
+class TextArg(BaseModel):
+    text: str = Field(description="Some text")
+
+
+@ma.action
+def step(arg: TextArg):
+    """Take a step."""
+    return arg.text
+
+
+action_graph = {ma.Start: [step], step: [step, ma.End]}
+
+
+class Timed:
+    """Wraps completion functions, recording the latency of every completion (with retries)."""
+
+    def __init__(self):
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def __call__(self, completion: callable) -> callable:
+        if inspect.iscoroutinefunction(completion):
+
+            async def timed(**kwargs):
+                start = time.perf_counter()
+                try:
+                    return await completion(**kwargs)
+                finally:
+                    self.record(time.perf_counter() - start)
+
+        else:
+
+            def timed(**kwargs):
+                start = time.perf_counter()
+                try:
+                    return completion(**kwargs)
+                finally:
+                    self.record(time.perf_counter() - start)
+
+        return timed
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+
+def percentile(values: list[float], q: float) -> float:
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--agents", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--backend", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--steps", type=int, default=5, help="Actions per agent")
+    parser.add_argument("--latency", type=float, default=0.2, help="Median, seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--request-timeout", type=float, default=10.0)
+    parser.add_argument("--max-connections", type=int, default=100)
+    args = parser.parse_args()
+
+    llm = FakeLLM(choices=["step"] * (args.steps - 1) + ["End"])
+    server = MockOpenAIServer(
+        llm,
+        latency=lognormal_latency(args.latency, args.latency_sigma),
+        rate_limit_rate=args.rate_limit_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_seconds=2 * args.request_timeout,
+    )
+    get_completion_func = (
+        gpt.get_acompletion_func if args.backend == "asyncio" else gpt.get_completion_func
+    )
+    timed = Timed()
+    pool = gpt.ConnectionPool(args.max_connections)  # shared by all the agents
+    with server:
+        stats = fleet.run_fleet(
+            action_graph,
+            [None] * args.agents,
+            max_concurrency=args.concurrency,
+            backend=args.backend,
+            completion_factory=lambda: timed(
+                get_completion_func(
+                    api_base=server.url,
+                    api_key="mock",
+                    pool=pool,
+                    read_timeout=args.request_timeout,
+                )
+            ),
+        )
+    latencies = sorted(timed.latencies)
+    print(stats)
+    print(server.stats)
+    print(
+        f"completions: {len(latencies)}, {len(latencies) / stats.elapsed:.1f}/s,"
+        f" latency p50 {percentile(latencies, 50):.3f}s,"
+        f" p95 {percentile(latencies, 95):.3f}s, p99 {percentile(latencies, 99):.3f}s"
+    )
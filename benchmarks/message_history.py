@@ -0,0 +1,54 @@
+"""Benchmark the per-step cost of `run_agent` as the message history grows.
+
+Uses a graph of parameterless actions with a single successor,
+so no LLM calls are made, and the time measured is framework overhead.
+
+Run with: poetry run python benchmarks/message_history.py
+"""
+import argparse
+import time
+
+import make_agents as ma
+
+
+@ma.action
+def noop():
+    return "ok"
+
+
+action_graph = {ma.Start: [noop], noop: [noop]}
+
+
+def time_per_step(num_messages: int, report_every: int, **run_agent_kwargs):
+    """Returns a list of (history length, mean microseconds per step)."""
+    rows = []
+    agent = ma.run_agent(action_graph, completion=None, **run_agent_kwargs)
+    start = time.perf_counter()
+    for messages in agent:
+        if len(messages) % report_every == 0:
+            now = time.perf_counter()
+            rows.append((len(messages), 1e6 * (now - start) / report_every))
+            start = now
+        if len(messages) >= num_messages:
+            break
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-messages", type=int, default=10_000)
+    parser.add_argument("--copy-messages-num-messages", type=int, default=2_000)
+    args = parser.parse_args()
+
+    for copy_messages, num_messages in [
+        (False, args.num_messages),
+        (True, args.copy_messages_num_messages),
+    ]:
+        print(f"copy_messages={copy_messages}")
+        print(f"{'messages':>10} {'us/step':>10}")
+        report_every = max(num_messages // 10, 1)
+        for length, us in time_per_step(
+            num_messages, report_every, copy_messages=copy_messages
+        ):
+            print(f"{length:>10} {us:>10.1f}")
+        print()
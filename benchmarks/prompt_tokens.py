@@ -0,0 +1,81 @@
+"""Compare the prompt tokens of the function descriptions sent to the LLM,
+in the default and the compact (`run_agent(..., compact_prompts=True)`) encodings,
+over synthetic action graphs with realistic input schemas (nested, shared models).
+
+Counts the tokens of the functions in the two completions of a branching step:
+selecting the next action (`select_next_func`), then getting the selected action's input,
+and in the single completion of `select_and_act`. Uses tiktoken if it's installed,
+else estimates ~4 characters per token. The messages are the same in both encodings,
+so are left out.
+
+Run with: poetry run python benchmarks/prompt_tokens.py
+"""
+import argparse
+import json
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+import make_agents as ma
+from make_agents import make_agents
+from make_agents.context import get_token_counter
+
+
+class Address(BaseModel):
+    street: str = Field(description="The street, and the house number")
+    city: str = Field(description="The city")
+    postcode: str = Field(description="The postcode")
+
+
+class Contact(BaseModel):
+    name: str = Field(description="The full name of the contact")
+    email: Optional[str] = Field(None, description="Their email address, if known")
+    home: Address = Field(description="Their home address")
+    work: Optional[Address] = Field(None, description="Their work address, if any")
+    priority: Literal["low", "medium", "high"] = Field(
+        "medium", description="How urgent it is to contact them"
+    )
+
+
+def make_action(i: int):
+    def func(arg: Contact):
+        return arg.name
+
+    func.__name__ = f"action_{i}"
+    func.__doc__ = (
+        f"Action number {i}, which updates the contact's details.\n\n"
+        "Use it when the user has given new details for one of their contacts."
+    )
+    return ma.action(func)
+
+
+def step_tokens(options: list[callable], compact: bool, count_tokens: callable) -> dict:
+    """The tokens of the functions in each completion of a branching step."""
+    selector = make_agents.select_next_action_factory(options, compact)
+    requests = {
+        "select": make_agents.func_input_request([], selector, compact),
+        "input": make_agents.func_input_request([], options[0], compact),
+        "select_and_act": make_agents.select_and_act_request([], options, compact),
+    }
+    return {k: count_tokens(json.dumps(v["functions"])) for k, v in requests.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="gpt-4")
+    args = parser.parse_args()
+
+    count_tokens = get_token_counter(args.model)
+    print(f"{'options':>8} {'completion':>15} {'default':>9} {'compact':>9} {'saved':>7}")
+    for num_options in (2, 4, 16, 64):
+        options = [make_action(i) for i in range(num_options)]
+        default = step_tokens(options, False, count_tokens)
+        compact = step_tokens(options, True, count_tokens)
+        default["select + input"] = default["select"] + default["input"]
+        compact["select + input"] = compact["select"] + compact["input"]
+        for name in ("select", "input", "select + input", "select_and_act"):
+            saved = 1 - compact[name] / default[name]
+            print(
+                f"{num_options:>8} {name:>15} {default[name]:>9} {compact[name]:>9}"
+                f" {saved:>7.0%}"
+            )
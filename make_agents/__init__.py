@@ -11,11 +11,49 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from importlib_metadata import version
+import importlib
+from typing import TYPE_CHECKING
 
-__version__ = version(__package__)
+# The objects that are part of the API, and the modules they're in. They are imported
+# on first use, so that importing make_agents is fast, e.g. for the CLI, and worker
+# processes. (Some are slow to import, e.g. gpt imports openai.)
+_lazy_attributes = {
+    "MessageHistory": "make_agents.history",
+    "MessagesView": "make_agents.history",
+    "End": "make_agents.make_agents",
+    "Start": "make_agents.make_agents",
+    "action": "make_agents.make_agents",
+    "arun_agent": "make_agents.make_agents",
+    "run_agent": "make_agents.make_agents",
+}
+_lazy_modules = ("bonus", "gpt")
+__all__ = [*_lazy_attributes, *_lazy_modules]  # for `from make_agents import *`
 
-# Expose the objects that are part of the API
-import make_agents.bonus as bonus  # noqa: F401
-import make_agents.gpt as gpt  # noqa: F401
-from make_agents.make_agents import End, Start, action, run_agent  # noqa: F401
+if TYPE_CHECKING:
+    from make_agents import bonus, gpt  # noqa: F401
+    from make_agents.history import MessageHistory, MessagesView  # noqa: F401
+    from make_agents.make_agents import (  # noqa: F401
+        End,
+        Start,
+        action,
+        arun_agent,
+        run_agent,
+    )
+
+
+def __getattr__(name: str):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value  # so __getattr__ isn't called again
+        return value
+    if name in _lazy_modules:
+        return importlib.import_module(f"{__name__}.{name}")
+    if name == "__version__":
+        from importlib_metadata import version
+
+        return version(__package__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), "__version__", *_lazy_attributes, *_lazy_modules])
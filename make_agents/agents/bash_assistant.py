@@ -1,10 +1,10 @@
+"""This is a bash agent that will try to assist you with your system..."""
 import pprint
-import shlex
-import subprocess
 
 from pydantic import BaseModel, Field
 
 import make_agents as ma
+from make_agents.commands import CommandRunner
 
 
 class MessageUserArg(BaseModel):
@@ -28,30 +28,63 @@ def get_task_instructions():
 class RunBashCommandArg(BaseModel):
     plan: str = Field(description="Plan what to run")
     command: str = Field(description="Command to run")
+    background: bool = Field(
+        False,
+        description="Run it in the background, e.g. if it will take more than a minute,"
+        " and check on it later",
+    )
+
+
+# Commands time out after a minute (an hour in the background), and only the first and
+# last 4kB of their output are kept
+runner = CommandRunner(timeout=60, background_timeout=3600, max_output_bytes=8192)
 
 
 @ma.action
 def run_bash_command(arg: RunBashCommandArg):
-    """Record the users first and last name."""
+    """Run a bash command, once the user has validated it."""
     command = arg.command.strip()
     answer = input(
         f"Please validate the following bash command:\n`{command}`\nDo you want the agent to run it? (y/n)\n>  "
     ).lower()
-    while not answer:
-        if answer not in ["y", "n"]:
-            answer = input("Please enter either 'y' or 'n'.\n>  ").lower()
+    while answer not in ["y", "n"]:
+        answer = input("Please enter either 'y' or 'n'.\n>  ").lower()
     if answer == "n":
         return {"status": "user cancelled command"}
-    result = subprocess.run(shlex.split(arg.command), capture_output=True, text=True)
-    return {"stout": result.stdout, "stderr": result.stderr, "status": "command ran"}
+    return runner.run(command, background=arg.background)
+
+
+class JobArg(BaseModel):
+    job_id: int = Field(description="The job_id of a command run in the background")
+
+
+class CheckJobArg(JobArg):
+    wait: float = Field(
+        0, description="Seconds to wait for it to finish, at most 60", ge=0, le=60
+    )
+
+
+@ma.action
+def check_background_command(arg: CheckJobArg):
+    """Get the status and output so far of a command run in the background."""
+    return runner.check(arg.job_id, wait=arg.wait)
+
+
+@ma.action
+def stop_background_command(arg: JobArg):
+    """Stop a command run in the background."""
+    return runner.stop(arg.job_id)
 
 
 # Define action graph
+commands = [run_bash_command, check_background_command, stop_background_command]
 action_graph = {
     ma.Start: [get_task_instructions],
     get_task_instructions: [message_user],
-    message_user: [message_user, run_bash_command, ma.End],
-    run_bash_command: [message_user, run_bash_command],
+    message_user: [message_user, *commands, ma.End],
+    run_bash_command: [message_user, *commands],
+    check_background_command: [message_user, *commands],
+    stop_background_command: [message_user, *commands],
 }
 
 
@@ -0,0 +1,420 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Caches of JSON values, in memory or on disk (SQLite), with LRU eviction and expiry,
+a record / replay cache for completion functions, sharing of identical in-flight
+completion requests, and memoisation of action functions.
+"""
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Optional
+
+MODES = ("read_write", "record", "replay")
+
+
+class CacheMissError(KeyError):
+    """Raised in "replay" mode, when a request isn't in the cache."""
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+
+class MemoryCache:
+    """An in-memory cache of JSON text, evicting the least recently used entries
+    once there are more than `max_entries` entries, or more than `max_bytes` bytes of values.
+    If `ttl` is given, entries expire `ttl` seconds after they're put.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        clock: callable = time.time,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self._data = OrderedDict()  # key -> (value, expires)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+                self._bytes -= len(self._data.pop(key)[0])
+                self.stats.expirations += 1
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            if key in self._data:
+                self._bytes -= len(self._data.pop(key)[0])
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            self._data[key] = (value, expires)
+            self._bytes += len(value)
+            while self._data and (
+                (self.max_entries is not None and len(self._data) > self.max_entries)
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                _, (evicted, _) = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.stats.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    """An on-disk (SQLite) cache of JSON text, that persists between runs,
+    with the same eviction and expiry as `MemoryCache`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        clock: callable = time.time,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT,"
+                " size INTEGER, last_used INTEGER, expires REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS lru ON cache (last_used)")
+        # Orders the entries by when they were last used, for LRU eviction
+        (self._access_counter,) = self._db.execute(
+            "SELECT MAX(last_used) FROM cache"
+        ).fetchone()
+        self._access_counter = self._access_counter or 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT value, expires FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] is not None and row[1] <= self.clock():
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.stats.expirations += 1
+                row = None
+            if row is None:
+                self.stats.misses += 1
+                return None
+            self._access_counter += 1
+            self._db.execute(
+                "UPDATE cache SET last_used = ? WHERE key = ?",
+                (self._access_counter, key),
+            )
+            self.stats.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str):
+        with self._lock, self._db:
+            self._access_counter += 1
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, last_used, expires)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), self._access_counter, expires),
+            )
+            self._evict()
+
+    def _evict(self):
+        if self.max_entries is None and self.max_bytes is None:
+            return
+        num_entries, num_bytes = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()
+        evict = []
+        oldest_first = self._db.execute("SELECT key, size FROM cache ORDER BY last_used")
+        for key, size in oldest_first:
+            if not (
+                (self.max_entries is not None and num_entries > self.max_entries)
+                or (self.max_bytes is not None and num_bytes > self.max_bytes)
+            ):
+                break
+            evict.append((key,))
+            num_entries -= 1
+            num_bytes -= size
+        self._db.executemany("DELETE FROM cache WHERE key = ?", evict)
+        self.stats.evictions += len(evict)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+def request_key(request: dict) -> str:
+    """A hash of the (canonical JSON of the) kwargs of a completion request."""
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def cached_completion(completion: callable, cache, mode: str = "read_write") -> callable:
+    """Wrap a completion function, so that its responses are cached,
+    e.g. to re-run an agent, or its tests, without calling the LLM again.
+
+    The cache key is a hash of the full request: the model (and other defaults,
+    if the completion function is from `gpt.get_completion_func`),
+    the messages, the functions, the function_call, etc.
+
+    Parameters
+    ----------
+    completion : callable
+        The completion function to wrap.
+    cache : Union[MemoryCache, SQLiteCache]
+        Where the responses are stored.
+    mode : str, optional
+        "read_write" uses cached responses, and caches new ones,
+        "record" always calls `completion`, and caches the response,
+        "replay" only uses cached responses, raising `CacheMissError` for
+        any request that isn't cached. By default "read_write".
+
+    Returns
+    -------
+    callable
+        The completion function, with caching.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}.")
+    request_defaults = getattr(completion, "request_defaults", {})
+
+    def cached(**kwargs):
+        if kwargs.get("stream"):  # streamed responses aren't cached
+            return completion(**kwargs)
+        key = request_key({**request_defaults, **kwargs})
+        if mode != "record":
+            response = cache.get(key)
+            if response is not None:
+                return response_from_json(response)
+            if mode == "replay":
+                raise CacheMissError(key)
+        response = completion(**kwargs)
+        cache.put(key, response_to_json(response))
+        return response
+
+    cached.request_defaults = request_defaults
+    return cached
+
+
+def cached_acompletion(
+    acompletion: callable, cache, mode: str = "read_write"
+) -> callable:
+    """The same as `cached_completion`, for async completion functions."""
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}.")
+    request_defaults = getattr(acompletion, "request_defaults", {})
+
+    async def cached(**kwargs):
+        if kwargs.get("stream"):  # streamed responses aren't cached
+            return await acompletion(**kwargs)
+        key = request_key({**request_defaults, **kwargs})
+        if mode != "record":
+            response = cache.get(key)
+            if response is not None:
+                return response_from_json(response)
+            if mode == "replay":
+                raise CacheMissError(key)
+        response = await acompletion(**kwargs)
+        cache.put(key, response_to_json(response))
+        return response
+
+    cached.request_defaults = request_defaults
+    return cached
+
+
+@dataclass
+class SingleFlightStats:
+    requests: int = 0
+    # The requests that shared the call of an identical request already in flight
+    coalesced: int = 0
+
+
+def single_flight_completion(completion: callable) -> callable:
+    """Wrap a completion function, so that identical requests that are in flight
+    at the same time share one call, e.g. the first steps of many agents started
+    with the same messages. Each caller gets its own copy of the response.
+
+    Requests are identical if their `request_key`s are (as for `cached_completion`).
+    Use it when identical requests should get the same response (e.g. temperature 0).
+    Streamed requests aren't shared. Counts are in the `stats` attribute.
+    """
+    request_defaults = getattr(completion, "request_defaults", {})
+    stats = SingleFlightStats()
+    in_flight = {}  # key -> Future of (response, response JSON)
+    lock = threading.Lock()
+
+    def coalesced(**kwargs):
+        if kwargs.get("stream"):
+            return completion(**kwargs)
+        key = request_key({**request_defaults, **kwargs})
+        with lock:
+            stats.requests += 1
+            future = in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = in_flight[key] = Future()
+            else:
+                stats.coalesced += 1
+        if not leader:
+            response, text = future.result()
+            return copy_response(response, text)
+        try:
+            response = completion(**kwargs)
+            future.set_result((response, json.dumps(response)))
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with lock:
+                del in_flight[key]
+
+    coalesced.request_defaults = request_defaults
+    coalesced.stats = stats
+    return coalesced
+
+
+def single_flight_acompletion(acompletion: callable) -> callable:
+    """The same as `single_flight_completion`, for async completion functions.
+    The shared call isn't cancelled if one of its callers is cancelled."""
+    request_defaults = getattr(acompletion, "request_defaults", {})
+    stats = SingleFlightStats()
+    in_flight = {}  # (event loop, key) -> task
+
+    async def call(**kwargs):
+        response = await acompletion(**kwargs)
+        return response, json.dumps(response)
+
+    async def coalesced(**kwargs):
+        if kwargs.get("stream"):
+            return await acompletion(**kwargs)
+        key = (
+            asyncio.get_running_loop(),
+            request_key({**request_defaults, **kwargs}),
+        )
+        stats.requests += 1
+        task = in_flight.get(key)
+        if task is not None:
+            stats.coalesced += 1
+            response, text = await asyncio.shield(task)
+            return copy_response(response, text)
+        task = in_flight[key] = asyncio.ensure_future(call(**kwargs))
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+        response, _ = await asyncio.shield(task)
+        return response
+
+    coalesced.request_defaults = request_defaults
+    coalesced.stats = stats
+    return coalesced
+
+
+def copy_response(response, text: str):
+    """A copy of a response, from its JSON `text`, of the same type."""
+    if type(response) is dict:
+        return json.loads(text)
+    from openai.util import convert_to_openai_object
+
+    return convert_to_openai_object(json.loads(text))
+
+
+def memoised_action(func: callable, cache) -> callable:
+    """Wrap an action function, so that its results are cached, keyed by the function
+    and the canonical JSON of its (validated) input. Used by `action(cache=...)`.
+    The results must be JSON serialisable (as they are for the LLM anyway).
+    """
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    def key(args: tuple) -> str:
+        return request_key(
+            {"action": name, "arg": args[0].model_dump(mode="json") if args else None}
+        )
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def memoised(*args):
+            k = key(args)
+            result = cache.get(k)
+            if result is not None:
+                return json.loads(result)
+            result = await func(*args)
+            cache.put(k, json.dumps(result))
+            return result
+
+    else:
+
+        @functools.wraps(func)
+        def memoised(*args):
+            k = key(args)
+            result = cache.get(k)
+            if result is not None:
+                return json.loads(result)
+            result = func(*args)
+            cache.put(k, json.dumps(result))
+            return result
+
+    memoised.cache = cache
+    return memoised
+
+
+def response_to_json(response) -> str:
+    """The JSON text a response is cached as, with its type: a dict, or an OpenAI object
+    (so that it's loaded as the same type, see `response_from_json`)."""
+    return json.dumps({"openai_object": type(response) is not dict, "response": response})
+
+
+def response_from_json(text: str):
+    """Load a cached response, as the type that was cached: a dict, or an OpenAI object
+    (with attribute access), so that a cache hit looks the same as a miss."""
+    record = json.loads(text)
+    if not record["openai_object"]:
+        return record["response"]
+    from openai.util import convert_to_openai_object
+
+    return convert_to_openai_object(record["response"])
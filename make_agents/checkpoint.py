@@ -0,0 +1,196 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checkpointing agent sessions to an append-only log, and resuming them from it."""
+import json
+import os
+from dataclasses import dataclass
+from typing import Iterator, Optional, Union
+
+from make_agents.make_agents import (
+    Start,
+    description,
+    dict_to_action_graph_func,
+    get_pydantic_model_from_action_func,
+    parallel_actions_factory,
+    parallel_last_call,
+    run_agent,
+)
+
+
+class SessionLog:
+    """An append-only JSONL log of a session's messages, written to by `run_agent`
+    (see its `session_log` parameter). Each line is either
+    `{"op": "append", "message": ...}`, or `{"op": "replace", "messages": [...]}`
+    (written when the messages were modified in place, e.g. by a `pre_llm_callback`).
+
+    Every line is flushed as it's written, and fsync'ed every `fsync_every` lines
+    (and on close), to balance durability with write cost.
+    """
+
+    def __init__(self, path: str, fsync_every: int = 10):
+        self.path = path
+        self.fsync_every = fsync_every
+        self._file = open(path, "a")
+        self._unsynced = 0
+
+    def append(self, message: dict):
+        self._write({"op": "append", "message": message})
+
+    def replace(self, messages: list[dict]):
+        self._write({"op": "replace", "messages": list(messages)})
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def read(path: str) -> tuple[list[dict], list[dict]]:
+        """Returns the current messages, and all the messages ever appended, in order.
+        A truncated last line (from a crash while writing) is ignored."""
+        messages, appended = [], []
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if record["op"] == "append":
+                    messages.append(record["message"])
+                    appended.append(record["message"])
+                else:
+                    messages = record["messages"]
+        return messages, appended
+
+
+@dataclass
+class SessionState:
+    """The state of the agent loop, rebuilt from a `SessionLog`, by `load_session`."""
+
+    messages: list[dict]
+    current_action: callable
+    current_action_result: object
+    # The selection call, without its result: (options, the call message)
+    pending_selection: Optional[tuple[list[callable], dict]] = None
+    # The action selected, that hasn't been run yet
+    pending_action: Optional[callable] = None
+    # The input of `pending_action`, if the call message is already in the messages
+    pending_call: Optional[tuple] = None
+
+
+def load_session(path: str, action_graph: Union[dict, callable]) -> SessionState:
+    """Rebuild the state of a session from its log, by walking the action graph
+    along the function calls (and results) that were logged. No LLM calls are made.
+    """
+    if isinstance(action_graph, dict):
+        action_graph = dict_to_action_graph_func(action_graph)
+    messages, appended = SessionLog.read(path)
+    current_action, current_action_result = Start, None
+    options, selection_call, selected, call = None, None, None, None
+    for message in appended:
+        if message["role"] == "assistant" and message.get("function_call"):
+            name = message["function_call"]["name"]
+            options = action_graph(
+                current_action=current_action, current_action_result=current_action_result
+            )
+            if name == "select_next_func":
+                selection_call = message
+            elif name == "run_in_parallel":
+                call = (parallel_actions_factory(options), message)
+                selection_call = None
+            else:
+                call = (find_action(options, name), message)
+                selection_call = None
+        elif message["role"] == "function":
+            if message["name"] == "select_next_func":
+                selected = find_action(options, json.loads(message["content"]))
+                selection_call = None
+            elif call is not None:
+                current_action, current_action_result = call[0], json.loads(
+                    message["content"]
+                )
+                if hasattr(current_action, "parallel_options"):
+                    current_action, current_action_result = parallel_last_call(
+                        current_action, current_action_result
+                    )
+                call, selected = None, None
+    state = SessionState(messages, current_action, current_action_result)
+    if call is not None:
+        action_func, message = call
+        arg = None
+        if description(action_func)["parameters"]:
+            pydantic_model = get_pydantic_model_from_action_func(action_func)
+            arg = pydantic_model(**json.loads(message["function_call"]["arguments"]))
+        state.pending_action, state.pending_call = action_func, (arg,)
+    elif selection_call is not None:
+        state.pending_selection = (options, selection_call)
+    elif selected is not None:
+        state.pending_action = selected
+    return state
+
+
+def find_action(options: list[callable], name: str) -> callable:
+    for x in options or []:
+        if description(x)["name"] == name:
+            return x
+    raise ValueError(f"The log doesn't match the action graph: no action {name!r}.")
+
+
+def resume_agent(
+    action_graph: Union[dict, callable], path: str, fsync_every: int = 10, **kwargs
+) -> Iterator:
+    """Resume the session logged at `path`, continuing to log to it.
+
+    If the session stopped part way through a step, the step is finished without
+    repeating any LLM calls: a logged selection is applied, and an action whose call
+    was logged (but not its result) is run again, with the logged input.
+
+    Parameters
+    ----------
+    action_graph : Union[dict[callable, list[callable]], callable]
+        The same action graph the session was run with.
+    path : str
+        The path of the session's log.
+    fsync_every : int, optional
+        See `SessionLog`, by default 10.
+    **kwargs
+        Passed to `run_agent`, e.g. `completion`.
+
+    Yields
+    ------
+    Iterator[MessagesView]
+        The messages after each step, see `run_agent`.
+    """
+    state = load_session(path, action_graph)
+    with SessionLog(path, fsync_every) as session_log:
+        yield from run_agent(
+            action_graph, session_log=session_log, resume=state, **kwargs
+        )
@@ -1,6 +1,16 @@
+"""The command line interface. The agents, and the rest of make_agents (and openai),
+are only imported when a command needs them, so that the CLI starts quickly."""
+import ast
+import functools
+import importlib
+import json
+import pkgutil
+from pathlib import Path
+from typing import Optional
+
 import click
 
-from make_agents.agents import bash_assistant
+AGENTS_DIR = Path(__file__).parent / "agents"
 
 
 @click.group()
@@ -8,19 +18,146 @@ def cli():
     pass
 
 
-@click.group()
+class AgentsGroup(click.Group):
+    """Has a command for each module in make_agents/agents, that calls its `run`
+    function. The modules are found without importing them, and a module is only
+    imported when its command is run."""
+
+    def list_commands(self, ctx) -> list[str]:
+        return sorted(x.name for x in pkgutil.iter_modules([str(AGENTS_DIR)]))
+
+    def get_command(self, ctx, name: str) -> click.Command:
+        if name not in self.list_commands(ctx):
+            return None
+
+        @click.command(name=name, help=agent_docstring(name))
+        @click.option("--verbose", "-v", is_flag=True, help="Will print all messages.")
+        def run_agent(verbose):
+            importlib.import_module(f"make_agents.agents.{name}").run(verbose=verbose)
+
+        return run_agent
+
+
+def agent_docstring(name: str) -> str:
+    """The docstring of an agent's module, read without importing it."""
+    source = (AGENTS_DIR / f"{name}.py").read_text()
+    return ast.get_docstring(ast.parse(source)) or ""
+
+
+@click.group(cls=AgentsGroup)
 def run():
     """This is a group for running different agents"""
 
 
-@run.command(name="bash_assistant")
-@click.option("--verbose", "-v", is_flag=True, help="Will print all messages.")
-def _bash_assistant(verbose):
-    """This is a bash agent that will try to assist you with your system..."""
-    bash_assistant.run(verbose=verbose)
+class FleetBackend(click.ParamType):
+    """`click.Choice(fleet.BACKENDS)`, where fleet (and so the rest of make_agents) is
+    only imported when the option is used, or shown in the help."""
+
+    name = "backend"
+
+    def choice(self) -> click.Choice:
+        from make_agents.fleet import BACKENDS
+
+        return click.Choice(BACKENDS)
+
+    def get_metavar(self, param, *args, **kwargs):
+        return self.choice().get_metavar(param, *args, **kwargs)
+
+    def convert(self, value, param, ctx):
+        return self.choice().convert(value, param, ctx)
+
+    def shell_complete(self, ctx, param, incomplete):
+        return self.choice().shell_complete(ctx, param, incomplete)
+
+
+@click.command()
+@click.argument("action_graph")
+@click.argument("inputs", type=click.File("r"))
+@click.option(
+    "--output", "-o", required=True, help="JSONL file to append transcripts to."
+)
+@click.option("--concurrency", "-c", default=8, show_default=True)
+@click.option(
+    "--backend",
+    type=FleetBackend(),
+    default="threads",
+)
+@click.option("--model", default="gpt-4", show_default=True)
+@click.option(
+    "--selector-model",
+    default=None,
+    help="The model for selecting the next action, by default MODEL.",
+)
+def fleet(action_graph, inputs, output, concurrency, backend, model, selector_model):
+    """Run one agent per line of INPUTS, a JSONL file where each line is the initial
+    list of messages (or null), using ACTION_GRAPH, e.g. `my_package.agents:action_graph`.
+    """
+    from make_agents import fleet as fleet_
+
+    module_name, _, attribute = action_graph.partition(":")
+    graph = getattr(importlib.import_module(module_name), attribute)
+    stats = fleet_.run_fleet(
+        graph,
+        (json.loads(line) for line in inputs if line.strip()),
+        output_path=output,
+        max_concurrency=concurrency,
+        backend=backend,
+        completion_factory=functools.partial(
+            routed_completion, backend == "asyncio", model, selector_model
+        ),
+    )
+    click.echo(stats)
+
+
+def routed_completion(
+    asynchronous: bool, model: str, selector_model: Optional[str]
+) -> callable:
+    from make_agents import gpt
+
+    get_completion_func = (
+        gpt.get_acompletion_func if asynchronous else gpt.get_completion_func
+    )
+    if selector_model is None:
+        return get_completion_func(model=model)
+    from make_agents.routing import AsyncCompletionRouter, CompletionRouter
+
+    router = AsyncCompletionRouter if asynchronous else CompletionRouter
+    return router(
+        get_completion_func(model=model),
+        selector=get_completion_func(model=selector_model),
+    )
+
+
+@click.command(name="mock_server")
+@click.option("--port", default=8000, show_default=True)
+@click.option("--latency", default=0.0, show_default=True, help="Median, in seconds.")
+@click.option("--latency-sigma", default=0.0, show_default=True)
+@click.option("--rate-limit-rate", default=0.0, show_default=True)
+@click.option("--timeout-rate", default=0.0, show_default=True)
+@click.option("--timeout-seconds", default=30.0, show_default=True)
+def mock_server(
+    port, latency, latency_sigma, rate_limit_rate, timeout_rate, timeout_seconds
+):
+    """Serve a local mock of the OpenAI chat completions API, for load testing,
+    with fake responses (see `make_agents.mock_server`)."""
+    from make_agents import mock_server as mock_server_
+
+    server = mock_server_.MockOpenAIServer(
+        latency=mock_server_.lognormal_latency(latency, latency_sigma)
+        if latency
+        else 0.0,
+        rate_limit_rate=rate_limit_rate,
+        timeout_rate=timeout_rate,
+        timeout_seconds=timeout_seconds,
+        port=port,
+    )
+    click.echo(f"Serving on {server.url}")
+    server.serve_forever()
 
 
 cli.add_command(run)
+cli.add_command(fleet)
+cli.add_command(mock_server)
 
 if __name__ == "__main__":
     cli()
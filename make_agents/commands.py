@@ -0,0 +1,250 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Running shell commands for agents: with a time limit, in the background if need be,
+streaming their output (to the terminal, and into a buffer of bounded size),
+so that only a bounded summary of the output goes into the messages."""
+import itertools
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Optional
+
+# The bytes read from the command's output at a time
+CHUNK_SIZE = 4096
+
+
+class BoundedOutput:
+    """Keeps the first and last `max_bytes / 2` bytes of a stream, and counts the rest."""
+
+    def __init__(self, max_bytes: int):
+        self.head_bytes = max_bytes // 2
+        self.tail_bytes = max_bytes - self.head_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes):
+        with self._lock:
+            self.total_bytes += len(data)
+            room = self.head_bytes - len(self.head)
+            if room > 0:
+                self.head += data[:room]
+                data = data[room:]
+            self.tail += data
+            del self.tail[: max(len(self.tail) - self.tail_bytes, 0)]
+
+    @property
+    def truncated_bytes(self) -> int:
+        return self.total_bytes - len(self.head) - len(self.tail)
+
+    def text(self) -> str:
+        with self._lock:
+            head = self.head.decode(errors="replace")
+            tail = self.tail.decode(errors="replace")
+            truncated = self.truncated_bytes
+        if truncated:
+            return f"{head}\n... [{truncated} bytes truncated] ...\n{tail}"
+        return head + tail
+
+
+class Job:
+    """A running command. Its output is read by background threads, so the command
+    never blocks on a full pipe, and it's killed after `timeout` seconds."""
+
+    def __init__(
+        self,
+        job_id: int,
+        command: str,
+        timeout: Optional[float],
+        max_output_bytes: int,
+        echo: bool,
+    ):
+        self.id = job_id
+        self.command = command
+        self.stdout = BoundedOutput(max_output_bytes)
+        self.stderr = BoundedOutput(max_output_bytes)
+        self.timed_out = False
+        self.stopped = False
+        self.started = time.monotonic()
+        self.finished = None
+        self._done = threading.Event()
+        self.process = subprocess.Popen(
+            shlex.split(command),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=os.name == "posix",  # so its children are killed with it
+        )
+        self._readers = [
+            threading.Thread(
+                target=self._read,
+                args=(self.process.stdout, self.stdout, sys.stdout if echo else None),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self._read,
+                args=(self.process.stderr, self.stderr, sys.stderr if echo else None),
+                daemon=True,
+            ),
+        ]
+        for reader in self._readers:
+            reader.start()
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._time_out)
+            self._timer.daemon = True
+            self._timer.start()
+        threading.Thread(target=self._wait, daemon=True).start()
+
+    @staticmethod
+    def _read(pipe, output: BoundedOutput, terminal):
+        for data in iter(lambda: pipe.read1(CHUNK_SIZE), b""):
+            output.write(data)
+            if terminal is not None:
+                terminal.write(data.decode(errors="replace"))
+                terminal.flush()
+        pipe.close()
+
+    def _wait(self):
+        self.process.wait()
+        for reader in self._readers:
+            reader.join()
+        if self._timer is not None:
+            self._timer.cancel()
+        self.finished = time.monotonic()
+        self._done.set()
+
+    def _time_out(self):
+        # (Its output may still be open in processes it started, after it has exited)
+        if not self._done.is_set():
+            self.timed_out = True
+            self.kill()
+
+    def kill(self):
+        """Kill the command (and, on POSIX, the processes it started)."""
+        try:
+            if os.name == "posix":
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except ProcessLookupError:
+            pass  # it already exited
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the command to finish (and its output to be read),
+        returns whether it has."""
+        return self._done.wait(timeout)
+
+    @property
+    def status(self) -> str:
+        if self.finished is None:
+            return "running"
+        if self.timed_out:
+            return "timed out"
+        return "stopped" if self.stopped else "exited"
+
+    def summary(self) -> dict:
+        """The status, and the (bounded) output so far, e.g. for the LLM."""
+        end = self.finished if self.finished is not None else time.monotonic()
+        summary = {
+            "job_id": self.id,
+            "status": self.status,
+            "exit_code": self.process.returncode if self.finished is not None else None,
+            "seconds": round(end - self.started, 2),
+            "stdout": self.stdout.text(),
+            "stderr": self.stderr.text(),
+        }
+        if self.stdout.truncated_bytes or self.stderr.truncated_bytes:
+            summary["truncated_bytes"] = (
+                self.stdout.truncated_bytes + self.stderr.truncated_bytes
+            )
+        return summary
+
+
+class CommandRunner:
+    """Runs commands (without a shell), e.g. for an agent's action functions.
+
+    Parameters
+    ----------
+    timeout : Optional[float], optional
+        The wall-clock time limit, in seconds, after which a command is killed,
+        by default 60. (None for no limit.)
+    background_timeout : Optional[float], optional
+        The same, for commands run in the background, by default 3600.
+    max_output_bytes : int, optional
+        The most bytes kept of each of stdout and stderr: the first and last halves,
+        by default 8192.
+    echo : bool, optional
+        Whether to stream the output of commands run in the foreground to the terminal,
+        as it's produced, by default True.
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[float] = 60.0,
+        background_timeout: Optional[float] = 3600.0,
+        max_output_bytes: int = 8192,
+        echo: bool = True,
+    ):
+        self.timeout = timeout
+        self.background_timeout = background_timeout
+        self.max_output_bytes = max_output_bytes
+        self.echo = echo
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def run(self, command: str, background: bool = False) -> dict:
+        """Run a command, and return its summary (see `Job.summary`). If `background`,
+        returns straight away, and the job can be checked on with `check`."""
+        with self._lock:
+            job_id = next(self._ids)
+        try:
+            job = Job(
+                job_id,
+                command,
+                self.background_timeout if background else self.timeout,
+                self.max_output_bytes,
+                echo=self.echo and not background,
+            )
+        except (OSError, ValueError) as e:  # e.g. not found, or unbalanced quotes
+            return {"job_id": None, "status": "failed to start", "error": str(e)}
+        self.jobs[job_id] = job
+        if not background:
+            job.wait()
+        return job.summary()
+
+    def check(self, job_id: int, wait: float = 0.0) -> dict:
+        """The summary of a job, after waiting up to `wait` seconds for it to finish."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return {"job_id": job_id, "status": "unknown job"}
+        job.wait(wait)
+        return job.summary()
+
+    def stop(self, job_id: int) -> dict:
+        """Kill a job, and return its summary."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return {"job_id": job_id, "status": "unknown job"}
+        if not job.wait(0):
+            job.stopped = True
+            job.kill()
+            job.wait(5)
+        return job.summary()
@@ -0,0 +1,132 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keeping the messages within a token budget, to bound prompt size (and so latency and cost)."""
+import json
+from typing import Optional
+
+STRATEGIES = ("sliding_window", "pinned_system")
+
+# Approximate tokens used by the formatting of each message
+TOKENS_PER_MESSAGE = 4
+
+
+def get_token_counter(model: str = "gpt-4") -> callable:
+    """Returns a function that counts the tokens in a string, using tiktoken if it's
+    installed (make_agents does not install it), else estimating ~4 characters per token.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return lambda text: (len(text) + 3) // 4
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return lambda text: len(encoding.encode(text))
+
+
+class ContextWindowManager:
+    """A `pre_llm_callback` that drops the oldest messages, once the messages
+    are over `max_tokens` tokens.
+
+    Token counts are cached per message, so each message is only tokenised once.
+    A function call and its result are always dropped together.
+
+    Parameters
+    ----------
+    max_tokens : int
+        The maximum number of tokens in the messages (leave room for the function
+        descriptions, and the completion, in the model's context window).
+    strategy : str, optional
+        "sliding_window" keeps the most recent messages,
+        "pinned_system" also always keeps the system prompt (the leading system messages),
+        by default "pinned_system".
+    pin_first : int, optional
+        The number of messages after the system prompt to always keep,
+        e.g. 2 to keep the call and result of an action that gave the agent its task,
+        by default 0. If the last of them is a function call, its result is kept too.
+    model : str, optional
+        The model, for choosing the tokenizer, by default "gpt-4".
+    count_tokens : Optional[callable], optional
+        Counts the tokens in a string, by default from `get_token_counter(model)`.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int,
+        strategy: str = "pinned_system",
+        pin_first: int = 0,
+        model: str = "gpt-4",
+        count_tokens: Optional[callable] = None,
+    ):
+        if strategy not in STRATEGIES:
+            raise ValueError(
+                f"Unknown strategy {strategy!r}, expected one of {STRATEGIES}."
+            )
+        self.max_tokens = max_tokens
+        self.strategy = strategy
+        self.pin_first = pin_first
+        self.count_tokens = count_tokens or get_token_counter(model)
+        self.dropped_messages = 0
+        self._counts = {}  # id(message) -> (message, tokens)
+
+    def message_tokens(self, message: dict) -> int:
+        """The (cached) number of tokens in a message."""
+        cached = self._counts.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        text = json.dumps(
+            [message.get(key) for key in ("content", "name", "function_call")]
+        )
+        tokens = self.count_tokens(text) + TOKENS_PER_MESSAGE
+        self._counts[id(message)] = (message, tokens)
+        return tokens
+
+    def num_pinned(self, messages: list[dict]) -> int:
+        num_pinned = 0
+        if self.strategy == "pinned_system":
+            while num_pinned < len(messages) and messages[num_pinned]["role"] == "system":
+                num_pinned += 1
+        num_pinned = min(num_pinned + self.pin_first, len(messages))
+        if num_pinned and is_call_with_result(messages, num_pinned - 1):
+            num_pinned += 1  # pin the result of a pinned call too
+        return num_pinned
+
+    def __call__(self, messages: list[dict]):
+        tokens = [self.message_tokens(m) for m in messages]
+        if len(self._counts) > 2 * len(messages):  # forget dropped messages
+            self._counts = {id(m): (m, t) for m, t in zip(messages, tokens)}
+        total = sum(tokens)
+        start = end = self.num_pinned(messages)
+        # Drop the oldest (unpinned) messages, but never the most recent one
+        while total > self.max_tokens and end < len(messages) - 1:
+            size = 2 if is_call_with_result(messages, end) else 1
+            if end + size >= len(messages):
+                break
+            total -= sum(tokens[end : end + size])
+            end += size
+        if end > start:
+            del messages[start:end]
+            self.dropped_messages += end - start
+
+
+def is_call_with_result(messages: list[dict], i: int) -> bool:
+    """Whether messages[i] is a function call, and messages[i + 1] is its result."""
+    return (
+        i + 1 < len(messages)
+        and messages[i]["role"] == "assistant"
+        and bool(messages[i].get("function_call"))
+        and messages[i + 1]["role"] == "function"
+        and messages[i + 1].get("name") == messages[i]["function_call"]["name"]
+    )
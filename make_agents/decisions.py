@@ -0,0 +1,196 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Selecting the next action without the LLM, when it's predictable from the current
+action and its result: from rules, and from the selections in past transcripts."""
+import json
+import threading
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union
+
+
+@dataclass
+class DecisionStats:
+    rule_decisions: int = 0
+    cache_decisions: int = 0
+    # The selections left to the LLM
+    llm_decisions: int = 0
+
+    @property
+    def saved_calls(self) -> int:
+        """The selector (LLM) calls that were saved."""
+        return self.rule_decisions + self.cache_decisions
+
+
+@dataclass
+class Rule:
+    """After `current_action`, if its result matches `when`, select `select`.
+
+    `when` is a function `when(result) -> bool`, or a dict that the result must contain,
+    e.g. `Rule(check_validation_code, message_user, when={"status": "error"})`.
+    By default (None), the rule always applies.
+    """
+
+    current_action: callable
+    select: callable
+    when: Optional[Union[callable, dict]] = None
+
+    def matches(self, current_action: callable, result) -> bool:
+        if current_action != self.current_action:
+            return False
+        if self.when is None:
+            return True
+        if isinstance(self.when, dict):
+            return isinstance(result, dict) and all(
+                k in result and result[k] == v for k, v in self.when.items()
+            )
+        return bool(self.when(result))
+
+
+def result_shape(result) -> tuple:
+    """What a decision is keyed on, besides the current action: for dicts, the keys,
+    and the values that look like a status (booleans, None, short strings),
+    e.g. `{"status": "error", "description": "..."}` -> `(("description", "str"),
+    ("status", "error"))`. For other results, the type."""
+    if not isinstance(result, dict):
+        return (type(result).__name__,)
+    return tuple(
+        (k, v if _is_status(v) else type(v).__name__)
+        for k, v in sorted(result.items(), key=lambda x: str(x[0]))
+    )
+
+
+def _is_status(value) -> bool:
+    return (
+        value is None
+        or isinstance(value, bool)
+        or (isinstance(value, str) and len(value) <= 20)
+    )
+
+
+class DecisionCache:
+    """The past selections, by the current action and the shape of its result
+    (see `result_shape`), recorded as the agent runs, or learnt from transcripts.
+
+    Parameters
+    ----------
+    min_count : int, optional
+        Only decide once the selection has been made this many times, by default 3.
+    min_confidence : float, optional
+        Only decide if the selection has been made at least this fraction of the time,
+        by default 0.9.
+    shape : callable, optional
+        The function that gives the shape of a result, by default `result_shape`.
+    """
+
+    def __init__(
+        self,
+        min_count: int = 3,
+        min_confidence: float = 0.9,
+        shape: callable = result_shape,
+    ):
+        self.min_count = min_count
+        self.min_confidence = min_confidence
+        self.shape = shape
+        self.selections = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def decide(self, current_action: callable, result, options: list[callable]):
+        """The option that's confidently the selection, or None."""
+        counts = self.selections.get(self._key(current_action.__name__, result))
+        if not counts:
+            return None
+        (name, count), *_ = counts.most_common(1)
+        if count < self.min_count or count / sum(counts.values()) < self.min_confidence:
+            return None
+        return next((x for x in options if x.__name__ == name), None)
+
+    def record(self, current_action: callable, result, selected: callable):
+        self._record(current_action.__name__, result, selected.__name__)
+
+    def learn(self, messages: Iterable[dict]):
+        """Record the selections in a transcript (a list of messages, e.g. from
+        `run_agent`, or a `checkpoint.SessionLog`)."""
+        previous = None  # the last action, and its result
+        for message in messages:
+            if message["role"] == "function" and message["name"] != "select_next_func":
+                try:
+                    previous = message["name"], json.loads(message["content"])
+                except (TypeError, json.JSONDecodeError):
+                    previous = None
+            elif message["role"] == "assistant" and message.get("function_call"):
+                name = message["function_call"]["name"]
+                if name == "select_next_func":
+                    try:
+                        arguments = json.loads(message["function_call"]["arguments"])
+                        name = arguments["next_function"]
+                    except (TypeError, KeyError, json.JSONDecodeError):
+                        continue
+                if previous is not None:
+                    self._record(*previous, name)
+                    previous = None
+
+    def _record(self, current_action: str, result, selected: str):
+        with self._lock:
+            self.selections[self._key(current_action, result)][selected] += 1
+
+    def _key(self, current_action: str, result) -> tuple:
+        return (current_action, self.shape(result))
+
+
+class DecisionRouter:
+    """Selects the next action without the LLM when it can, by `rules` (checked in order),
+    then by `cache`, so that `run_agent` only asks the LLM (`select_next_func`)
+    when the selection is uncertain. The LLM's selections are recorded in the cache.
+
+    Parameters
+    ----------
+    rules : Iterable[Rule], optional
+        By default none.
+    cache : Optional[DecisionCache], optional
+        By default None (only the rules are used).
+    """
+
+    def __init__(self, rules: Iterable[Rule] = (), cache: Optional[DecisionCache] = None):
+        self.rules = list(rules)
+        self.cache = cache
+        self.stats = DecisionStats()
+        self._lock = threading.Lock()
+
+    def decide(
+        self, current_action: callable, result, options: list[callable]
+    ) -> tuple[Optional[callable], Optional[str]]:
+        """The selection, and what made it ("rule" or "cache"), or (None, None)
+        if it's up to the LLM."""
+        selected, source = None, None
+        for rule in self.rules:
+            if rule.select in options and rule.matches(current_action, result):
+                selected, source = rule.select, "rule"
+                break
+        if selected is None and self.cache is not None:
+            selected = self.cache.decide(current_action, result, options)
+            source = "cache" if selected is not None else None
+        with self._lock:
+            if source == "rule":
+                self.stats.rule_decisions += 1
+            elif source == "cache":
+                self.stats.cache_decisions += 1
+            else:
+                self.stats.llm_decisions += 1
+        return selected, source
+
+    def record(self, current_action: callable, result, selected: callable):
+        """Record a selection made by the LLM."""
+        if self.cache is not None:
+            self.cache.record(current_action, result, selected)
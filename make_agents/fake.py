@@ -0,0 +1,236 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A deterministic fake LLM, with the response format of `openai.ChatCompletion.create`,
+for running agents offline, e.g. in tests and benchmarks.
+"""
+import asyncio
+import itertools
+import json
+import threading
+import time
+from typing import Iterator, Optional, Union
+
+
+class FakeLLM:
+    """Answers completion requests with function calls, without a network.
+
+    The function called is the one forced by `function_call`; when the choice is
+    the model's (`select_next_func`, or `function_call="auto"`), the choices are
+    scripted. The arguments are the simplest ones that are valid for the function's
+    JSON schema (see `fake_arguments`), unless `arguments` is given.
+
+    Parameters
+    ----------
+    choices : Optional[Union[list[str], callable]], optional
+        The names of the functions to choose, in order (cycling through them,
+        and skipping any that aren't options), or a function
+        `choices(options, messages) -> name`. By default the first option is chosen.
+    arguments : Optional[callable], optional
+        A function `arguments(name, parameters_schema, messages) -> dict`,
+        by default `fake_arguments(parameters_schema)`.
+    latency : float, optional
+        Seconds to wait before responding (or before the first chunk, when streaming),
+        by default 0.
+    prompt_tokens : Optional[int], optional
+        The prompt tokens to report in the usage, by default estimated from the request
+        (~4 characters per token).
+    completion_tokens : int, optional
+        The completion tokens to report in the usage, by default 10.
+    chunk_size : int, optional
+        The number of characters of the arguments in each chunk, when streaming,
+        by default 8.
+    model : str, optional
+        The model to report, by default "fake".
+    """
+
+    def __init__(
+        self,
+        choices: Optional[Union[list[str], callable]] = None,
+        arguments: Optional[callable] = None,
+        latency: float = 0.0,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: int = 10,
+        chunk_size: int = 8,
+        model: str = "fake",
+    ):
+        if isinstance(choices, (list, tuple)):
+            choices = _cycle_choices(choices)
+        self.choices = choices
+        self.arguments = arguments
+        self.latency = latency
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.chunk_size = chunk_size
+        self.model = model
+        self.calls = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def completion(self, stream: bool = False, **kwargs):
+        """A completion function, to pass to `run_agent`."""
+        if self.latency:
+            time.sleep(self.latency)
+        response = self.respond(kwargs)
+        return self.stream(response) if stream else response
+
+    async def acompletion(self, stream: bool = False, **kwargs):
+        """An async completion function, to pass to `arun_agent`."""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        response = self.respond(kwargs)
+        if not stream:
+            return response
+
+        async def chunks():
+            for chunk in self.stream(response):
+                yield chunk
+
+        return chunks()
+
+    def respond(self, request: dict) -> dict:
+        """The response to a request (the kwargs of a completion function)."""
+        with self._lock:
+            self.calls += 1
+            response_id = next(self._ids)
+        messages = request.get("messages", [])
+        functions = {f["name"]: f for f in request.get("functions") or []}
+        function_call = request.get("function_call", "auto" if functions else "none")
+        if isinstance(function_call, dict):
+            name = function_call["name"]
+        elif function_call == "auto":
+            name = self.choose(list(functions), messages)
+        else:
+            name = None
+        if name is None:
+            message = {"role": "assistant", "content": "OK."}
+        else:
+            parameters = functions[name].get("parameters") or {}
+            if name == "select_next_func":
+                arguments = {
+                    "thought_process": "",
+                    "next_function": self.choose(_enum_options(parameters), messages),
+                }
+            elif self.arguments is not None:
+                arguments = self.arguments(name, parameters, messages)
+            else:
+                arguments = fake_arguments(parameters)
+            message = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {"name": name, "arguments": json.dumps(arguments)},
+            }
+        prompt_tokens = self.prompt_tokens
+        if prompt_tokens is None:
+            prompt_tokens = len(json.dumps([messages, request.get("functions")])) // 4
+        return {
+            "id": f"chatcmpl-fake-{response_id}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", self.model),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "function_call" if name else "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": prompt_tokens + self.completion_tokens,
+            },
+        }
+
+    def choose(self, options: list[str], messages: list[dict]) -> str:
+        if self.choices is None:
+            return options[0]
+        return self.choices(options, messages)
+
+    def stream(self, response: dict) -> Iterator[dict]:
+        """The response as `stream=True` chunks."""
+        message = response["choices"][0]["message"]
+        base = {k: response[k] for k in ("id", "created", "model")}
+        base["object"] = "chat.completion.chunk"
+
+        def chunk(delta: dict, finish_reason=None) -> dict:
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+            return {**base, "choices": [choice]}
+
+        if "function_call" not in message:
+            yield chunk({"role": "assistant", "content": message["content"]})
+        else:
+            name = message["function_call"]["name"]
+            arguments = message["function_call"]["arguments"]
+            yield chunk(
+                {"role": "assistant", "function_call": {"name": name, "arguments": ""}}
+            )
+            for i in range(0, len(arguments), self.chunk_size):
+                piece = arguments[i : i + self.chunk_size]
+                yield chunk({"function_call": {"arguments": piece}})
+        yield chunk({}, response["choices"][0]["finish_reason"])
+
+
+def fake_arguments(schema: dict, defs: Optional[dict] = None):
+    """The simplest value that's valid for a JSON schema (as made by Pydantic):
+    the default, the first enum value / option, "fake" for strings, 0 for numbers, etc.
+    """
+    defs = {**(defs or {}), **schema.get("$defs", {})}
+    if "$ref" in schema:
+        return fake_arguments(defs[schema["$ref"].split("/")[-1]], defs)
+    if "default" in schema:
+        return schema["default"]
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return schema["enum"][0]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return fake_arguments(schema[key][0], defs)
+    schema_type = schema.get("type", "object")
+    if schema_type == "object":
+        properties = schema.get("properties", {})
+        return {
+            key: fake_arguments(properties[key], defs)
+            for key in schema.get("required", [])
+        }
+    if schema_type == "array":
+        return [fake_arguments(schema["items"], defs)] * schema.get("minItems", 0)
+    if schema_type == "string":
+        return "fake".ljust(schema.get("minLength", 0), "e")
+    return {"integer": 0, "number": 0.0, "boolean": False, "null": None}[schema_type]
+
+
+def _enum_options(schema: dict) -> list[str]:
+    # The options of `select_next_func` are the enum of its `next_function` field
+    # (inlined in compact schemas)
+    field = schema["properties"]["next_function"]
+    if "enum" in field:
+        return field["enum"]
+    (options,) = schema["$defs"].values()
+    return options["enum"]
+
+
+def _cycle_choices(names: list[str]) -> callable:
+    num_names = len(names)
+    names = itertools.cycle(names)
+    lock = threading.Lock()
+
+    def choices(options: list[str], messages: list[dict]) -> str:
+        with lock:
+            for name in itertools.islice(names, num_names):
+                if name in options:
+                    return name
+        raise ValueError(f"None of the scripted choices are options: {options}")
+
+    return choices
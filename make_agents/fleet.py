@@ -0,0 +1,278 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run many agents (sessions) over the same action graph, with bounded concurrency."""
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import AsyncIterator, Iterable, Iterator, Optional, Union
+
+from make_agents.make_agents import arun_agent, run_agent
+
+BACKENDS = ("threads", "asyncio", "processes")
+
+
+@dataclass
+class SessionResult:
+    """The outcome of one session. `messages` is the final transcript,
+    (or as far as the session got, if it raised `error`)."""
+
+    index: int
+    messages: list[dict]
+    error: Optional[str] = None
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {"index": self.index, "messages": self.messages, "error": self.error}
+        )
+
+
+@dataclass
+class FleetStats:
+    """Throughput of a fleet run."""
+
+    sessions: int = 0
+    failed: int = 0
+    messages: int = 0
+    start_time: float = field(default_factory=time.perf_counter)
+    end_time: Optional[float] = None
+
+    def update(self, result: SessionResult):
+        self.sessions += 1
+        self.failed += result.error is not None
+        self.messages += len(result.messages)
+        self.end_time = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def sessions_per_second(self) -> float:
+        return self.sessions / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.sessions} sessions ({self.failed} failed), {self.messages} messages"
+            f" in {self.elapsed:.2f}s: {self.sessions_per_second:.2f} sessions/s,"
+            f" {self.messages_per_second:.2f} messages/s"
+        )
+
+
+def run_fleet(
+    action_graph: Union[dict, callable],
+    messages_inits: Iterable[Optional[list[dict]]],
+    output_path: Optional[str] = None,
+    max_concurrency: int = 8,
+    backend: str = "threads",
+    **kwargs,
+) -> FleetStats:
+    """Run one agent per element of `messages_inits`, with at most `max_concurrency`
+    running at any time. Each session's final transcript is appended to `output_path`
+    (as a line of JSON, see `SessionResult`) as soon as the session finishes.
+
+    Parameters
+    ----------
+    action_graph : Union[dict[callable, list[callable]], callable]
+        The graph of actions that every agent uses, see `run_agent`.
+    messages_inits : Iterable[Optional[list[dict]]]
+        The initial messages of each session. Consumed lazily.
+    output_path : Optional[str], optional
+        JSONL file that the transcripts are written to, by default None (not written).
+    max_concurrency : int, optional
+        The maximum number of sessions running at once, by default 8.
+    backend : str, optional
+        One of "threads", "asyncio" (uses `arun_agent`) or "processes", by default "threads".
+        With "processes", the action graph, completion, etc. must be picklable.
+    **kwargs
+        Passed to `iter_fleet`.
+
+    Returns
+    -------
+    FleetStats
+        The number of sessions / messages, and the throughput.
+    """
+    stats = FleetStats()
+    output = open(output_path, "a") if output_path else None
+    try:
+        for result in iter_fleet(
+            action_graph, messages_inits, max_concurrency, backend, **kwargs
+        ):
+            stats.update(result)
+            if output:
+                output.write(result.to_json() + "\n")
+                output.flush()
+    finally:
+        if output:
+            output.close()
+    return stats
+
+
+def iter_fleet(
+    action_graph: Union[dict, callable],
+    messages_inits: Iterable[Optional[list[dict]]],
+    max_concurrency: int = 8,
+    backend: str = "threads",
+    completion_factory: Optional[callable] = None,
+    **run_agent_kwargs,
+) -> Iterator[SessionResult]:
+    """Like `run_fleet`, but yields each `SessionResult` as soon as its session finishes
+    (so not necessarily in order).
+
+    `completion_factory` is an alternative to passing `completion`: it's called to
+    create the completion function in each session, e.g.
+    `functools.partial(gpt.get_completion_func, model="gpt-3.5-turbo")`, which
+    (unlike the completion function itself) can be pickled for the "processes" backend.
+    Other kwargs are passed to `run_agent` / `arun_agent`.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}.")
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1.")
+    if backend == "asyncio":
+        loop = asyncio.new_event_loop()
+        results = aiter_fleet(
+            action_graph,
+            messages_inits,
+            max_concurrency,
+            completion_factory,
+            **run_agent_kwargs,
+        )
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.run_until_complete(close_connection_pools())
+            loop.close()
+    executor_cls = ThreadPoolExecutor if backend == "threads" else ProcessPoolExecutor
+    inputs = enumerate(messages_inits)
+    with executor_cls(max_workers=max_concurrency) as executor:
+
+        def submit(n: int) -> set:
+            return {
+                executor.submit(
+                    run_session,
+                    action_graph,
+                    i,
+                    messages_init,
+                    completion_factory,
+                    run_agent_kwargs,
+                )
+                for i, messages_init in islice(inputs, n)
+            }
+
+        pending = submit(max_concurrency)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending |= submit(len(done))
+            for future in done:
+                yield future.result()
+
+
+async def aiter_fleet(
+    action_graph: Union[dict, callable],
+    messages_inits: Iterable[Optional[list[dict]]],
+    max_concurrency: int = 8,
+    completion_factory: Optional[callable] = None,
+    **arun_agent_kwargs,
+) -> AsyncIterator[SessionResult]:
+    """The asyncio version of `iter_fleet`, where every session runs in the current event loop."""
+    inputs = enumerate(messages_inits)
+
+    def submit(n: int) -> set:
+        return {
+            asyncio.ensure_future(
+                arun_session(
+                    action_graph, i, messages_init, completion_factory, arun_agent_kwargs
+                )
+            )
+            for i, messages_init in islice(inputs, n)
+        }
+
+    pending = submit(max_concurrency)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            pending |= submit(len(done))
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def close_connection_pools():
+    """Close the async HTTP sessions of the completion functions (`gpt.ConnectionPool`s)
+    in the running event loop, if any were used."""
+    gpt = sys.modules.get("make_agents.gpt")  # not imported if it wasn't used
+    if gpt is not None:
+        await gpt.aclose_pools()
+
+
+def run_session(
+    action_graph: Union[dict, callable],
+    index: int,
+    messages_init: Optional[list[dict]],
+    completion_factory: Optional[callable],
+    run_agent_kwargs: dict,
+) -> SessionResult:
+    """Run one agent to completion, catching any error."""
+    if completion_factory:
+        run_agent_kwargs = {**run_agent_kwargs, "completion": completion_factory()}
+    messages = messages_init or []
+    try:
+        for messages in run_agent(action_graph, messages_init, **run_agent_kwargs):
+            pass
+    except Exception as e:
+        return SessionResult(index, list(messages), repr(e))
+    return SessionResult(index, list(messages))
+
+
+async def arun_session(
+    action_graph: Union[dict, callable],
+    index: int,
+    messages_init: Optional[list[dict]],
+    completion_factory: Optional[callable],
+    arun_agent_kwargs: dict,
+) -> SessionResult:
+    """Run one agent to completion with asyncio, catching any error."""
+    if completion_factory:
+        arun_agent_kwargs = {**arun_agent_kwargs, "completion": completion_factory()}
+    messages = messages_init or []
+    try:
+        async for messages in arun_agent(
+            action_graph, messages_init, **arun_agent_kwargs
+        ):
+            pass
+    except Exception as e:
+        return SessionResult(index, list(messages), repr(e))
+    return SessionResult(index, list(messages))
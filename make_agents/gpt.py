@@ -11,7 +11,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import atexit
+import threading
+import time
+import weakref
+from typing import Optional
+
 import openai
+import requests
+from openai.api_requestor import MAX_CONNECTION_RETRIES
 from tenacity import (
     retry,
     retry_if_exception_type,
@@ -19,8 +28,165 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from make_agents import tracing
+from make_agents.rate_limit import RateLimiter
+
+
+class ConnectionPool:
+    """The pooled, keep-alive HTTP sessions that completion functions send their requests
+    with: a `requests.Session` for sync completion functions, and an `aiohttp.ClientSession`
+    (per event loop) for async ones. Pass the same pool to many completion functions,
+    so that they share warm connections (no repeated TCP / TLS handshakes).
+    By default, completion functions share `default_pool()`.
+
+    Close the sessions when done, with `close()` (the sync session, and the async
+    sessions of event loops that aren't running), and, in each event loop that used
+    the pool, `await aclose()` (or see `aclose_pools`). Or use the pool as a (sync
+    or async) context manager.
+
+    Parameters
+    ----------
+    max_connections : int, optional
+        The maximum number of connections per host, by default 100.
+    keepalive_seconds : float, optional
+        How long idle connections are kept open, by the async session, by default 60.
+    """
+
+    def __init__(self, max_connections: int = 100, keepalive_seconds: float = 60.0):
+        self.max_connections = max_connections
+        self.keepalive_seconds = keepalive_seconds
+        self._session = None
+        self._asessions = {}  # event loop -> aiohttp.ClientSession
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                self._session = make_session(self.max_connections)
+            return self._session
+
+    def asession(self):
+        """The aiohttp session for the running event loop."""
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for other in [x for x in self._asessions if x.is_closed()]:
+                del self._asessions[other]
+            if loop not in self._asessions:
+                connector = aiohttp.TCPConnector(
+                    limit=0,
+                    limit_per_host=self.max_connections,
+                    keepalive_timeout=self.keepalive_seconds,
+                )
+                self._asessions[loop] = aiohttp.ClientSession(connector=connector)
+            return self._asessions[loop]
+
+    def use_in_this_thread(self):
+        """Have openai send this thread's sync requests with the pool's session.
+
+        openai (0.28) has no parameter for the session of a request: it sends sync
+        requests with a session per thread, so the pool's session is installed as this
+        thread's session. If `openai.requestssession` is set, openai's own handling
+        of it is left alone (and the pool isn't used for sync requests)."""
+        thread_context = getattr(openai.api_requestor, "_thread_context", None)
+        if openai.requestssession or thread_context is None:
+            return
+        thread_context.session = self.session
+        thread_context.session_create_time = time.time()
+
+    def close(self):
+        """Close the sync session, and the async sessions of the event loops that
+        aren't running (the session of a running loop is closed by `aclose`)."""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+            asessions = {
+                loop: self._asessions.pop(loop)
+                for loop in list(self._asessions)
+                if not loop.is_running()
+            }
+        for loop, asession in asessions.items():
+            if not loop.is_closed():
+                loop.run_until_complete(asession.close())
+
+    async def aclose(self):
+        """Close the async session of the running event loop."""
+        with self._lock:
+            asession = self._asessions.pop(asyncio.get_running_loop(), None)
+        if asession is not None:
+            await asession.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+        self.close()
+
+
+def make_session(max_connections: int) -> requests.Session:
+    """A `requests.Session` with a pool of up to `max_connections` connections per host,
+    otherwise set up as openai sets up its own sessions: with the proxies of
+    `openai.proxy`, and retrying failed connections."""
+    session = requests.Session()
+    if isinstance(openai.proxy, str):
+        session.proxies = {"http": openai.proxy, "https": openai.proxy}
+    elif isinstance(openai.proxy, dict):
+        session.proxies = openai.proxy.copy()
+    elif openai.proxy is not None:
+        raise ValueError("openai.proxy must be a URL, or a dict of URLs (by scheme).")
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=max_connections,
+        pool_maxsize=max_connections,
+        max_retries=MAX_CONNECTION_RETRIES,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_pools = weakref.WeakSet()  # every ConnectionPool, for `aclose_pools`
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool() -> ConnectionPool:
+    """The pool that completion functions share, unless they're given one.
+    Its sync session is closed at exit."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+            atexit.register(_default_pool.close)
+        return _default_pool
 
-def get_completion_func(model: str = "gpt-4", **kwargs) -> callable:
+
+async def aclose_pools():
+    """Close the async sessions of every `ConnectionPool` (including the default pool)
+    in the running event loop, e.g. before the loop is closed."""
+    for pool in list(_pools):
+        await pool.aclose()
+
+
+def get_completion_func(
+    model: str = "gpt-4",
+    rate_limiter: Optional[RateLimiter] = None,
+    api_base: Optional[str] = None,
+    pool: Optional[ConnectionPool] = None,
+    connect_timeout: float = 10.0,
+    read_timeout: float = 600.0,
+    **kwargs,
+) -> callable:
     """Returns a function for getting completions from OpenAI.
     Can specify more parameters, e.g. temperature, etc. via kwargs, see:
     https://platform.openai.com/docs/api-reference/introduction?lang=python
@@ -29,21 +195,123 @@ def get_completion_func(model: str = "gpt-4", **kwargs) -> callable:
     ----------
     model : str, optional
         The chat model to use, by default "gpt-4".
+    rate_limiter : Optional[RateLimiter], optional
+        Pass the same `RateLimiter` to every completion function (sync or async)
+        that shares a quota, so that they wait their turn, rather than being rate limited.
+    api_base : Optional[str], optional
+        The base URL of the API, e.g. of a proxy, or an OpenAI compatible server,
+        by default OpenAI's (`openai.api_base`).
+    pool : Optional[ConnectionPool], optional
+        The connections to send the requests with, by default `default_pool()`.
+    connect_timeout : float, optional
+        The time limit, in seconds, for connecting to the API, by default 10.
+    read_timeout : float, optional
+        The time limit, in seconds, for the API to respond, by default 600.
+        (For async completion functions, it's the time limit for the whole request.)
 
     Returns
     -------
     callable
         A function that is used to get completions from OpenAI, to drive agents.
+        Its connection pool is its `pool` attribute.
+    """
+    pool = pool or default_pool()
+    if api_base is not None:
+        kwargs["api_base"] = api_base
+    request_options = dict(request_timeout=(connect_timeout, read_timeout))
+
+    @retry_on_rate_limit()
+    def completion(**kwargs2):
+        request = {"model": model, **request_options, **kwargs, **kwargs2}
+        pool.use_in_this_thread()
+        if rate_limiter is None:
+            return openai.ChatCompletion.create(**request)
+        tokens = rate_limiter.acquire(request)
+        response = openai.ChatCompletion.create(**request)
+        rate_limiter.record_usage(tokens, response)
+        return response
+
+    completion.request_defaults = dict(model=model, **kwargs)
+    completion.pool = pool
+    return completion
+
+
+def get_acompletion_func(
+    model: str = "gpt-4",
+    rate_limiter: Optional[RateLimiter] = None,
+    api_base: Optional[str] = None,
+    pool: Optional[ConnectionPool] = None,
+    connect_timeout: float = 10.0,
+    read_timeout: float = 600.0,
+    **kwargs,
+) -> callable:
+    """Returns an async function for getting completions from OpenAI, for use with `arun_agent`.
+    The same as `get_completion_func`, except that the returned function must be awaited.
+
+    Parameters
+    ----------
+    model : str, optional
+        The chat model to use, by default "gpt-4".
+    rate_limiter : Optional[RateLimiter], optional
+        Pass the same `RateLimiter` to every completion function (sync or async)
+        that shares a quota, so that they wait their turn, rather than being rate limited.
+    api_base : Optional[str], optional
+        The base URL of the API, see `get_completion_func`.
+    pool : Optional[ConnectionPool], optional
+        The connections to send the requests with, by default `default_pool()`.
+        Close its session with `await acompletion.pool.aclose()` (or `aclose_pools()`)
+        before the event loop is closed.
+    connect_timeout : float, optional
+        The time limit, in seconds, for connecting to the API, by default 10.
+    read_timeout : float, optional
+        The time limit, in seconds, for the whole request, by default 600.
+
+    Returns
+    -------
+    callable
+        An async function that is used to get completions from OpenAI, to drive agents.
     """
+    pool = pool or default_pool()
+    if api_base is not None:
+        kwargs["api_base"] = api_base
+    request_options = dict(request_timeout=(connect_timeout, read_timeout))
+
+    @retry_on_rate_limit()
+    async def acompletion(**kwargs2):
+        request = {"model": model, **request_options, **kwargs, **kwargs2}
+        token = openai.aiosession.set(pool.asession())
+        try:
+            if rate_limiter is None:
+                return await openai.ChatCompletion.acreate(**request)
+            tokens = await rate_limiter.aacquire(request)
+            response = await openai.ChatCompletion.acreate(**request)
+            rate_limiter.record_usage(tokens, response)
+            return response
+        finally:
+            openai.aiosession.reset(token)
 
-    @retry(
+    acompletion.request_defaults = dict(model=model, **kwargs)
+    acompletion.pool = pool
+    return acompletion
+
+
+def retry_on_rate_limit() -> callable:
+    """Decorator to retry (sync or async) OpenAI calls, on timeouts and rate limits."""
+    return retry(
         retry=retry_if_exception_type(
             (openai.error.Timeout, openai.error.RateLimitError)
         ),
         wait=wait_random_exponential(min=0, max=60),
         stop=stop_after_attempt(6),
+        before_sleep=trace_retry,
     )
-    def completion(**kwargs2):
-        return openai.ChatCompletion.create(model=model, **kwargs, **kwargs2)
 
-    return completion
+
+def trace_retry(retry_state):
+    """Records a retry as a tracing event (in the completion's span), see `tracing`."""
+    tracing.event(
+        "retry",
+        attempt=retry_state.attempt_number,
+        wait=retry_state.next_action.sleep,
+        error=repr(retry_state.outcome.exception()),
+    )
@@ -0,0 +1,129 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Message history with cheap, read-only snapshots.
+
+Appending to a `MessageHistory` never invalidates snapshots taken earlier,
+since a snapshot only ever looks at a prefix of the list. Any other modification
+(e.g. truncation inside a `pre_llm_callback`) first hands a copy of the current
+messages to the outstanding snapshots (copy-on-write), so taking a snapshot is O(1).
+"""
+from collections.abc import Sequence
+from typing import Iterable
+
+
+class _Storage:
+    """The list that outstanding snapshots read from."""
+
+    __slots__ = ("items",)
+
+    def __init__(self, items: list):
+        self.items = items
+
+
+def _detaching(method: callable) -> callable:
+    def wrapper(self, *args, **kwargs):
+        self._detach()
+        self.modifications += 1
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class MessagesView(Sequence):
+    """A read-only snapshot of a `MessageHistory`.
+
+    Note that the messages themselves are shared with the history (not copied),
+    so treat them as read-only. Use `to_list` to get an independent copy.
+    """
+
+    __slots__ = ("_storage", "_len")
+
+    def __init__(self, storage: _Storage, length: int):
+        self._storage = storage
+        self._len = length
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._storage.items[i] for i in range(self._len)[index]]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("MessagesView index out of range")
+        return self._storage.items[index]
+
+    def __iter__(self):
+        items = self._storage.items
+        for i in range(self._len):
+            yield items[i]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (MessagesView, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list(self)!r})"
+
+    def to_list(self) -> list[dict]:
+        """Return a deep copy of the messages, as a plain list."""
+        from copy import deepcopy
+
+        return deepcopy(list(self))
+
+
+class MessageHistory(list):
+    """A list of messages that can produce O(1) read-only snapshots, see `snapshot`.
+
+    It is a `list`, so it can be passed to callbacks that modify it in place,
+    and serialised as-is when sent to the LLM.
+    `modifications` counts the in-place modifications, other than appending.
+    """
+
+    __slots__ = ("_storage", "modifications")
+
+    def __init__(self, messages: Iterable[dict] = ()):
+        super().__init__(messages)
+        self._storage = None
+        self.modifications = 0
+
+    def snapshot(self) -> MessagesView:
+        """Return a read-only view of the messages as they are now."""
+        if self._storage is None:
+            self._storage = _Storage(self)
+        return MessagesView(self._storage, len(self))
+
+    def _detach(self):
+        # Give the outstanding snapshots their own copy, before modifying in place.
+        if self._storage is not None:
+            self._storage.items = list(self)
+            self._storage = None
+
+    def __reduce_ex__(self, protocol):
+        return type(self), (list(self),)
+
+    # Appending (append, extend, +=) is safe for snapshots, everything else isn't.
+    __setitem__ = _detaching(list.__setitem__)
+    __delitem__ = _detaching(list.__delitem__)
+    __imul__ = _detaching(list.__imul__)
+    insert = _detaching(list.insert)
+    pop = _detaching(list.pop)
+    remove = _detaching(list.remove)
+    clear = _detaching(list.clear)
+    sort = _detaching(list.sort)
+    reverse = _detaching(list.reverse)
@@ -11,22 +11,69 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import collections
+import contextvars
+import functools
 import inspect
 import json
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from copy import deepcopy
 from enum import Enum
-from typing import Iterator, Optional, Union
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Generator,
+    Iterator,
+    Literal,
+    NamedTuple,
+    Optional,
+    Union,
+)
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, create_model
 
-from make_agents.gpt import get_completion_func
+from make_agents import tracing
+from make_agents.cache import MemoryCache, memoised_action
+from make_agents.decisions import DecisionRouter
+from make_agents.history import MessageHistory, MessagesView
+from make_agents.repair import INVALID_ARGUMENTS, ArgumentRepairer
+from make_agents.speculation import Speculator
+from make_agents.streaming import astream_completion, stream_completion
 
-default_completion = get_completion_func()
+if TYPE_CHECKING:
+    from make_agents.checkpoint import SessionLog, SessionState
+
+
+def default_completion(**kwargs):
+    """The default completion function, `gpt.get_completion_func()`,
+    created on first use (so that openai is only imported if it's needed)."""
+    return _default_completion_funcs()[0](**kwargs)
+
+
+async def default_acompletion(**kwargs):
+    """The default async completion function, `gpt.get_acompletion_func()`,
+    created on first use."""
+    return await _default_completion_funcs()[1](**kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _default_completion_funcs() -> tuple[callable, callable]:
+    from make_agents.gpt import get_acompletion_func, get_completion_func
+
+    return get_completion_func(), get_acompletion_func()
+
+
+default_completion.request_defaults = default_acompletion.request_defaults = {
+    "model": "gpt-4"
+}
 
 default_system_prompt = """You are a helpful assistant. You will be given tasks, via function calls. You will be given the ability to run different functions at different times. Please use them to complete the most recent task you have been given."""
 
 
-def action(func: callable) -> callable:
+def action(func: Optional[callable] = None, *, cache=None) -> callable:
     """A decorator to create *action functions* — functions to be used by the agent.
     An action function must have *at most* one parameter, which must be annotated with a Pydantic model.
 
@@ -42,6 +89,13 @@ def action(func: callable) -> callable:
     ----------
     func : callable
         The function to be decorated.
+    cache : Optional[Union[bool, MemoryCache, SQLiteCache]], optional
+        Memoise the function, e.g. for lookups and read-only queries, so that it's
+        not run again for the same input, when the agent revisits it:
+        `@action(cache=True)` caches the results in memory, or pass a cache from
+        `make_agents.cache`, e.g. `@action(cache=SQLiteCache(path, ttl=3600))`
+        to cache them on disk, for an hour. The hits and misses are counted in
+        `func.cache.stats`. By default None (not memoised).
 
     Returns
     -------
@@ -53,6 +107,10 @@ def action(func: callable) -> callable:
     ValueError
         If the function has more than one parameter, or if the parameter is not annotated with a Pydantic model.
     """
+    if func is None:
+        return functools.partial(action, cache=cache)
+    if cache is not None and cache is not False:
+        func = memoised_action(func, MemoryCache() if cache is True else cache)
     parameters = inspect.signature(func).parameters
     if len(parameters) == 0:
         func.description_for_llm = {
@@ -71,6 +129,7 @@ def action(func: callable) -> callable:
     return func
 
 
+@functools.lru_cache(maxsize=4096)
 def get_pydantic_model_from_action_func(func: callable) -> BaseModel:
     (arg,) = inspect.signature(func).parameters.values()
     try:
@@ -82,29 +141,87 @@ def get_pydantic_model_from_action_func(func: callable) -> BaseModel:
     return arg.annotation
 
 
-def select_next_action_factory(options: list[callable]) -> callable:
-    names = [description(x)["name"] for x in options]
-    if len(names) != len(set(names)):
-        raise ValueError(f"Duplicate function names: {names}")
+def select_next_action_factory(
+    options: list[callable], compact: bool = False
+) -> callable:
+    """Returns an action function for the LLM to select one of `options`.
+    (A `CompiledActionGraph` makes them up front, for each of its nodes.)
+
+    If `compact`, its docstring lists the options by name, with the first line of
+    their docstrings (rather than their full descriptions, with their parameters),
+    sorted by name, so the same options always give the same prompt."""
+    with tracing.span("selector", options=len(options)):
+        names = [description(x)["name"] for x in options]
+        if len(names) != len(set(names)):
+            raise ValueError(f"Duplicate function names: {names}")
+        if compact:
+            options = sorted(options, key=lambda x: description(x)["name"])
+
+        class SelectNextFuncArg(BaseModel):
+            thought_process: str = Field(
+                ...,
+                description="Describe your thought process for selecting the next function in a few words.",
+            )
+            next_function: Enum(
+                "function_names",
+                {description(x)["name"]: description(x)["name"] for x in options},
+            ) = Field(..., description="Name of the function to call next")
+
+        def select_next_func(arg: SelectNextFuncArg):
+            return arg.next_function.value
+
+        instruction = (
+            "Given the following functions, choose the one that will most help you achieve"
+            " your goal:"
+        )
+        if compact:
+            select_next_func.__doc__ = "\n".join(
+                [instruction]
+                + [f"- {description(x)['name']}: {summary(x)}" for x in options]
+            )
+        else:
+            select_next_func.__doc__ = f"{instruction} " + ", ".join(
+                [json.dumps(description(x)) for x in options]
+            )
+        return action(select_next_func)
 
-    class SelectNextFuncArg(BaseModel):
-        thought_process: str = Field(
+
+def parallel_actions_factory(options: list[callable]) -> callable:
+    """Returns an action function for the LLM to call several of `options` at once
+    (a batch of calls, with their arguments). Calling it returns the calls, as a list
+    of `(action function, validated input)`. It's cached, so batches of the same options
+    reuse the same function.
+    """
+    with tracing.span("selector", options=len(options), parallel=True):
+        return _parallel_actions_factory(tuple(options))
+
+
+@functools.lru_cache(maxsize=1024)
+def _parallel_actions_factory(options: tuple[callable]) -> callable:
+    actions = {description(x)["name"]: x for x in options if x != End}
+    call_models = []
+    for name, x in actions.items():
+        fields = {"name": (Literal[name], ...)}
+        if description(x)["parameters"]:
+            fields["arguments"] = (get_pydantic_model_from_action_func(x), ...)
+        call_models.append(create_model(f"{name}_call", **fields))
+
+    class RunInParallelArg(BaseModel):
+        calls: list[Union[tuple(call_models)]] = Field(
             ...,
-            description="Describe your thought process for selecting the next function in a few words.",
+            min_length=1,
+            description="The functions to call, and their arguments, in order.",
         )
-        next_function: Enum(
-            "function_names",
-            {description(x)["name"]: description(x)["name"] for x in options},
-        ) = Field(..., description="Name of the function to call next")
 
-    def select_next_func(arg: SelectNextFuncArg):
-        return arg.next_function.value
+    def run_in_parallel(arg: RunInParallelArg):
+        return [(actions[x.name], getattr(x, "arguments", None)) for x in arg.calls]
 
-    select_next_func.__doc__ = (
-        "Given the following functions, choose the one that will most help you achieve"
-        " your goal: " + ", ".join([json.dumps(description(x)) for x in options])
+    run_in_parallel.__doc__ = (
+        "Call several functions at the same time. Use this when you need to call"
+        " functions that don't depend on each other's results, e.g. several lookups."
     )
-    return action(select_next_func)
+    run_in_parallel.parallel_options = options
+    return action(run_in_parallel)
 
 
 def description(action_func: callable) -> dict:
@@ -117,34 +234,122 @@ def description(action_func: callable) -> dict:
         )
 
 
+def summary(action_func: callable) -> str:
+    """The first line of the action function's description."""
+    text = (description(action_func)["description"] or "").strip()
+    return text.splitlines()[0].strip() if text else ""
+
+
+@functools.lru_cache(maxsize=4096)
+def compact_description(action_func: callable) -> dict:
+    """The description of the action function, with its parameters' schema compacted,
+    see `compact_schema`."""
+    desc = description(action_func)
+    parameters = desc["parameters"] and compact_schema(desc["parameters"])
+    return {**desc, "parameters": parameters}
+
+
+def compact_schema(schema: dict) -> dict:
+    """A JSON schema (as made by Pydantic) with fewer tokens, that validates the same:
+    without titles (they repeat the names), with the definitions (`$defs`) that are
+    used once inlined, and the definitions that are used more than once kept once,
+    in name order."""
+    defs = schema.get("$defs", {})
+    refs = collections.Counter(_refs(schema))
+
+    def compact(x):
+        if isinstance(x, list):
+            return [compact(v) for v in x]
+        if not isinstance(x, dict):
+            return x
+        if refs.get(x.get("$ref"), 0) == 1:
+            definition = defs[x["$ref"].split("/")[-1]]
+            return compact({**definition, **{k: v for k, v in x.items() if k != "$ref"}})
+        result = {}
+        for key, value in x.items():
+            if key in ("title", "$defs"):
+                continue
+            if key == "properties":
+                result[key] = {name: compact(v) for name, v in value.items()}
+            elif key in ("default", "const", "enum", "examples"):
+                result[key] = value  # values, not schemas
+            else:
+                result[key] = compact(value)
+        return result
+
+    result = compact(schema)
+    shared = {
+        name: compact(defs[name]) for name in sorted(defs) if refs[f"#/$defs/{name}"] > 1
+    }
+    if shared:
+        result["$defs"] = shared
+    return result
+
+
+def _refs(x) -> Iterator[str]:
+    if isinstance(x, list):
+        for v in x:
+            yield from _refs(v)
+    elif isinstance(x, dict):
+        for key, value in x.items():
+            if key == "$ref":
+                yield value
+            elif key not in ("default", "const", "enum", "examples"):
+                yield from _refs(value)
+
+
 def get_func_input_from_llm(messages: list[dict], func: callable, completion: callable):
-    response = completion(
+    response = completion(**func_input_request(messages, func))
+    return parse_func_input(response, func)
+
+
+def func_input_request(
+    messages: list[dict], func: callable, compact: bool = False
+) -> dict:
+    """The kwargs for the completion function, to get the input of `func` from the LLM.
+    If `compact`, the schema of its input is compacted, see `compact_schema`."""
+    # function_call forces the function to be called
+    return dict(
         messages=messages,
-        functions=[description(func)],
-        function_call={
-            "name": description(func)["name"]
-        },  # force the function to be called
+        functions=[compact_description(func) if compact else description(func)],
+        function_call={"name": description(func)["name"]},
     )
+
+
+def parse_func_input(response: dict, func: callable):
+    message = response["choices"][0]["message"]
     # Validate the arg
     pydantic_model = get_pydantic_model_from_action_func(func)
-    func_arg = pydantic_model(
-        **json.loads(response.choices[0].message.function_call.arguments)
-    )
+    with tracing.span("validation", function=description(func)["name"]):
+        func_arg = pydantic_model.model_validate(
+            json.loads(message["function_call"]["arguments"])
+        )
     # If the above didn't raise an error, we can assume the arg is valid
-    func_arg_message = json.loads(
-        json.dumps(response.choices[0].message)
-    )  # make a clean dict
+    func_arg_message = json.loads(json.dumps(message))  # make a clean dict
     return func_arg_message, func_arg
 
 
+def run_func(func: callable, arg: Optional[BaseModel]):
+    """Run an action function."""
+    if inspect.iscoroutinefunction(func):
+        raise TypeError(
+            f"The action {description(func)['name']!r} is async, run it with arun_agent."
+        )
+    with tracing.span("action", action=description(func)["name"]):
+        return func(arg) if arg else func()
+
+
 def run_func_for_llm(func: callable, arg: Optional[BaseModel]):
     func_result = func(arg) if arg else func()
-    func_result_message = {
+    return func_result_message(func, func_result), func_result
+
+
+def func_result_message(func: callable, func_result) -> dict:
+    return {
         "role": "function",
-        "name": func.description_for_llm["name"],
+        "name": description(func)["name"],
         "content": json.dumps(func_result),
     }
-    return func_result_message, func_result
 
 
 class Start:
@@ -170,10 +375,21 @@ def run_agent(
     messages_init: Optional[list[dict]] = None,
     completion: Optional[callable] = default_completion,
     pre_llm_callback: Optional[callable] = identity,
-) -> Iterator[list[dict[str, str]]]:
-    """Run an agent. This is a generator that yields the list of messages after each step.
-    Be mindful that the yielded messages are mutable, allowing them to be modified in place,
-    (make copies if you want to avoid this).
+    copy_messages: bool = False,
+    select_and_act: bool = False,
+    on_partial: Optional[callable] = None,
+    speculator: Optional[Speculator] = None,
+    parallel_actions: bool = False,
+    action_timeout: Optional[float] = None,
+    session_log: Optional["SessionLog"] = None,
+    resume: Optional["SessionState"] = None,
+    decisions: Optional[DecisionRouter] = None,
+    compact_prompts: bool = False,
+    repairer: Optional[ArgumentRepairer] = None,
+) -> Iterator[Union[MessagesView, list[dict[str, str]]]]:
+    """Run an agent. This is a generator that yields the messages after each step.
+    By default the yielded messages are a read-only snapshot (`MessagesView`),
+    which is O(1) to create, however long the conversation gets.
 
     Parameters
     ----------
@@ -190,79 +406,661 @@ def run_agent(
         It will be passed the list of messages, and can modify it in place.
         Can be used for, e.g. reducing the list of messages to only the most recent ones,
         or reducing the list by summarising, etc.
+    copy_messages : bool, optional
+        If True, yield a deep copy of the list of messages at each step
+        (the behaviour of earlier versions). This is O(n) per step, by default False.
+    select_and_act : bool, optional
+        If True, when there is more than one possible next action, offer them all
+        to the LLM as functions, so it selects the action and generates its input
+        in a single completion, rather than two (selecting via `select_next_func`,
+        then generating the input). The selection messages are then not in the transcript.
+        Falls back to `select_next_func` if the LLM doesn't call one of the functions.
+        By default False.
+    on_partial : Optional[callable], optional
+        If given, completions are streamed (`stream=True`), and as each chunk arrives,
+        `on_partial(message, partial_arguments)` is called with the message so far,
+        and the function call arguments so far, parsed as far as possible
+        (see `partial_json.parse_partial_json`), e.g. to display the message
+        to the user as it's generated. The arguments are validated once complete.
+        By default None.
+    speculator : Optional[Speculator], optional
+        If given, when the LLM is selecting the next action, and the speculator
+        predicts which action it will select, the input of that action is requested
+        from the LLM at the same time (in a background thread), to save a round-trip
+        if the prediction is right. See `speculation.Speculator`. By default None.
+    parallel_actions : bool, optional
+        If True, when there is more than one possible next action, the LLM can also
+        call several of them at once (as a batch, via a `run_in_parallel` function),
+        e.g. to do several lookups in one step. The calls are run concurrently
+        (in a thread pool), and their results are appended as one message, in the order
+        of the calls. The last call is then the current action. Implies `select_and_act`.
+        By default False.
+    action_timeout : Optional[float], optional
+        The time limit, in seconds, for each call of a batch. The LLM is told about
+        the calls that time out (they can't be interrupted, so are left running
+        in the background). By default None (no limit).
+    session_log : Optional[SessionLog], optional
+        If given, every message is written to this log as it's added, so the session
+        can be resumed after a crash, see `checkpoint.resume_agent`. By default None.
+    resume : Optional[SessionState], optional
+        The state to resume from (instead of starting from `messages_init`),
+        see `checkpoint.load_session`. By default None.
+    decisions : Optional[DecisionRouter], optional
+        If given, when there is more than one possible next action, it's selected
+        by the router's rules, or from its cache of past selections, if it can be,
+        rather than by the LLM (saving a completion), see `decisions.DecisionRouter`.
+        The LLM's selections are recorded in its cache. By default None.
+    compact_prompts : bool, optional
+        If True, the functions are described to the LLM in fewer tokens: `select_next_func`
+        lists the options by name, with a one-line summary each (rather than with
+        their full descriptions and schemas), and the schemas are compacted
+        (see `compact_schema`). By default False.
+    repairer : Optional[ArgumentRepairer], optional
+        If given, when the LLM's function call arguments are invalid (malformed JSON,
+        or failing validation), they're repaired locally if possible, else the LLM is
+        sent the error, for that call only, and asked to call the function again,
+        a bounded number of times, see `repair.ArgumentRepairer`. Else (by default)
+        the error is raised.
 
     Yields
     ------
-    Iterator[list[dict[str, str]]]
-        At each step, the list of messages is yielded,
-        i.e. the same list that was yielded in the previous step, with one more message appended.
+    Iterator[Union[MessagesView, list[dict[str, str]]]]
+        At each step, the messages are yielded,
+        i.e. the messages that were yielded in the previous step, with one more message appended.
     """
-    if isinstance(action_graph, dict):
-        action_graph = dict_to_action_graph_func(action_graph)
-    messages = (
-        deepcopy(messages_init)
-        if messages_init
-        else [{"role": "system", "content": default_system_prompt}]
+    steps = agent_steps(
+        action_graph,
+        messages_init,
+        pre_llm_callback,
+        copy_messages,
+        select_and_act,
+        speculator,
+        parallel_actions,
+        action_timeout,
+        session_log,
+        resume,
+        decisions,
+        compact_prompts,
+        repairer,
     )
-    current_action = Start
-    current_action_result = None
+    # With spare workers, since a mispredicted prefetch can't be interrupted once
+    # it's started, and mustn't hold up the next one
+    executor = ThreadPoolExecutor() if speculator else None
+    action_executor = None
+    try:
+        result = None
+        while True:
+            try:
+                request = steps.send(result)
+            except StopIteration:
+                return
+            result = None
+            if isinstance(request, CompletionRequest):
+                if request.prefetched is not None:
+                    result = request.prefetched.result()
+                    continue
+                if request.speculative is not None:
+                    prefetch = executor.submit(
+                        contextvars.copy_context().run, completion, **request.speculative
+                    )
+                with completion_span(request) as span:
+                    if on_partial:
+                        result = stream_completion(completion, request.kwargs, on_partial)
+                    else:
+                        result = completion(**request.kwargs)
+                    span.set(**tracing.usage_attributes(result))
+                if request.speculative is not None:
+                    result = (result, prefetch)
+            elif isinstance(request, ActionRequest):
+                result = run_func(request.func, request.arg)
+            elif isinstance(request, ParallelActionRequest):
+                if action_executor is None:
+                    action_executor = ThreadPoolExecutor()
+                result = run_funcs(request.calls, request.timeout, action_executor)
+            else:
+                yield request
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if action_executor:
+            action_executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def arun_agent(
+    action_graph: Union[dict, callable],
+    messages_init: Optional[list[dict]] = None,
+    completion: Optional[callable] = default_acompletion,
+    executor: Optional[Executor] = None,
+    on_partial: Optional[callable] = None,
+    **kwargs,
+) -> AsyncIterator[Union[MessagesView, list[dict[str, str]]]]:
+    """Run an agent, with asyncio. The same as `run_agent`, except that this is an
+    async generator, so many agents can run concurrently in one thread.
+
+    Action functions can be async (`async def`). Regular action functions are run
+    in `executor` (the default thread pool of the event loop if None),
+    so that they don't block the event loop.
+
+    Parameters
+    ----------
+    action_graph : Union[dict[callable, list[callable]], callable]
+        The graph of actions that the agent can take, see `run_agent`.
+    messages_init : Optional[list[dict]], optional
+        Optionally initialise the list of messages, see `run_agent`.
+    completion : Optional[callable], optional
+        The async function that will be used to get completions from the LLM,
+        e.g. from `gpt.get_acompletion_func`.
+    executor : Optional[Executor], optional
+        The executor to run regular (non-async) action functions in.
+    on_partial : Optional[callable], optional
+        Stream the completions, and call this function with the partial messages,
+        see `run_agent`.
+    **kwargs
+        The other options of `run_agent`, e.g. `pre_llm_callback`.
+
+    Yields
+    ------
+    AsyncIterator[Union[MessagesView, list[dict[str, str]]]]
+        At each step, the messages are yielded, see `run_agent`.
+    """
+    steps = agent_steps(action_graph, messages_init, **kwargs)
+    result = None
     while True:
-        next_action_options = action_graph(
-            current_action=current_action, current_action_result=current_action_result
-        )
-        if not next_action_options:
-            break
-        # DECIDE NEXT ACTION
-        if len(next_action_options) == 1:
-            current_action = next_action_options[0]
+        try:
+            request = steps.send(result)
+        except StopIteration:
+            return
+        result = None
+        if isinstance(request, CompletionRequest):
+            if request.prefetched is not None:
+                result = await request.prefetched
+                continue
+            if request.speculative is not None:
+                prefetch = asyncio.ensure_future(completion(**request.speculative))
+            with completion_span(request) as span:
+                if on_partial:
+                    result = await astream_completion(
+                        completion, request.kwargs, on_partial
+                    )
+                else:
+                    result = await completion(**request.kwargs)
+                span.set(**tracing.usage_attributes(result))
+            if request.speculative is not None:
+                result = (result, prefetch)
+        elif isinstance(request, ActionRequest):
+            result = await arun_func(request.func, request.arg, executor)
+        elif isinstance(request, ParallelActionRequest):
+            result = await arun_funcs(request.calls, request.timeout, executor)
         else:
+            yield request
+
+
+async def arun_func(
+    func: callable, arg: Optional[BaseModel], executor: Optional[Executor]
+):
+    """Run an action function, without blocking the event loop."""
+    args = (arg,) if arg else ()
+    with tracing.span("action", action=description(func)["name"]):
+        if inspect.iscoroutinefunction(func):
+            return await func(*args)
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def completion_span(request: "CompletionRequest"):
+    """Traces a completion, if tracing is on."""
+    if tracing.get_tracer() is None:
+        return tracing.span("completion")
+    function_call = request.kwargs["function_call"]
+    return tracing.span(
+        "completion",
+        function_call=function_call["name"]
+        if isinstance(function_call, dict)
+        else function_call,
+        messages=len(request.kwargs["messages"]),
+        speculative=request.speculative is not None,
+    )
+
+
+def run_funcs(
+    calls: list[tuple[callable, Optional[BaseModel]]],
+    timeout: Optional[float],
+    executor: Executor,
+) -> list[dict]:
+    """Run action functions concurrently in `executor`, see `parallel_results`.
+    Each call has `timeout` seconds from when it starts (it may wait for a worker)."""
+
+    def run(started: Future, func: callable, arg: Optional[BaseModel]):
+        started.set_result(time.monotonic())
+        return run_func(func, arg)
+
+    starts = [Future() for _ in calls]
+    futures = [
+        executor.submit(contextvars.copy_context().run, run, started, func, arg)
+        for started, (func, arg) in zip(starts, calls)
+    ]
+    results = []
+    for started, future in zip(starts, futures):
+        try:
+            if timeout is None:
+                results.append(future.result())
+            else:
+                deadline = started.result() + timeout
+                results.append(future.result(max(deadline - time.monotonic(), 0)))
+        except FutureTimeoutError:
+            future.cancel()
+            results.append(TimeoutError())
+    return parallel_results(calls, results, timeout)
+
+
+async def arun_funcs(
+    calls: list[tuple[callable, Optional[BaseModel]]],
+    timeout: Optional[float],
+    executor: Optional[Executor],
+) -> list[dict]:
+    """Run action functions concurrently, with asyncio, see `parallel_results`."""
+
+    async def run(func, arg):
+        try:
+            return await asyncio.wait_for(arun_func(func, arg, executor), timeout)
+        except asyncio.TimeoutError:
+            return TimeoutError()
+
+    results = await asyncio.gather(*(run(func, arg) for func, arg in calls))
+    return parallel_results(calls, results, timeout)
+
+
+def parallel_results(
+    calls: list[tuple[callable, Optional[BaseModel]]], results: list, timeout: float
+) -> list[dict]:
+    """The results of a batch of calls, in the order of the calls, for the LLM.
+    A call that timed out gets an error, instead of a result (but isn't interrupted)."""
+    return [
+        {"name": description(func)["name"], "error": f"Timed out after {timeout}s."}
+        if isinstance(result, TimeoutError)
+        else {"name": description(func)["name"], "result": result}
+        for (func, _), result in zip(calls, results)
+    ]
+
+
+class CompletionRequest(NamedTuple):
+    """Yielded by `agent_steps` when it needs a completion from the LLM.
+    If `speculative` is set, a completion for those kwargs is also started, and the
+    caller sends back `(response, prefetch)`, where `prefetch` is a future of its response.
+    If `prefetched` is set, the caller sends back its result, instead of getting a completion.
+    """
+
+    kwargs: Optional[dict]
+    speculative: Optional[dict] = None
+    prefetched: Optional[Union[Future, asyncio.Future]] = None
+
+
+class ActionRequest(NamedTuple):
+    """Yielded by `agent_steps` when it needs an action function to be run."""
+
+    func: callable
+    arg: Optional[BaseModel]
+
+
+class ParallelActionRequest(NamedTuple):
+    """Yielded by `agent_steps` when it needs several action functions to be run
+    concurrently (each for at most `timeout` seconds). The caller sends back the
+    results, from `run_funcs` / `arun_funcs`."""
+
+    calls: list[tuple[callable, Optional[BaseModel]]]
+    timeout: Optional[float]
+
+
+def agent_steps(
+    action_graph: Union[dict, callable],
+    messages_init: Optional[list[dict]] = None,
+    pre_llm_callback: callable = identity,
+    copy_messages: bool = False,
+    select_and_act: bool = False,
+    speculator: Optional[Speculator] = None,
+    parallel_actions: bool = False,
+    action_timeout: Optional[float] = None,
+    session_log: Optional["SessionLog"] = None,
+    resume: Optional["SessionState"] = None,
+    decisions: Optional[DecisionRouter] = None,
+    compact_prompts: bool = False,
+    repairer: Optional[ArgumentRepairer] = None,
+) -> Generator:
+    """The agent loop shared by `run_agent` and `arun_agent`. It doesn't do any IO itself:
+    it yields `CompletionRequest`s and `ActionRequest`s, which the caller fulfils by
+    sending back the response / the result, and yields the messages after each step,
+    which the caller passes on (sending back None).
+    """
+    if isinstance(action_graph, dict):
+        action_graph = dict_to_action_graph_func(action_graph)
+    if isinstance(action_graph, CompiledActionGraph):
+        selector = action_graph.selector
+    else:
+        selector = select_next_action_factory
+    if resume:
+        messages = MessageHistory(deepcopy(resume.messages))
+    else:
+        messages = MessageHistory(
+            deepcopy(messages_init)
+            if messages_init
+            else [{"role": "system", "content": default_system_prompt}]
+        )
+        if session_log:
+            session_log.replace(messages)
+
+    def snapshot():
+        with tracing.span("snapshot", messages=len(messages), copy=copy_messages):
+            return deepcopy(list(messages)) if copy_messages else messages.snapshot()
+
+    def append(message: dict):
+        messages.append(message)
+        if session_log:
+            session_log.append(message)
+
+    def callback():
+        modifications, length = messages.modifications, len(messages)
+        with tracing.span("pre_llm_callback"):
             pre_llm_callback(messages)
-            select_next_action: callable = select_next_action_factory(next_action_options)
-            func_arg_message, func_arg = get_func_input_from_llm(
-                messages, select_next_action, completion
-            )
-            messages.append(func_arg_message)
-            yield deepcopy(messages)
-            pre_llm_callback(messages)
-            func_result_message, func_result = run_func_for_llm(
-                select_next_action, func_arg
+        if not session_log:
+            return
+        if messages.modifications != modifications:
+            session_log.replace(messages)
+        else:  # only appended to, if anything
+            for message in messages[length:]:
+                session_log.append(message)
+
+    def parse(response: dict, func: callable, request: dict):
+        """`parse_func_input`, repairing invalid arguments with `repairer` (if given),
+        by sending it repair completion requests, based on `request`."""
+        if repairer is None:
+            return parse_func_input(response, func)
+        attempts = 0
+        while True:
+            try:
+                result = parse_func_input(response, func)
+            except INVALID_ARGUMENTS as e:
+                error = e
+            else:
+                if attempts:
+                    repairer.record("llm_repairs")
+                return result
+            if attempts == 0:
+                repairer.record("invalid")
+            repaired = repairer.repair_locally(response)
+            if repaired is not None:
+                try:
+                    result = parse_func_input(repaired, func)
+                except INVALID_ARGUMENTS:
+                    pass
+                else:
+                    repairer.record("local_repairs")
+                    return result
+            if attempts == repairer.max_attempts:
+                repairer.record("failures")
+                raise error
+            attempts += 1
+            tracing.event("repair", function=description(func)["name"], attempt=attempts)
+            response = yield CompletionRequest(repairer.request(request, response, error))
+            repairer.record("llm_attempts", response)
+
+    def select(options: list[callable], selector_message: Optional[dict] = None):
+        """Have the LLM select one of `options` with `select_next_func` (unless
+        `selector_message`, its call, is given), returns the selected action."""
+        select_next_action: callable = selector(options, compact_prompts)
+        if selector_message is None:
+            callback()
+            request = func_input_request(messages, select_next_action, compact_prompts)
+            response = yield CompletionRequest(request)
+            selector_message, selector_arg = yield from parse(
+                response, select_next_action, request
             )
-            messages.append(func_result_message)
-            yield deepcopy(messages)
-            current_action = next(
-                x for x in next_action_options if description(x)["name"] == func_result
+            append(selector_message)
+            yield snapshot()
+        else:
+            selector_arg = get_pydantic_model_from_action_func(select_next_action)(
+                **json.loads(selector_message["function_call"]["arguments"])
             )
+        callback()
+        selection_message, selection = run_func_for_llm(select_next_action, selector_arg)
+        append(selection_message)
+        yield snapshot()
+        return next(x for x in options if description(x)["name"] == selection)
+
+    def select_speculatively(options: list[callable], prediction: callable):
+        """`select`, while getting the input of `prediction` at the same time.
+        Returns the selected action, and its input message and input if the prediction
+        was right, else None and None."""
+        callback()
+        select_next_action: callable = selector(options, compact_prompts)
+        request = func_input_request(messages, select_next_action, compact_prompts)
+        response, prefetch = yield CompletionRequest(
+            request,
+            speculative=func_input_request(list(messages), prediction, compact_prompts),
+        )
+        selector_message, selector_arg = yield from parse(
+            response, select_next_action, request
+        )
+        append(selector_message)
+        yield snapshot()
+        callback()
+        selection_message, selection = run_func_for_llm(select_next_action, selector_arg)
+        append(selection_message)
+        yield snapshot()
+        selected = next(x for x in options if description(x)["name"] == selection)
+        speculator.record_outcome(prediction == selected, prefetch)
+        if prediction != selected:
+            return selected, None, None
+        response = yield CompletionRequest(None, prefetched=prefetch)
+        request = func_input_request(messages, selected, compact_prompts)
+        return (selected, *(yield from parse(response, selected, request)))
+
+    current_action = Start
+    current_action_result = None
+    resumed_action, resumed_call = None, None
+    if resume:
+        current_action = resume.current_action
+        current_action_result = resume.current_action_result
+        resumed_action, resumed_call = resume.pending_action, resume.pending_call
+        if resume.pending_selection:
+            resumed_action = yield from select(*resume.pending_selection)
+    while True:
+        func_arg_message = None  # set if the LLM already gave the action's input
+        if resumed_action is not None:
+            current_action, resumed_action = resumed_action, None
+        else:
+            with tracing.span("graph", current_action=current_action.__name__):
+                next_action_options = action_graph(
+                    current_action=current_action,
+                    current_action_result=current_action_result,
+                )
+            if not next_action_options:
+                break
+            # DECIDE NEXT ACTION
+            previous_action = current_action
+            decided = None
+            if decisions and len(next_action_options) > 1:
+                decided, source = decisions.decide(
+                    previous_action, current_action_result, next_action_options
+                )
+                if decided is not None:
+                    tracing.event("decision", source=source, selected=decided.__name__)
+            if len(next_action_options) == 1:
+                current_action = next_action_options[0]
+            elif decided is not None:
+                current_action = decided
+            else:
+                if select_and_act or parallel_actions:
+                    options = list(next_action_options)
+                    if parallel_actions and any(x != End for x in options):
+                        options.append(parallel_actions_factory(next_action_options))
+                    callback()
+                    response = yield CompletionRequest(
+                        select_and_act_request(messages, options, compact_prompts)
+                    )
+                    selected = selected_option(response, options)
+                    if selected == End or (
+                        selected and not description(selected)["parameters"]
+                    ):
+                        current_action = selected
+                        func_arg_message, func_arg = no_input_message(selected), None
+                    elif selected:
+                        current_action = selected
+                        func_arg_message, func_arg = yield from parse(
+                            response,
+                            selected,
+                            func_input_request(messages, selected, compact_prompts),
+                        )
+                prediction = (
+                    speculator.predict(current_action, next_action_options)
+                    if speculator and func_arg_message is None
+                    else None
+                )
+                if func_arg_message is not None:
+                    pass
+                elif prediction is not None and description(prediction)["parameters"]:
+                    current_action, func_arg_message, func_arg = yield from (
+                        select_speculatively(next_action_options, prediction)
+                    )
+                else:
+                    current_action = yield from select(next_action_options)
+                if speculator and current_action in next_action_options:
+                    speculator.record(
+                        previous_action, next_action_options, current_action
+                    )
+                if decisions and current_action in next_action_options:
+                    decisions.record(
+                        previous_action, current_action_result, current_action
+                    )
         if current_action == End:
             break
         # RUN THE ACTION
-        if description(current_action)["parameters"]:
-            pre_llm_callback(messages)
-            func_arg_message, func_arg = get_func_input_from_llm(
-                messages, current_action, completion
-            )
+        if resumed_call is not None:  # the call is already in the messages
+            (func_arg,), resumed_call = resumed_call, None
         else:
-            func_arg_message = {
-                "role": "assistant",
-                "content": None,
-                "function_call": {
-                    "name": description(current_action)["name"],
-                    "arguments": "null",
-                },
-            }
-            func_arg = None
-        messages.append(func_arg_message)
-        yield deepcopy(messages)
-        pre_llm_callback(messages)
-        func_result_message, func_result = run_func_for_llm(current_action, func_arg)
-        messages.append(func_result_message)
-        yield deepcopy(messages)
+            if func_arg_message is None:
+                if description(current_action)["parameters"]:
+                    callback()
+                    request = func_input_request(
+                        messages, current_action, compact_prompts
+                    )
+                    response = yield CompletionRequest(request)
+                    func_arg_message, func_arg = yield from parse(
+                        response, current_action, request
+                    )
+                else:
+                    func_arg_message, func_arg = no_input_message(current_action), None
+            append(func_arg_message)
+            yield snapshot()
+        callback()
+        if hasattr(current_action, "parallel_options"):
+            results = yield ParallelActionRequest(
+                current_action(func_arg), action_timeout
+            )
+            append(func_result_message(current_action, results))
+            yield snapshot()
+            current_action, current_action_result = parallel_last_call(
+                current_action, results
+            )
+            continue
+        func_result = yield ActionRequest(current_action, func_arg)
+        append(func_result_message(current_action, func_result))
+        yield snapshot()
         current_action_result = func_result
 
 
+def parallel_last_call(parallel_action: callable, results: list[dict]) -> tuple:
+    """The action and result of the last call of a batch (None if it timed out),
+    which the agent continues from."""
+    last = results[-1]
+    (action_func,) = [
+        x
+        for x in parallel_action.parallel_options
+        if x != End and description(x)["name"] == last["name"]
+    ]
+    return action_func, last.get("result")
+
+
+def no_input_message(func: callable) -> dict:
+    """The message for calling an action function that has no parameters."""
+    return {
+        "role": "assistant",
+        "content": None,
+        "function_call": {"name": description(func)["name"], "arguments": "null"},
+    }
+
+
+def select_and_act_request(
+    messages: list[dict], options: list[callable], compact: bool = False
+) -> dict:
+    """The kwargs for the completion function, to have the LLM call one of `options`.
+    If `compact`, their schemas are compacted, see `compact_schema`."""
+    functions = []
+    for x in options:
+        desc = compact_description(x) if compact else description(x)
+        function = {k: v for k, v in desc.items() if v is not None}
+        function.setdefault("parameters", {"type": "object", "properties": {}})
+        functions.append(function)
+    return dict(messages=messages, functions=functions, function_call="auto")
+
+
+def selected_option(response: dict, options: list[callable]) -> Optional[callable]:
+    """The option the LLM called, or None if it didn't call one of `options`."""
+    function_call = response["choices"][0]["message"].get("function_call")
+    if not function_call:
+        return None
+    selected = [x for x in options if description(x)["name"] == function_call["name"]]
+    if not selected:
+        return None
+    (action_func,) = selected
+    return action_func
+
+
+def parse_select_and_act(response: dict, options: list[callable]) -> Optional[tuple]:
+    """Returns the selected action, its input message, and its (validated) input,
+    or None if the LLM didn't call one of `options`."""
+    action_func = selected_option(response, options)
+    if action_func is None:
+        return None
+    if action_func == End or not description(action_func)["parameters"]:
+        return action_func, no_input_message(action_func), None
+    func_arg_message, func_arg = parse_func_input(response, action_func)
+    return action_func, func_arg_message, func_arg
+
+
 def dict_to_action_graph_func(action_graph: dict) -> callable:
-    def action_graph_func(
-        current_action: callable, current_action_result: Union[dict, None]
-    ):
-        return action_graph.get(current_action, None)
+    return CompiledActionGraph(action_graph)
+
+
+class CompiledActionGraph:
+    """An action graph function, for an action graph given as a dict.
+    All the metadata that's needed to run the graph is computed up front
+    (and so e.g. an action function missing its metadata raises an error immediately).
+    """
+
+    def __init__(self, action_graph: dict[callable, list[callable]]):
+        self.action_graph = {
+            node: tuple(options) for node, options in action_graph.items()
+        }
+        # The action functions for selecting between the options of each node,
+        # by (options, compact), see `select_next_action_factory`
+        self.selectors = {}
+        for options in self.action_graph.values():
+            for option in options:
+                if option != End and description(option)["parameters"]:
+                    get_pydantic_model_from_action_func(option)
+            if len(options) > 1:
+                for compact in (False, True):
+                    self.selectors[options, compact] = select_next_action_factory(
+                        options, compact
+                    )
+
+    def __call__(
+        self, current_action: callable, current_action_result: Union[dict, None]
+    ) -> Optional[tuple[callable]]:
+        return self.action_graph.get(current_action, None)
 
-    return action_graph_func
+    def selector(self, options: tuple[callable], compact: bool = False) -> callable:
+        """The action function for the LLM to select one of `options`."""
+        try:
+            return self.selectors[options, compact]
+        except KeyError:  # not the options of a node
+            return select_next_action_factory(options, compact)
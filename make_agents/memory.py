@@ -0,0 +1,161 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Folding older messages into a rolling summary, in the background."""
+import json
+import warnings
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Optional
+
+from make_agents.context import is_call_with_result
+
+default_summary_prompt = """You maintain a summary of a conversation between an assistant and a user (including the functions the assistant called, and their results). You will be given the current summary, and the next messages of the conversation. Reply with the updated summary: keep every fact that may be needed later (names, values, decisions, the task), and be concise."""
+
+
+class SummarizingMemory:
+    """A `pre_llm_callback` that replaces older messages with a summary, to bound the
+    size of the prompt without losing the facts in the older messages.
+
+    Once there are `chunk_size` messages older than the `keep_last` most recent messages,
+    the oldest chunk is summarised (together with the current summary) by the LLM,
+    in a background thread, so the agent doesn't wait. E.g. the summary is usually
+    made while an action (like waiting for the user's input) is running.
+    When it's ready, the chunk is replaced by the summary (a system message,
+    after the system prompt).
+
+    Parameters
+    ----------
+    completion : callable
+        A (sync) completion function, e.g. from `gpt.get_completion_func`,
+        possibly for a cheaper model than the agent uses.
+    keep_last : int, optional
+        The number of most recent messages that are never summarised, by default 20.
+    chunk_size : int, optional
+        The number of messages to fold into the summary at a time, by default 10.
+    pin_first : int, optional
+        The number of messages after the system prompt to never summarise, by default 0.
+    executor : Optional[Executor], optional
+        Where the summaries are made, by default a thread, which is shut down by `close`
+        (or on leaving a `with` block).
+    summary_prompt : str, optional
+        The instructions for updating the summary.
+    """
+
+    def __init__(
+        self,
+        completion: callable,
+        keep_last: int = 20,
+        chunk_size: int = 10,
+        pin_first: int = 0,
+        executor: Optional[Executor] = None,
+        summary_prompt: str = default_summary_prompt,
+    ):
+        self.completion = completion
+        self.keep_last = keep_last
+        self.chunk_size = chunk_size
+        self.pin_first = pin_first
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.summary_prompt = summary_prompt
+        self.summary: Optional[str] = None
+        self.summarised_messages = 0
+        self._summary_message: Optional[dict] = None
+        self._chunk: list[dict] = []
+        self._future = None
+
+    def __call__(self, messages: list[dict]):
+        if self._future is not None and self._future.done():
+            self._apply(messages)
+        if self._future is None:
+            self._start(messages)
+
+    def wait(self, messages: list[dict]):
+        """Block until the summary in progress (if any) is ready, and apply it."""
+        if self._future is not None:
+            self._future.result()
+            self._apply(messages)
+
+    def close(self):
+        """Shut down the executor, if it's the default one. A summary in progress
+        is not applied."""
+        self._future, self._chunk = None, []
+        if self._owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _num_pinned(self, messages: list[dict]) -> int:
+        num_pinned = 0
+        while (
+            num_pinned < len(messages)
+            and messages[num_pinned]["role"] == "system"
+            and messages[num_pinned] is not self._summary_message
+        ):
+            num_pinned += 1
+        return num_pinned + self.pin_first
+
+    def _start(self, messages: list[dict]):
+        start = self._num_pinned(messages)
+        if start < len(messages) and messages[start] is self._summary_message:
+            start += 1
+        # The chunk ends before the `keep_last` most recent messages, as they are now
+        limit = len(messages) - self.keep_last
+        end = start + self.chunk_size
+        if end > limit:
+            return
+        if is_call_with_result(messages, end - 1):
+            # Keep the call and its result together, in the chunk if there's room
+            end += 1 if end < limit else -1
+        if end <= start:
+            return
+        self._chunk = messages[start:end]
+        self._future = self.executor.submit(self._summarise, self.summary, self._chunk)
+
+    def _summarise(self, summary: Optional[str], chunk: list[dict]) -> str:
+        response = self.completion(
+            messages=[
+                {"role": "system", "content": self.summary_prompt},
+                {
+                    "role": "user",
+                    "content": f"Current summary: {summary or '(none)'}\n\n"
+                    f"Next messages: {json.dumps(chunk)}",
+                },
+            ]
+        )
+        return response["choices"][0]["message"]["content"]
+
+    def _apply(self, messages: list[dict]):
+        future, chunk = self._future, self._chunk
+        self._future, self._chunk = None, []
+        try:
+            self.summary = future.result()
+        except Exception as e:
+            warnings.warn(f"Failed to summarise messages, will try again: {e!r}")
+            return
+        new_summary_message = {
+            "role": "system",
+            "content": f"Summary of the earlier conversation: {self.summary}",
+        }
+        # Replace the summary and the chunk (whatever is left of them) with the new summary
+        remove = {id(m) for m in chunk} | {id(self._summary_message)}
+        start = self._num_pinned(messages)
+        end = start
+        while end < len(messages) and id(messages[end]) in remove:
+            end += 1
+        messages[start:end] = [new_summary_message]
+        self._summary_message = new_summary_message
+        self.summarised_messages += len(chunk)
@@ -0,0 +1,216 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A local mock of the OpenAI chat completions API, for load testing the real network path
+(retries, timeouts, connection reuse, rate limiting) without calling the real API.
+
+E.g.::
+
+    with MockOpenAIServer(latency=lognormal_latency(0.5), rate_limit_rate=0.05) as server:
+        completion = gpt.get_completion_func(api_base=server.url, api_key="mock")
+        ...
+"""
+import json
+import math
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Union
+
+from make_agents.fake import FakeLLM
+
+
+@dataclass
+class MockServerStats:
+    requests: int = 0
+    completions: int = 0
+    rate_limited: int = 0
+    timeouts: int = 0
+    # The connections opened, fewer than requests if connections are reused
+    connections: int = 0
+
+
+def lognormal_latency(median: float, sigma: float = 0.5) -> callable:
+    """A latency distribution with a long tail, like real LLM APIs', for `MockOpenAIServer`."""
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+class MockOpenAIServer:
+    """An HTTP server that speaks the chat completions (and function calling) protocol,
+    including streaming, in a background thread. Point a completion function at `url`
+    (e.g. `gpt.get_completion_func(api_base=server.url, api_key="mock")`).
+
+    Parameters
+    ----------
+    llm : Optional[FakeLLM], optional
+        Makes the (scripted) responses, by default `FakeLLM()`.
+    latency : Union[float, callable], optional
+        The seconds to wait before responding, or a function `latency(rng)` that samples
+        it (`rng` is a `random.Random`), e.g. `lognormal_latency(0.5)`, by default 0.
+    rate_limit_rate : float, optional
+        The fraction of requests to reject with a 429 (rate limit) error, by default 0.
+    timeout_rate : float, optional
+        The fraction of requests to stall for `timeout_seconds` (before responding
+        with a 504), so that the client times out, by default 0.
+    timeout_seconds : float, optional
+        How long stalled requests stall for, by default 30.
+    seed : Optional[int], optional
+        The seed for the latencies and injected errors, by default 0.
+    host : str, optional
+        By default "127.0.0.1".
+    port : int, optional
+        By default 0 (any free port).
+    """
+
+    def __init__(
+        self,
+        llm: Optional[FakeLLM] = None,
+        latency: Union[float, callable] = 0.0,
+        rate_limit_rate: float = 0.0,
+        timeout_rate: float = 0.0,
+        timeout_seconds: float = 30.0,
+        seed: Optional[int] = 0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.llm = llm or FakeLLM()
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.stats = MockServerStats()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = _HTTPServer((host, port), _handler(self))
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """The API base URL, e.g. http://127.0.0.1:8000/v1"""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        """Serve in the current thread, e.g. from the CLI."""
+        self._httpd.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _sample(self) -> tuple[float, str]:
+        """The latency, and the outcome (the stat it counts towards):
+        "completions", "rate_limited" or "timeouts"."""
+        with self._lock:
+            self.stats.requests += 1
+            latency = self.latency(self._rng) if callable(self.latency) else self.latency
+            draw = self._rng.random()
+        if draw < self.rate_limit_rate:
+            return 0.0, "rate_limited"
+        if draw < self.rate_limit_rate + self.timeout_rate:
+            return self.timeout_seconds, "timeouts"
+        return latency, "completions"
+
+    def _count(self, stat: str):
+        with self._lock:
+            setattr(self.stats, stat, getattr(self.stats, stat) + 1)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+        # else the client hung up, e.g. it timed out
+
+
+def _handler(server: MockOpenAIServer) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+        disable_nagle_algorithm = True  # send streamed chunks straight away
+
+        def setup(self):
+            super().setup()
+            server._count("connections")
+
+        def log_message(self, format, *args):
+            pass  # don't log every request
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                return self.send_json(404, error("Not found.", "invalid_request_error"))
+            try:
+                request = json.loads(body)
+            except json.JSONDecodeError:
+                return self.send_json(
+                    400, error("Invalid JSON.", "invalid_request_error")
+                )
+            latency, outcome = server._sample()
+            server._count(outcome)
+            time.sleep(latency)
+            if outcome == "rate_limited":
+                message = "Rate limit reached (injected by the mock server)."
+                return self.send_json(
+                    429, error(message, "requests"), {"Retry-After": "1"}
+                )
+            if outcome == "timeouts":
+                return self.send_json(504, error("Timed out.", "timeout"))
+            response = server.llm.respond(request)
+            if request.get("stream"):
+                return self.send_stream(response)
+            self.send_json(200, response)
+
+        def send_json(self, status: int, data: dict, headers: Optional[dict] = None):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_stream(self, response: dict):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            events = [f"data: {json.dumps(x)}\n\n" for x in server.llm.stream(response)]
+            for event in events + ["data: [DONE]\n\n"]:
+                data = event.encode()
+                self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def error(message: str, error_type: str) -> dict:
+    return {
+        "error": {"message": message, "type": error_type, "param": None, "code": None}
+    }
@@ -0,0 +1,111 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Parsing of incomplete JSON, e.g. function call arguments while they're being streamed."""
+import json
+from typing import Any
+
+# How many characters to drop from the end of the text, at most, to find a parsable prefix
+MAX_BACKTRACK = 64
+
+_NOTHING = object()
+
+
+def parse_partial_json(text: str, default: Any = None) -> Any:
+    """Best-effort parse of the beginning of a JSON document, by closing any open
+    strings, objects and arrays, e.g. `'{"message": "Hel'` -> `{"message": "Hel"}`.
+    Incomplete keys and literals are dropped.
+
+    Returns `default` if no prefix of the text could be parsed.
+    """
+    for end in range(len(text), max(len(text) - MAX_BACKTRACK, 0) - 1, -1):
+        value = _close_and_parse(text[:end])
+        if value is not _NOTHING:
+            return value
+    return default
+
+
+def repair_json(text: str) -> Any:
+    """Parse JSON that's slightly malformed, as LLMs sometimes generate:
+    with trailing commas (`'{"a": 1,}'`), wrapped in a Markdown code block, or truncated
+    (the open strings, objects and arrays are closed, as in `parse_partial_json`,
+    but nothing is dropped).
+
+    Raises `json.JSONDecodeError` if it can't be repaired.
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        error = e
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1]
+        text = text[: -3 if text.endswith("```") else None]
+    value = _close_and_parse(_remove_trailing_commas(text))
+    if value is _NOTHING:
+        raise error
+    return value
+
+
+def _remove_trailing_commas(text: str) -> str:
+    chars = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "}]":
+            while chars and chars[-1].isspace():
+                chars.pop()
+            if chars and chars[-1] == ",":
+                chars.pop()
+        chars.append(char)
+    return "".join(chars)
+
+
+def _close_and_parse(text: str) -> Any:
+    closers = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            closers.append("}")
+        elif char == "[":
+            closers.append("]")
+        elif char in "}]" and closers:
+            closers.pop()
+    if in_string:
+        text = (text[:-1] if escaped else text) + '"'
+    text = text.rstrip()
+    if text.endswith(","):
+        text = text[:-1]
+    elif text.endswith(":"):
+        text += " null"
+    try:
+        return json.loads(text + "".join(reversed(closers)))
+    except json.JSONDecodeError:
+        return _NOTHING
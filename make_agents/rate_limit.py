@@ -0,0 +1,170 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Client-side rate limiting of completions, shared between agents (and threads / tasks)."""
+import asyncio
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class RateLimiterStats:
+    requests: int = 0
+    tokens: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.requests if self.requests else 0.0
+
+
+class TokenBucket:
+    """A token bucket, that allows its level to go negative, to reserve capacity in the future."""
+
+    def __init__(self, per_minute: float, capacity: float, now: float):
+        self.rate = per_minute / 60
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take `amount` from the bucket, and return how long to wait until it's available."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Limits the requests per minute and tokens per minute of the completion functions
+    it's passed to (see `gpt.get_completion_func`), e.g. to stay below the quota of
+    an OpenAI organisation, with many agents running in parallel.
+
+    Requests are served in the order they arrive (first come, first served),
+    across threads and asyncio tasks. Each request reserves its capacity on arrival,
+    then waits until that capacity is available, so waiting requests don't
+    compete with each other (or retry in lockstep).
+
+    Parameters
+    ----------
+    requests_per_minute : Optional[float], optional
+        The maximum number of requests per minute, by default None (unlimited).
+    tokens_per_minute : Optional[float], optional
+        The maximum number of tokens per minute, by default None (unlimited).
+        The tokens of a request are estimated before it's sent
+        (see `estimate_tokens`), then corrected using the usage in the response.
+    max_burst : float, optional
+        The fraction of a minute's quota that can be used at once, by default 1.0.
+        Lower values spread the requests out more evenly.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_burst: float = 1.0,
+        clock: callable = time.monotonic,
+    ):
+        now = clock()
+        self.request_bucket = (
+            TokenBucket(requests_per_minute, max(1, requests_per_minute * max_burst), now)
+            if requests_per_minute
+            else None
+        )
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute, max(1, tokens_per_minute * max_burst), now)
+            if tokens_per_minute
+            else None
+        )
+        self.clock = clock
+        self.stats = RateLimiterStats()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int) -> float:
+        """Reserve capacity for a request of `tokens` tokens, and return
+        the number of seconds to wait before sending it."""
+        with self._lock:
+            now = self.clock()
+            delay = 0.0
+            if self.request_bucket:
+                delay = max(delay, self.request_bucket.reserve(1, now))
+            if self.token_bucket:
+                delay = max(delay, self.token_bucket.reserve(tokens, now))
+            self.stats.requests += 1
+            self.stats.tokens += tokens
+            self.stats.total_wait += delay
+            self.stats.max_wait = max(self.stats.max_wait, delay)
+            return delay
+
+    def acquire(self, request: dict) -> int:
+        """Wait until `request` (the kwargs of the completion) can be sent.
+        Returns the estimated tokens, to pass to `record_usage`."""
+        tokens = estimate_tokens(request)
+        delay = self.reserve(tokens)
+        if delay:
+            self._enter_queue()
+            try:
+                time.sleep(delay)
+            finally:
+                self._leave_queue()
+        return tokens
+
+    async def aacquire(self, request: dict) -> int:
+        """The same as `acquire`, but for asyncio."""
+        tokens = estimate_tokens(request)
+        delay = self.reserve(tokens)
+        if delay:
+            self._enter_queue()
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._leave_queue()
+        return tokens
+
+    def record_usage(self, estimated_tokens: int, response: dict):
+        """Correct the token bucket, using the tokens that the request actually used."""
+        try:
+            actual_tokens = response["usage"]["total_tokens"]
+        except (KeyError, TypeError):
+            return
+        with self._lock:
+            self.stats.tokens += actual_tokens - estimated_tokens
+            if self.token_bucket:
+                self.token_bucket.refund(estimated_tokens - actual_tokens)
+
+    def _enter_queue(self):
+        with self._lock:
+            self.stats.queue_depth += 1
+            self.stats.max_queue_depth = max(
+                self.stats.max_queue_depth, self.stats.queue_depth
+            )
+
+    def _leave_queue(self):
+        with self._lock:
+            self.stats.queue_depth -= 1
+
+
+def estimate_tokens(request: dict, completion_tokens: int = 256) -> int:
+    """A rough (and cheap) estimate of the tokens used by a request:
+    ~4 characters per prompt token, plus `max_tokens` if set, else `completion_tokens`."""
+    prompt = json.dumps([request.get("messages"), request.get("functions")])
+    return len(prompt) // 4 + (request.get("max_tokens") or completion_tokens)
@@ -0,0 +1,129 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Repairing invalid function call arguments from the LLM (malformed JSON, or input
+that fails validation), rather than failing the agent."""
+import json
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from pydantic import ValidationError
+
+from make_agents.partial_json import repair_json
+
+# What parsing and validating invalid arguments raises: only these are repaired,
+# other errors (e.g. there's no function call) are raised as they are
+INVALID_ARGUMENTS = (json.JSONDecodeError, ValidationError)
+
+
+@dataclass
+class RepairStats:
+    # The function calls with invalid arguments
+    invalid: int = 0
+    # Of those, how many were repaired without the LLM, by the LLM, or not at all
+    local_repairs: int = 0
+    llm_repairs: int = 0
+    failures: int = 0
+    # The repair completions, and their tokens
+    llm_attempts: int = 0
+    tokens: int = 0
+
+
+class ArgumentRepairer:
+    """Repairs invalid function call arguments, so that one bad generation costs
+    one short round-trip, rather than the session.
+
+    First the JSON is repaired locally, if it can be (see `partial_json.repair_json`),
+    e.g. if it's truncated, or has trailing commas. Else the LLM is sent the same
+    request again, with its invalid call and the error appended (to that request only,
+    not to the agent's messages), and asked to call the function again,
+    up to `max_attempts` times. If it's still invalid, the error is raised.
+
+    Only errors from parsing the arguments (`json.JSONDecodeError`, and pydantic's
+    `ValidationError`) are repaired, before the action runs; any other error, e.g. if
+    there's no function call, or from the action itself, is raised as it is.
+
+    Parameters
+    ----------
+    max_attempts : int, optional
+        The most repair completions per function call, by default 2.
+    local : bool, optional
+        Whether to try repairing the JSON locally first, by default True.
+    """
+
+    def __init__(self, max_attempts: int = 2, local: bool = True):
+        self.max_attempts = max_attempts
+        self.local = local
+        self.stats = RepairStats()
+        self._lock = threading.Lock()
+
+    def repair_locally(self, response: dict) -> Optional[dict]:
+        """The response with its arguments repaired, or None if they can't be."""
+        if not self.local:
+            return None
+        message = response["choices"][0]["message"]
+        try:
+            arguments = repair_json(message["function_call"]["arguments"])
+        except json.JSONDecodeError:
+            return None
+        function_call = {**message["function_call"], "arguments": json.dumps(arguments)}
+        choice = {
+            **response["choices"][0],
+            "message": {**message, "function_call": function_call},
+        }
+        return {**response, "choices": [choice]}
+
+    def request(self, request: dict, response: dict, error: Exception) -> dict:
+        """The completion kwargs to have the LLM correct its call: `request`,
+        with the invalid call, and the error, appended to the messages."""
+        name = request["function_call"]["name"]
+        message = response["choices"][0]["message"]
+        invalid_call = {
+            "role": "assistant",
+            "content": message.get("content"),
+            "function_call": message["function_call"],
+        }
+        feedback = {
+            "role": "function",
+            "name": name,
+            "content": (
+                f"Error: {describe_error(error)}\n"
+                f"Call {name} again, with corrected arguments."
+            ),
+        }
+        return {**request, "messages": [*request["messages"], invalid_call, feedback]}
+
+    def record(self, stat: str, response: Optional[dict] = None):
+        """Count towards a stat, and the tokens of a repair completion's `response`."""
+        with self._lock:
+            setattr(self.stats, stat, getattr(self.stats, stat) + 1)
+            if response is not None:
+                try:
+                    self.stats.tokens += response["usage"]["total_tokens"]
+                except (KeyError, TypeError):
+                    pass
+
+
+def describe_error(error: Exception) -> str:
+    """A short description of why the arguments are invalid, for the LLM."""
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{'.'.join(str(x) for x in e['loc']) or 'arguments'}: {e['msg']}"
+            for e in error.errors(include_url=False)
+        )
+    if isinstance(error, json.JSONDecodeError):
+        return (
+            f"The arguments are not valid JSON: {error.msg} (at character {error.pos})."
+        )
+    return str(error)
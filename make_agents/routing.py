@@ -0,0 +1,140 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Routing completion requests to different models / providers, e.g. to send the
+high-volume, easy calls (selecting the next action) to a fast, cheap model.
+
+A backend is any completion function: from `gpt.get_completion_func` (OpenAI,
+or an OpenAI compatible endpoint, via `api_base`), a `fake.FakeLLM`, or a plain function.
+"""
+import inspect
+import threading
+from collections import Counter
+from typing import Optional, Union
+
+from make_agents.make_agents import description
+
+SELECTOR = "select_next_func"
+
+
+class CompletionRouter:
+    """A completion function that sends each request to one of several completion
+    functions (backends), by the function the LLM is asked to call.
+
+    The backends must be sync; for async backends (and `arun_agent`),
+    use `AsyncCompletionRouter`.
+
+    Parameters
+    ----------
+    default : callable
+        The backend for requests that aren't routed elsewhere.
+    selector : Optional[callable], optional
+        The backend for selecting the next action (`select_next_func` calls),
+        by default `default`.
+    routes : Optional[dict[Union[callable, str], callable]], optional
+        The backend for generating the input of an action, by action (or action name),
+        e.g. `{write_report: gpt4_completion}`, by default None.
+    auto : Optional[callable], optional
+        The backend for requests where the LLM chooses the function to call, e.g. with
+        `run_agent(..., select_and_act=True)`, by default `default`.
+
+    Attributes
+    ----------
+    calls : Counter
+        The number of requests sent to each route: "default", "selector", "auto",
+        or an action's name.
+    request_defaults : dict
+        The `request_defaults` of the backends (e.g. their models), by route,
+        so that e.g. `cache.cached_completion` keys a request by the model it's routed to
+        (changing any backend's defaults changes the keys of every route).
+    """
+
+    is_async = False
+
+    def __init__(
+        self,
+        default: callable,
+        selector: Optional[callable] = None,
+        routes: Optional[dict[Union[callable, str], callable]] = None,
+        auto: Optional[callable] = None,
+    ):
+        self.default = default
+        self.selector = selector or default
+        self.auto = auto or default
+        self.routes = {
+            key if isinstance(key, str) else description(key)["name"]: backend
+            for key, backend in (routes or {}).items()
+        }
+        backends = {
+            "default": self.default,
+            "selector": self.selector,
+            "auto": self.auto,
+            **self.routes,
+        }
+        for route, backend in backends.items():
+            if is_async(backend) != self.is_async:
+                raise TypeError(
+                    f"The {route!r} backend is {'' if self.is_async else 'a'}sync, "
+                    f"but {type(self).__name__}'s backends must all be "
+                    f"{'a' if self.is_async else ''}sync."
+                )
+        self.request_defaults = {
+            "routes": {
+                route: getattr(backend, "request_defaults", {})
+                for route, backend in backends.items()
+            }
+        }
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def route(self, request: dict) -> tuple[str, callable]:
+        """The route (see `calls`), and the backend, for a request."""
+        function_call = request.get("function_call")
+        if not isinstance(function_call, dict):
+            return (
+                ("auto", self.auto)
+                if request.get("functions")
+                else ("default", self.default)
+            )
+        name = function_call["name"]
+        if name == SELECTOR:
+            return "selector", self.selector
+        if name in self.routes:
+            return name, self.routes[name]
+        return "default", self.default
+
+    def _backend(self, request: dict) -> callable:
+        route, backend = self.route(request)
+        with self._lock:
+            self.calls[route] += 1
+        return backend
+
+    def __call__(self, **kwargs):
+        return self._backend(kwargs)(**kwargs)
+
+
+class AsyncCompletionRouter(CompletionRouter):
+    """The same as `CompletionRouter`, for async backends: an async completion function,
+    for use with `arun_agent`."""
+
+    is_async = True
+
+    async def __call__(self, **kwargs):
+        return await self._backend(kwargs)(**kwargs)
+
+
+def is_async(completion: callable) -> bool:
+    """Whether a completion function is async (including an `AsyncCompletionRouter`)."""
+    return inspect.iscoroutinefunction(completion) or inspect.iscoroutinefunction(
+        getattr(type(completion), "__call__", None)
+    )
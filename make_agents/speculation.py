@@ -0,0 +1,109 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Speculative prefetching of the next action's input, while the next action is being selected."""
+import threading
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class SpeculationStats:
+    attempts: int = 0
+    hits: int = 0
+    misses: int = 0
+    # The tokens of the mispredicted completions that weren't cancelled in time
+    wasted_tokens: int = 0
+    # Misses that were cancelled: before they started (`run_agent`), or while
+    # in flight (`arun_agent`)
+    cancelled: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.attempts if self.attempts else 0.0
+
+
+class Speculator:
+    """Predicts which action will be selected, from the past selections
+    (made after the same action, between the same options), so that `run_agent`
+    can get the input of the predicted action from the LLM at the same time as the selection.
+
+    If the prediction is right, that's one LLM round-trip less; if it's wrong,
+    the speculative completion is cancelled, if it can be (with `arun_agent`; with
+    `run_agent`, only if it hasn't started), otherwise it runs to completion,
+    and its tokens are counted in `stats.wasted_tokens`.
+    Note that the speculative completion doesn't see the selection messages.
+
+    Parameters
+    ----------
+    min_count : int, optional
+        Only predict once the prediction has been selected this many times, by default 1.
+    min_confidence : float, optional
+        Only predict if the prediction has been selected at least this fraction of the time,
+        by default 0.5.
+    """
+
+    def __init__(self, min_count: int = 1, min_confidence: float = 0.5):
+        self.min_count = min_count
+        self.min_confidence = min_confidence
+        self.stats = SpeculationStats()
+        self.selections = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def predict(
+        self, current_action: callable, options: list[callable]
+    ) -> Optional[callable]:
+        """The option that's likely to be selected, or None."""
+        counts = self.selections.get(_key(current_action, options))
+        if not counts:
+            return None
+        (name, count), *_ = counts.most_common(1)
+        if count < self.min_count or count / sum(counts.values()) < self.min_confidence:
+            return None
+        return next(x for x in options if x.__name__ == name)
+
+    def record(
+        self, current_action: callable, options: list[callable], selected: callable
+    ):
+        """Record a selection, to improve future predictions."""
+        with self._lock:
+            self.selections[_key(current_action, options)][selected.__name__] += 1
+
+    def record_outcome(self, hit: bool, prefetch):
+        """Record whether the prediction was right. On a miss, `prefetch` (a future
+        of the speculative response) is cancelled if it can be, otherwise its tokens
+        are counted as wasted when it completes."""
+        with self._lock:
+            self.stats.attempts += 1
+            self.stats.hits += hit
+            self.stats.misses += not hit
+        if not hit:
+            prefetch.add_done_callback(self._count_wasted)
+            prefetch.cancel()
+
+    def _count_wasted(self, prefetch):
+        with self._lock:
+            if prefetch.cancelled():
+                self.stats.cancelled += 1
+                return
+            if prefetch.exception() is not None:
+                return
+            try:
+                self.stats.wasted_tokens += prefetch.result()["usage"]["total_tokens"]
+            except (KeyError, TypeError):
+                pass
+
+
+def _key(current_action: callable, options: list[callable]) -> tuple:
+    return (current_action.__name__, *(x.__name__ for x in options))
@@ -0,0 +1,80 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streaming completions (`stream=True`), with the partial messages passed to a callback."""
+from typing import Optional
+
+from make_agents.partial_json import parse_partial_json
+
+
+class MessageAccumulator:
+    """Builds up the assistant message from the chunks of a streamed completion."""
+
+    def __init__(self):
+        self.message = {"role": "assistant", "content": None}
+        self.usage = None
+
+    def add(self, chunk: dict) -> bool:
+        """Add a chunk, returns True if it changed the message."""
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        if not chunk.get("choices"):
+            return False
+        delta = chunk["choices"][0].get("delta") or {}
+        changed = False
+        if delta.get("content"):
+            self.message["content"] = (self.message["content"] or "") + delta["content"]
+            changed = True
+        if delta.get("function_call"):
+            function_call = self.message.setdefault(
+                "function_call", {"name": "", "arguments": ""}
+            )
+            for key in ("name", "arguments"):
+                function_call[key] += delta["function_call"].get(key) or ""
+            changed = True
+        return changed
+
+    @property
+    def partial_arguments(self) -> Optional[dict]:
+        """The function call arguments so far, parsed, see `parse_partial_json`."""
+        if "function_call" not in self.message:
+            return None
+        return parse_partial_json(self.message["function_call"]["arguments"])
+
+    def response(self) -> dict:
+        """The complete response, in the same format as a non-streamed completion."""
+        response = {"choices": [{"message": self.message}]}
+        if self.usage:
+            response["usage"] = self.usage
+        return response
+
+
+def stream_completion(completion: callable, kwargs: dict, on_partial: callable) -> dict:
+    """Get a completion with `stream=True`, calling `on_partial(message, partial_arguments)`
+    as each chunk arrives, and return the complete response."""
+    accumulator = MessageAccumulator()
+    for chunk in completion(stream=True, **kwargs):
+        if accumulator.add(chunk):
+            on_partial(accumulator.message, accumulator.partial_arguments)
+    return accumulator.response()
+
+
+async def astream_completion(
+    acompletion: callable, kwargs: dict, on_partial: callable
+) -> dict:
+    """The same as `stream_completion`, for async completion functions."""
+    accumulator = MessageAccumulator()
+    async for chunk in await acompletion(stream=True, **kwargs):
+        if accumulator.add(chunk):
+            on_partial(accumulator.message, accumulator.partial_arguments)
+    return accumulator.response()
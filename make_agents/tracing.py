@@ -0,0 +1,272 @@
+# Copyright 2023 Sidney Radcliffe
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tracing the phases of the agent loop, as spans (with events), to see where the time goes.
+
+Tracing is off unless a `Tracer` is active, e.g.::
+
+    exporter = InMemoryExporter()
+    with Tracer(exporter):
+        for messages in run_agent(action_graph):
+            ...
+    exporter.spans  # "graph", "selector", "completion", "validation", "action", ...
+
+When it's off, each instrumented phase costs one context variable lookup.
+"""
+import contextvars
+import itertools
+import json
+import threading
+import time
+from typing import Optional
+
+_tracer = contextvars.ContextVar("make_agents_tracer", default=None)
+_current_span = contextvars.ContextVar("make_agents_span", default=None)
+
+
+class Span:
+    """A timed phase of the agent loop, with attributes (e.g. the action's name,
+    the number of tokens) and events (e.g. retries). Times are in ns since the epoch."""
+
+    __slots__ = (
+        "name",
+        "span_id",
+        "parent_id",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "events",
+    )
+
+    def __init__(
+        self, name: str, span_id: int, parent_id: Optional[int], attributes: dict
+    ):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.events = []
+
+    @property
+    def duration(self) -> float:
+        """The duration in seconds."""
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name: str, **attributes):
+        self.events.append({"name": name, "time_ns": time.time_ns(), **attributes})
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"Span({self.name!r}, {self.attributes!r})"
+
+
+class _NoSpan:
+    """What `span` gives when tracing is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def add_event(self, name: str, **attributes):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _ActiveSpan:
+    def __init__(self, tracer: "Tracer", name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> Span:
+        self.span = self.tracer.start_span(self.name, self.attributes)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current_span.reset(self.token)
+        if exc is not None:
+            self.span.set(error=repr(exc))
+        self.tracer.end_span(self.span)
+
+
+class Tracer:
+    """Passes the spans of the agent loop to the exporters, while it's active
+    (use it as a context manager, in the context the agent is run in).
+
+    Parameters
+    ----------
+    *exporters
+        Where the spans go, e.g. `InMemoryExporter`, `JSONLExporter`,
+        `OpenTelemetryExporter`. Exporters have an `export(span)` method, called
+        when a span ends, and optionally an `on_start(span)` method.
+    """
+
+    def __init__(self, *exporters):
+        self.exporters = exporters
+        self._ids = itertools.count(1)
+        self._tokens = []
+
+    def span(self, name: str, **attributes) -> _ActiveSpan:
+        return _ActiveSpan(self, name, attributes)
+
+    def start_span(self, name: str, attributes: dict) -> Span:
+        parent = _current_span.get()
+        span = Span(name, next(self._ids), parent and parent.span_id, attributes)
+        for exporter in self.exporters:
+            if hasattr(exporter, "on_start"):
+                exporter.on_start(span)
+        return span
+
+    def end_span(self, span: Span):
+        span.end_ns = time.time_ns()
+        for exporter in self.exporters:
+            exporter.export(span)
+
+    def event(self, name: str, **attributes):
+        """Add an event to the current span, or if there isn't one,
+        export it as a span of its own (with no duration)."""
+        span = _current_span.get()
+        if span is not None:
+            span.add_event(name, **attributes)
+        else:
+            self.end_span(self.start_span(name, attributes))
+
+    def __enter__(self):
+        self._tokens.append(_tracer.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        _tracer.reset(self._tokens.pop())
+
+
+def get_tracer() -> Optional[Tracer]:
+    """The active tracer, or None if tracing is off."""
+    return _tracer.get()
+
+
+def span(name: str, **attributes):
+    """A context manager that traces the phase it wraps, if tracing is on."""
+    tracer = _tracer.get()
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(name, **attributes)
+
+
+def event(name: str, **attributes):
+    """Record an event (in the current span), if tracing is on."""
+    tracer = _tracer.get()
+    if tracer is not None:
+        tracer.event(name, **attributes)
+
+
+def usage_attributes(response) -> dict:
+    """The token counts of a completion response, as span attributes."""
+    try:
+        usage = response["usage"]
+        return dict(
+            prompt_tokens=usage["prompt_tokens"],
+            completion_tokens=usage["completion_tokens"],
+        )
+    except (KeyError, TypeError):
+        return {}
+
+
+class InMemoryExporter:
+    """Collects the spans in `spans`, e.g. for tests, or to analyse in a notebook."""
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+class JSONLExporter:
+    """Writes each span as a line of JSON to `path`."""
+
+    def __init__(self, path: str):
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        self._file.close()
+
+
+class OpenTelemetryExporter:
+    """Re-creates the spans as OpenTelemetry spans (with the same parents, times,
+    attributes and events), to send them to any OpenTelemetry backend.
+    Requires `opentelemetry-api` (make_agents does not install it).
+
+    Parameters
+    ----------
+    tracer : optional
+        The OpenTelemetry tracer, by default `opentelemetry.trace.get_tracer("make_agents")`.
+    """
+
+    def __init__(self, tracer=None):
+        from opentelemetry import trace
+
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer("make_agents")
+        self._spans = {}  # span_id -> OpenTelemetry span
+        self._lock = threading.Lock()
+
+    def on_start(self, span: Span):
+        with self._lock:
+            parent = self._spans.get(span.parent_id)
+        context = self._trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self.tracer.start_span(
+            span.name, context=context, start_time=span.start_ns
+        )
+        with self._lock:
+            self._spans[span.span_id] = otel_span
+
+    def export(self, span: Span):
+        with self._lock:
+            otel_span = self._spans.pop(span.span_id)
+        otel_span.set_attributes({k: _otel_value(v) for k, v in span.attributes.items()})
+        for event in span.events:
+            event = dict(event)
+            name, time_ns = event.pop("name"), event.pop("time_ns")
+            attributes = {k: _otel_value(v) for k, v in event.items()}
+            otel_span.add_event(name, attributes, timestamp=time_ns)
+        if "error" in span.attributes:
+            otel_span.set_status(self._trace.StatusCode.ERROR, span.attributes["error"])
+        otel_span.end(end_time=span.end_ns)
+
+
+def _otel_value(value):
+    # OpenTelemetry attributes must be primitives
+    return value if isinstance(value, (str, bool, int, float)) else str(value)
@@ -0,0 +1,192 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from pydantic import BaseModel, Field
+
+from make_agents.cache import (
+    CacheMissError,
+    MemoryCache,
+    SQLiteCache,
+    cached_completion,
+    request_key,
+    single_flight_acompletion,
+    single_flight_completion,
+)
+from make_agents.make_agents import action
+
+
+def test_request_key_is_canonical():
+    assert request_key({"a": 1, "b": [1, 2]}) == request_key({"b": [1, 2], "a": 1})
+    assert request_key({"a": 1}) != request_key({"a": 2})
+
+
+@pytest.mark.parametrize(
+    "make_cache", [MemoryCache, lambda **kw: SQLiteCache(":memory:", **kw)]
+)
+def test_lru_eviction(make_cache):
+    cache = make_cache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"  # now "b" is the least recently used
+    cache.put("c", "3")
+    assert cache.get("b") is None and cache.get("a") == "1" and cache.get("c") == "3"
+    assert cache.stats.evictions == 1 and cache.stats.misses == 1 and len(cache) == 2
+
+    cache = make_cache(max_bytes=4)
+    cache.put("a", "11")
+    cache.put("b", "22")
+    cache.put("c", "333")
+    assert len(cache) == 1 and cache.get("c") == "333"
+
+
+def test_record_and_replay(tmp_path):
+    calls = []
+
+    def completion(**kwargs):
+        calls.append(kwargs)
+        return {
+            "choices": [{"message": {"role": "assistant", "content": str(len(calls))}}]
+        }
+
+    completion.request_defaults = {"model": "gpt-4"}
+    path = str(tmp_path / "cache.sqlite")
+    cached = cached_completion(completion, SQLiteCache(path))
+    first = cached(messages=[{"role": "user", "content": "hi"}])
+    second = cached(messages=[{"role": "user", "content": "hi"}])
+    assert len(calls) == 1
+    assert first == second and type(second) is dict  # a hit looks like a miss
+
+    # A new process, replaying from disk
+    replay = cached_completion(completion, SQLiteCache(path), mode="replay")
+    assert replay(messages=[{"role": "user", "content": "hi"}]) == first
+    with pytest.raises(CacheMissError):
+        replay(messages=[{"role": "user", "content": "bye"}])
+    assert len(calls) == 1
+
+    # The model is part of the key
+    completion.request_defaults = {"model": "gpt-3.5-turbo"}
+    with pytest.raises(CacheMissError):
+        cached_completion(completion, SQLiteCache(path), mode="replay")(
+            messages=[{"role": "user", "content": "hi"}]
+        )
+
+
+def test_replay_keeps_openai_objects():
+    from openai.util import convert_to_openai_object
+
+    def completion(**kwargs):
+        return convert_to_openai_object(
+            {"choices": [{"message": {"role": "assistant", "content": "hi"}}]}
+        )
+
+    cached = cached_completion(completion, MemoryCache())
+    miss = cached(messages=[])
+    hit = cached(messages=[])
+    assert type(hit) is type(miss) and hit == miss
+    assert hit.choices[0].message.content == "hi"
+
+
+@pytest.mark.parametrize(
+    "make_cache", [MemoryCache, lambda **kw: SQLiteCache(":memory:", **kw)]
+)
+def test_ttl(make_cache):
+    now = [0.0]
+    cache = make_cache(ttl=10, clock=lambda: now[0])
+    cache.put("a", "1")
+    now[0] = 9
+    assert cache.get("a") == "1"
+    now[0] = 10
+    assert cache.get("a") is None and len(cache) == 0
+    assert cache.stats.expirations == 1 and cache.stats.misses == 1
+
+
+def test_action_cache():
+    calls = []
+
+    class LookupArg(BaseModel):
+        key: str = Field(description="The key")
+
+    @action(cache=True)
+    def lookup(arg: LookupArg):
+        """Look up a key."""
+        calls.append(arg.key)
+        return {"value": arg.key.upper()}
+
+    assert lookup.description_for_llm["parameters"]["title"] == "LookupArg"
+    assert lookup(LookupArg(key="a")) == {"value": "A"}
+    assert lookup(LookupArg(key="a")) == {"value": "A"}
+    assert lookup(LookupArg(key="b")) == {"value": "B"}
+    assert calls == ["a", "b"]
+    assert lookup.cache.stats.hits == 1 and lookup.cache.stats.misses == 2
+
+    @action(cache=MemoryCache(max_entries=1))
+    async def alookup(arg: LookupArg):
+        """Look up a key, asynchronously."""
+        calls.append(arg.key)
+        return arg.key
+
+    assert asyncio.run(alookup(LookupArg(key="c"))) == "c"
+    assert asyncio.run(alookup(LookupArg(key="c"))) == "c"
+    assert calls == ["a", "b", "c"]
+
+
+def test_single_flight():
+    calls = []
+    release = threading.Event()
+
+    def completion(**kwargs):
+        calls.append(kwargs)
+        release.wait(5)
+        return {"choices": [{"message": {"content": kwargs["messages"][0]["content"]}}]}
+
+    coalesced = single_flight_completion(completion)
+    requests = [{"messages": [{"role": "user", "content": x}]} for x in "aaab"]
+    with ThreadPoolExecutor(len(requests)) as executor:
+        futures = [executor.submit(lambda x: coalesced(**x), x) for x in requests]
+        while len(calls) < 2 or coalesced.stats.requests < 4:
+            time.sleep(0.01)
+        release.set()
+        responses = [x.result() for x in futures]
+    assert len(calls) == 2
+    assert coalesced.stats.requests == 4 and coalesced.stats.coalesced == 2
+    assert [x["choices"][0]["message"]["content"] for x in responses] == list("aaab")
+    # Each caller gets its own copy
+    responses[0]["choices"][0]["message"]["content"] = "changed"
+    assert responses[1]["choices"][0]["message"]["content"] == "a"
+    # Requests that aren't in flight at the same time aren't shared
+    coalesced(**requests[0])
+    assert len(calls) == 3
+
+
+def test_single_flight_async():
+    calls = []
+
+    async def acompletion(**kwargs):
+        calls.append(kwargs)
+        await asyncio.sleep(0.05)
+        if kwargs.get("fail"):
+            raise ValueError("API error")
+        return {"choices": [{"message": {"content": "hi"}}]}
+
+    coalesced = single_flight_acompletion(acompletion)
+
+    async def run():
+        responses = await asyncio.gather(*[coalesced(model="m") for _ in range(3)])
+        errors = await asyncio.gather(
+            *[coalesced(fail=True) for _ in range(2)], return_exceptions=True
+        )
+        # A cancelled caller doesn't cancel the call it shares
+        leader = asyncio.ensure_future(coalesced(model="x"))
+        follower = asyncio.ensure_future(coalesced(model="x"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return responses, errors, await follower
+
+    responses, errors, response = asyncio.run(run())
+    assert len(calls) == 3 and coalesced.stats.coalesced == 4
+    assert responses[0] == responses[1] and responses[0] is not responses[1]
+    assert all(isinstance(x, ValueError) for x in errors)
+    assert response == {"choices": [{"message": {"content": "hi"}}]}
@@ -0,0 +1,175 @@
+import json
+
+import pytest
+from pydantic import BaseModel, Field
+
+from make_agents.checkpoint import SessionLog, load_session, resume_agent
+from make_agents.fake import FakeLLM
+from make_agents.make_agents import End, Start, action, run_agent
+
+
+class TextArg(BaseModel):
+    text: str = Field(description="The text")
+
+
+@action
+def echo(arg: TextArg):
+    """Echo the text."""
+    return arg.text
+
+
+@action
+def shout(arg: TextArg):
+    """Shout the text."""
+    return arg.text.upper()
+
+
+action_graph = {Start: [echo], echo: [shout, End], shout: [End]}
+
+
+def scripted_llm() -> FakeLLM:
+    """Selects the first option whenever there is a choice, and gives the text "hi"."""
+    return FakeLLM(arguments=lambda name, parameters, messages: {"text": "hi"})
+
+
+def test_session_log(tmp_path):
+    path = tmp_path / "session.jsonl"
+    with SessionLog(path) as session_log:
+        messages = list(
+            run_agent(
+                action_graph,
+                completion=scripted_llm().completion,
+                session_log=session_log,
+            )
+        )[-1]
+    logged_messages, appended = SessionLog.read(path)
+    assert logged_messages == list(messages)
+    assert appended == list(messages)[1:]  # the system prompt is a replace record
+
+    # A partly written last line is ignored
+    with open(path, "a") as f:
+        f.write('{"op": "append", "mess')
+    assert SessionLog.read(path)[0] == list(messages)
+
+
+@pytest.mark.parametrize("crash_after", range(1, 6))
+def test_resume_agent(tmp_path, crash_after):
+    expected_llm = scripted_llm()
+    expected = list(run_agent(action_graph, completion=expected_llm.completion))[-1]
+
+    path = tmp_path / "session.jsonl"
+    llm = scripted_llm()
+    with SessionLog(path) as session_log:
+        agent = run_agent(
+            action_graph, completion=llm.completion, session_log=session_log
+        )
+        for _ in range(crash_after):
+            next(agent)
+        agent.close()
+    messages = list(resume_agent(action_graph, path, completion=llm.completion))[-1]
+    assert list(messages) == list(expected)
+    # No LLM calls were repeated
+    assert llm.calls == expected_llm.calls
+    assert SessionLog.read(path)[0] == list(expected)
+
+
+def test_load_session(tmp_path):
+    path = tmp_path / "session.jsonl"
+    with SessionLog(path) as session_log:
+        agent = run_agent(
+            action_graph, completion=scripted_llm().completion, session_log=session_log
+        )
+        for _ in range(5):
+            next(agent)
+        agent.close()
+    state = load_session(path, action_graph)
+    assert state.current_action == echo
+    assert state.current_action_result == "hi"
+    assert state.pending_action == shout
+    assert state.pending_call == (TextArg(text="hi"),)
+
+
+def test_session_log_replace(tmp_path):
+    def keep_recent(messages):
+        if len(messages) > 3:
+            del messages[1:-2]
+
+    path = tmp_path / "session.jsonl"
+    with SessionLog(path) as session_log:
+        messages = list(
+            run_agent(
+                action_graph,
+                completion=scripted_llm().completion,
+                pre_llm_callback=keep_recent,
+                session_log=session_log,
+            )
+        )[-1]
+    logged_messages, appended = SessionLog.read(path)
+    assert logged_messages == list(messages)
+    assert len(appended) == 6
+
+
+@pytest.mark.parametrize("crash_after", range(1, 6))
+def test_session_log_callback_appends(tmp_path, crash_after):
+    def inject(messages):
+        if messages[-1]["role"] == "function" and messages[-1]["name"] == "echo":
+            messages.append({"role": "user", "content": "injected"})
+
+    expected = list(
+        run_agent(
+            action_graph, completion=scripted_llm().completion, pre_llm_callback=inject
+        )
+    )[-1]
+    assert {"role": "user", "content": "injected"} in expected
+
+    path = tmp_path / "session.jsonl"
+    with SessionLog(path) as session_log:
+        agent = run_agent(
+            action_graph,
+            completion=scripted_llm().completion,
+            pre_llm_callback=inject,
+            session_log=session_log,
+        )
+        for _ in range(crash_after):
+            next(agent)
+        agent.close()
+    messages = list(
+        resume_agent(
+            action_graph,
+            path,
+            completion=scripted_llm().completion,
+            pre_llm_callback=inject,
+        )
+    )[-1]
+    assert list(messages) == list(expected)
+    assert SessionLog.read(path)[0] == list(expected)
+
+
+def test_resume_parallel_actions(tmp_path):
+    batch = {"calls": [{"name": "shout", "arguments": {"text": "hi"}}] * 2}
+
+    completion = FakeLLM(
+        choices=["run_in_parallel"],
+        arguments=lambda name, parameters, messages: (
+            batch if name == "run_in_parallel" else {"text": "hi"}
+        ),
+    ).completion
+
+    path = tmp_path / "session.jsonl"
+    with SessionLog(path) as session_log:
+        agent = run_agent(
+            action_graph,
+            completion=completion,
+            parallel_actions=True,
+            session_log=session_log,
+        )
+        for _ in range(3):
+            next(agent)
+        agent.close()
+    state = load_session(path, action_graph)
+    assert state.pending_action.__name__ == "run_in_parallel"
+    messages = list(
+        resume_agent(action_graph, path, completion=completion, parallel_actions=True)
+    )[-1]
+    assert json.loads(messages[-1]["content"]) == [{"name": "shout", "result": "HI"}] * 2
+    assert load_session(path, action_graph).current_action == shout
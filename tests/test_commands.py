@@ -0,0 +1,49 @@
+import shlex
+import sys
+import time
+
+from make_agents.commands import BoundedOutput, CommandRunner
+
+
+def python(code: str) -> str:
+    return f"{shlex.quote(sys.executable)} -c {shlex.quote(code)}"
+
+
+def test_bounded_output():
+    output = BoundedOutput(8)
+    for data in [b"ab", b"cdefgh", b"ijkl"]:
+        output.write(data)
+    assert output.total_bytes == 12 and output.truncated_bytes == 4
+    assert output.text() == "abcd\n... [4 bytes truncated] ...\nijkl"
+
+
+def test_run():
+    runner = CommandRunner(max_output_bytes=100, echo=False)
+    result = runner.run(python("import sys; print('x' * 1000); sys.exit(3)"))
+    assert result["status"] == "exited" and result["exit_code"] == 3
+    assert result["truncated_bytes"] == 901
+    assert len(result["stdout"]) < 150
+    assert runner.run("not-a-command-xyz")["status"] == "failed to start"
+
+
+def test_timeout():
+    runner = CommandRunner(timeout=0.2, echo=False)
+    start = time.monotonic()
+    result = runner.run(
+        python("import time; print('started', flush=True); time.sleep(10)")
+    )
+    assert time.monotonic() - start < 5
+    assert result["status"] == "timed out" and result["stdout"] == "started\n"
+
+
+def test_background():
+    runner = CommandRunner(echo=False)
+    code = "import time; print('started', flush=True); time.sleep(0.3); print('done')"
+    result = runner.run(python(code), background=True)
+    assert result["status"] == "running"
+    job_id = result["job_id"]
+    assert runner.check(job_id, wait=5)["stdout"] == "started\ndone\n"
+
+    result = runner.run(python("import time; time.sleep(10)"), background=True)
+    assert runner.stop(result["job_id"])["status"] == "stopped"
+    assert runner.check(99)["status"] == "unknown job"
@@ -0,0 +1,98 @@
+import json
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+from make_agents.fake import FakeLLM
+from make_agents.make_agents import (
+    End,
+    Start,
+    action,
+    compact_schema,
+    func_input_request,
+    run_agent,
+    select_next_action_factory,
+)
+
+
+class EchoArg(BaseModel):
+    text: str = Field(description="Text to echo")
+
+
+@action
+def echo(arg: EchoArg):
+    """Echo the text."""
+    return arg.text
+
+
+class Address(BaseModel):
+    street: str = Field(description="The street")
+
+
+class Contact(BaseModel):
+    title: str = Field(description="Mr, Ms, etc.")
+    home: Address
+    work: Optional[Address] = None
+    kind: Literal["person", "company"] = "person"
+
+
+def test_compact_schema():
+    assert compact_schema(Contact.model_json_schema()) == {
+        "properties": {
+            "title": {"description": "Mr, Ms, etc.", "type": "string"},
+            "home": {"$ref": "#/$defs/Address"},
+            "work": {
+                "anyOf": [{"$ref": "#/$defs/Address"}, {"type": "null"}],
+                "default": None,
+            },
+            "kind": {
+                "default": "person",
+                "enum": ["person", "company"],
+                "type": "string",
+            },
+        },
+        "required": ["title", "home"],
+        "type": "object",
+        "$defs": {
+            "Address": {
+                "properties": {"street": {"description": "The street", "type": "string"}},
+                "required": ["street"],
+                "type": "object",
+            }
+        },
+    }
+    # A definition that's used once is inlined
+    assert compact_schema(Address.model_json_schema()) == {
+        "properties": {"street": {"description": "The street", "type": "string"}},
+        "required": ["street"],
+        "type": "object",
+    }
+
+
+def test_compact_prompts():
+    action_graph = {Start: [echo], echo: [echo, End]}
+    requests = []
+
+    def completion(**kwargs):
+        requests.append(kwargs)
+        return llm.completion(**kwargs)
+
+    llm = FakeLLM(choices=["echo", "End"])
+    messages = list(run_agent(action_graph, completion=completion, compact_prompts=True))[
+        -1
+    ]
+    assert [x["name"] for x in messages if x["role"] == "function"] == [
+        "echo",
+        "select_next_func",
+        "echo",
+        "select_next_func",
+    ]
+    (selector,) = requests[1]["functions"]
+    assert selector["description"].endswith(
+        "\n- End: End your assistance with immediate effect.\n- echo: Echo the text."
+    )
+    assert len(json.dumps(selector)) < len(
+        json.dumps(
+            func_input_request([], select_next_action_factory([echo, End]))["functions"]
+        )
+    )
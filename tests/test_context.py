@@ -0,0 +1,80 @@
+import pytest
+
+from make_agents.context import ContextWindowManager
+from make_agents.history import MessageHistory
+
+
+def call(name):
+    return {
+        "role": "assistant",
+        "content": None,
+        "function_call": {"name": name, "arguments": "null"},
+    }
+
+
+def result(name):
+    return {"role": "function", "name": name, "content": '"ok"'}
+
+
+def count_messages(text):
+    return 0  # so each message is 4 tokens (the per-message overhead)
+
+
+@pytest.mark.parametrize("strategy", ["sliding_window", "pinned_system"])
+def test_keeps_calls_with_their_results(strategy):
+    system = {"role": "system", "content": "You are..."}
+    messages = MessageHistory([system])
+    for i in range(5):
+        messages += [call(f"f{i}"), result(f"f{i}")]
+    manager = ContextWindowManager(16, strategy, count_tokens=count_messages)
+    view = messages.snapshot()
+    manager(messages)
+    if strategy == "pinned_system":
+        assert messages == [system, call("f4"), result("f4")]
+    else:
+        assert messages == [call("f3"), result("f3"), call("f4"), result("f4")]
+    assert len(view) == 11  # snapshots are unaffected
+    manager(messages)
+    assert manager.dropped_messages == len(view) - len(messages)
+
+
+def test_pin_first_and_token_cache():
+    counted = []
+
+    def count_tokens(text):
+        counted.append(text)
+        return 1
+
+    messages = [{"role": "system", "content": "s"}, call("task"), result("task")]
+    messages += [{"role": "user", "content": str(i)} for i in range(10)]
+    manager = ContextWindowManager(5 * 5, pin_first=2, count_tokens=count_tokens)
+    manager(messages)
+    assert messages[:3] == [
+        {"role": "system", "content": "s"},
+        call("task"),
+        result("task"),
+    ]
+    assert [m["content"] for m in messages[3:]] == ["8", "9"]
+    assert len(counted) == 13
+    messages.append({"role": "user", "content": "10"})
+    manager(messages)
+    assert len(counted) == 14  # only the new message was counted
+    assert [m["content"] for m in messages[3:]] == ["9", "10"]
+
+
+@pytest.mark.parametrize("pin_first", [1, 2])
+def test_pin_first_keeps_calls_with_their_results(pin_first):
+    system = {"role": "system", "content": "s"}
+    task = {"role": "user", "content": "task"}
+    messages = [system, task, call("f0"), result("f0")]
+    messages += [{"role": "user", "content": str(i)} for i in range(5)]
+    manager = ContextWindowManager(
+        4 * 5, pin_first=pin_first, count_tokens=count_messages
+    )
+    manager(messages)
+    if pin_first == 1:
+        assert messages[:2] == [system, task]
+        assert [m["content"] for m in messages[2:]] == ["2", "3", "4"]
+    else:  # the pinned call's result is pinned too
+        assert messages[:4] == [system, task, call("f0"), result("f0")]
+        assert [m["content"] for m in messages[4:]] == ["4"]
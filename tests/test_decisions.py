@@ -0,0 +1,73 @@
+import json
+
+from pydantic import BaseModel, Field
+
+from make_agents.decisions import DecisionCache, DecisionRouter, Rule
+from make_agents.make_agents import End, Start, action, run_agent
+
+
+class EchoArg(BaseModel):
+    text: str = Field(description="Text to echo")
+
+
+@action
+def echo(arg: EchoArg):
+    """Echo the text."""
+    return arg.text
+
+
+def scripted_completion(**kwargs):
+    """Selects the first option whenever there is a choice, and echoes "hi"."""
+    name = kwargs["function_call"]["name"]
+    if name == "select_next_func":
+        (options,) = kwargs["functions"][0]["parameters"]["$defs"].values()
+        arguments = {"thought_process": "", "next_function": options["enum"][0]}
+    else:
+        arguments = {"text": "hi"}
+    return {
+        "choices": [
+            {
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "function_call": {"name": name, "arguments": json.dumps(arguments)},
+                }
+            }
+        ]
+    }
+
+
+def test_decisions():
+    requests = []
+
+    def completion(**kwargs):
+        requests.append(kwargs["function_call"]["name"])
+        return scripted_completion(**kwargs)
+
+    # A rule decides every selection
+    action_graph = {Start: [echo], echo: [echo, End]}
+    decisions = DecisionRouter([Rule(echo, echo, when=lambda result: result == "hi")])
+    agent = run_agent(action_graph, completion=completion, decisions=decisions)
+    messages = [next(agent) for _ in range(8)][-1]
+    assert requests == ["echo"] * 4
+    assert [x["name"] for x in messages if x["role"] == "function"] == ["echo"] * 4
+    assert decisions.stats.saved_calls == decisions.stats.rule_decisions == 3
+
+    # The cache decides, once the LLM has made the same selection twice
+    requests.clear()
+    decisions = DecisionRouter(cache=DecisionCache(min_count=2))
+    agent = run_agent(action_graph, completion=completion, decisions=decisions)
+    messages = [next(agent) for _ in range(14)][-1]
+    assert requests.count("select_next_func") == 2
+    assert decisions.stats.llm_decisions == 2 and decisions.stats.cache_decisions == 2
+
+    # Learning from a transcript
+    cache = DecisionCache(min_count=4)
+    cache.learn(messages)
+    assert cache.decide(echo, "hi", [echo, End]) is echo
+    assert cache.decide(echo, {"status": "error"}, [echo, End]) is None
+
+    rule = Rule(echo, End, when={"status": "error"})
+    assert rule.matches(echo, {"status": "error", "description": "Invalid code."})
+    assert not rule.matches(echo, {"status": "success"})
+    assert not rule.matches(echo, "error")
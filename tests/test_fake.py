@@ -0,0 +1,86 @@
+import asyncio
+from typing import Literal, Optional
+
+import pytest
+from pydantic import BaseModel, Field
+
+import make_agents as ma
+from make_agents.fake import FakeLLM, fake_arguments
+
+
+class Inner(BaseModel):
+    count: int
+    flag: bool = True
+
+
+class ComplexArg(BaseModel):
+    text: str = Field(min_length=6)
+    kind: Literal["a", "b"]
+    inner: Inner
+    items: list[Inner] = Field(min_length=2)
+    maybe: Optional[float]
+
+
+def test_fake_arguments_are_valid():
+    arguments = fake_arguments(ComplexArg.model_json_schema())
+    assert ComplexArg(**arguments).kind == "a"
+
+
+class TextArg(BaseModel):
+    text: str = Field(description="Some text")
+
+
+@ma.action
+def first(arg: TextArg):
+    """The first action."""
+    return arg.text
+
+
+@ma.action
+def second():
+    """The second action."""
+    return "done"
+
+
+action_graph = {ma.Start: [first], first: [first, second], second: [ma.End]}
+
+
+def test_fake_llm():
+    llm = FakeLLM(choices=["second"], prompt_tokens=5, completion_tokens=3)
+    messages = list(ma.run_agent(action_graph, completion=llm.completion))[-1]
+    assert [m.get("name") for m in messages if m["role"] == "function"] == [
+        "first",
+        "select_next_func",
+        "second",
+    ]
+    assert messages[2]["content"] == '"fake"'
+    assert llm.calls == 2
+    response = llm.completion(messages=[{"role": "user", "content": "hi"}])
+    assert response["choices"][0]["message"] == {"role": "assistant", "content": "OK."}
+    assert response["usage"] == {
+        "prompt_tokens": 5,
+        "completion_tokens": 3,
+        "total_tokens": 8,
+    }
+    with pytest.raises(ValueError):
+        FakeLLM(choices=["nope"]).choose(["first", "second"], [])
+
+
+def test_fake_llm_streaming_and_async():
+    partials = []
+    llm = FakeLLM(choices=["second"], chunk_size=3)
+    expected = list(ma.run_agent(action_graph, completion=llm.completion))[-1]
+    streamed = list(
+        ma.run_agent(
+            action_graph,
+            completion=llm.completion,
+            on_partial=lambda message, arguments: partials.append(arguments),
+        )
+    )[-1]
+    assert list(streamed) == list(expected)
+    assert {"text": "fa"} in partials
+
+    async def collect():
+        return [m async for m in ma.arun_agent(action_graph, completion=llm.acompletion)]
+
+    assert list(asyncio.run(collect())[-1]) == list(expected)
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+import make_agents as ma
+from make_agents.cli import fleet
+from make_agents.fleet import BACKENDS, iter_fleet, run_fleet
+
+
+@ma.action
+def count_messages():
+    return "counted"
+
+
+# At module level, so that it can be pickled for the "processes" backend
+action_graph = {ma.Start: [count_messages]}
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_run_fleet(tmp_path, backend):
+    messages_inits = (
+        [{"role": "system", "content": "hi"}, {"role": "user", "content": str(i)}]
+        for i in range(10)
+    )
+    output_path = tmp_path / "transcripts.jsonl"
+    stats = run_fleet(
+        action_graph,
+        messages_inits,
+        output_path=str(output_path),
+        max_concurrency=3,
+        backend=backend,
+        completion=None,
+    )
+    assert stats.sessions == 10 and stats.failed == 0 and stats.messages == 40
+    results = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert sorted(r["index"] for r in results) == list(range(10))
+    for r in results:
+        assert r["messages"][1]["content"] == str(r["index"])
+        assert r["messages"][-1]["content"] == '"counted"'
+
+
+def test_iter_fleet_reports_errors():
+    @ma.action
+    def fail():
+        raise RuntimeError("failed")
+
+    (result,) = iter_fleet({ma.Start: [fail]}, [None], completion=None)
+    assert result.error == "RuntimeError('failed')"
+    assert result.messages[-1]["function_call"]["name"] == "fail"
+
+
+def test_cli_backends(tmp_path):
+    inputs = tmp_path / "inputs.jsonl"
+    inputs.write_text("null\n" * 3)
+    output = tmp_path / "transcripts.jsonl"
+    args = [f"{__name__}:action_graph", str(inputs), "-o", str(output)]
+    result = CliRunner().invoke(fleet, [*args, "--backend", "processes"])
+    assert result.exit_code == 0, result.output
+    assert len(output.read_text().splitlines()) == 3
+
+    result = CliRunner().invoke(fleet, [*args, "--backend", "fibers"])
+    assert result.exit_code == 2 and "'fibers' is not one of" in result.output
@@ -0,0 +1,54 @@
+import json
+from copy import deepcopy
+
+import pytest
+
+import make_agents as ma
+from make_agents.history import MessageHistory
+
+
+def test_snapshots_are_unaffected_by_appends():
+    history = MessageHistory([{"role": "system", "content": "a"}])
+    view = history.snapshot()
+    history.append({"role": "user", "content": "b"})
+    assert len(view) == 1 and len(history) == 2
+    assert view == [{"role": "system", "content": "a"}]
+    assert view[-1] == {"role": "system", "content": "a"}
+    with pytest.raises(IndexError):
+        view[1]
+
+
+def test_snapshots_survive_in_place_modification():
+    history = MessageHistory([{"content": i} for i in range(5)])
+    view = history.snapshot()
+    del history[1:4]
+    history[0] = {"content": "replaced"}
+    history.append({"content": 5})
+    assert [m["content"] for m in view] == [0, 1, 2, 3, 4]
+    assert [m["content"] for m in history.snapshot()] == ["replaced", 4, 5]
+    assert view[1:3] == [{"content": 1}, {"content": 2}]
+
+
+def test_history_is_a_list():
+    history = MessageHistory([{"content": 1}])
+    assert isinstance(history, list)
+    assert json.loads(json.dumps(history)) == [{"content": 1}]
+    assert type(deepcopy(history)) is MessageHistory
+    assert deepcopy(history) == history
+
+
+def test_run_agent_yields_snapshots():
+    @ma.action
+    def noop():
+        return "done"
+
+    action_graph = {ma.Start: [noop], noop: [noop]}
+    agent = ma.run_agent(action_graph, completion=None)
+    first = next(agent)
+    for _ in range(3):
+        latest = next(agent)
+    assert len(first) == 2 and len(latest) == 5
+    assert latest[-1] == {"role": "function", "name": "noop", "content": '"done"'}
+
+    copied = next(ma.run_agent(action_graph, completion=None, copy_messages=True))
+    assert type(copied) is list and copied == first
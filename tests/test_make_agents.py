@@ -1,7 +1,28 @@
+import asyncio
+import itertools
+import json
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
 import pytest
 from pydantic import BaseModel, Field
 
-from make_agents.make_agents import action
+from make_agents import make_agents, tracing
+from make_agents.fake import FakeLLM
+from make_agents.make_agents import (
+    End,
+    Start,
+    action,
+    arun_agent,
+    dict_to_action_graph_func,
+    run_agent,
+    run_funcs,
+)
+from make_agents.speculation import Speculator
 
 
 def test_action_decorator():
@@ -59,3 +80,288 @@ def test_action_decorator():
         @action
         def example_func(arg):
             pass
+
+
+def function_call_response(name: str, arguments: dict) -> dict:
+    return {
+        "choices": [
+            {
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "function_call": {"name": name, "arguments": json.dumps(arguments)},
+                }
+            }
+        ]
+    }
+
+
+class EchoArg(BaseModel):
+    text: str = Field(description="Text to echo")
+
+
+@action
+def echo(arg: EchoArg):
+    """Echo the text."""
+    return arg.text
+
+
+@action
+async def async_echo(arg: EchoArg):
+    """Echo the text, asynchronously."""
+    return arg.text
+
+
+def scripted_completion(**kwargs):
+    """Selects the first option whenever there is a choice, and echoes "hi"."""
+    name = kwargs["function_call"]["name"]
+    if name == "select_next_func":
+        (options,) = kwargs["functions"][0]["parameters"]["$defs"].values()
+        arguments = {"thought_process": "", "next_function": options["enum"][0]}
+    else:
+        arguments = {"text": "hi"}
+    return function_call_response(name, arguments)
+
+
+def test_run_agent():
+    action_graph = {Start: [echo], echo: [echo, End]}
+    agent = run_agent(action_graph, completion=scripted_completion)
+    messages = [next(agent) for _ in range(6)][-1]
+    assert [m["role"] for m in messages] == [
+        "system",
+        "assistant",
+        "function",
+        "assistant",
+        "function",
+        "assistant",
+        "function",
+    ]
+    assert messages[2]["content"] == '"hi"'
+    assert messages[3]["function_call"]["name"] == "select_next_func"
+    assert messages[4]["content"] == '"echo"'
+
+
+def test_arun_agent():
+    async def acompletion(**kwargs):
+        await asyncio.sleep(0)
+        return scripted_completion(**kwargs)
+
+    async def collect(action_graph):
+        results = []
+        async for messages in arun_agent(action_graph, completion=acompletion):
+            results.append(messages)
+            if len(results) == 6:
+                return results
+
+    action_graph = {Start: [echo], echo: [echo, End]}
+    expected = [
+        list(m)
+        for m in itertools.islice(
+            run_agent(action_graph, completion=scripted_completion), 6
+        )
+    ]
+    assert [list(m) for m in asyncio.run(collect(action_graph))] == expected
+
+    action_graph = {Start: [async_echo], async_echo: [async_echo, End]}
+    messages = asyncio.run(collect(action_graph))[-1]
+    assert messages[2] == {"role": "function", "name": "async_echo", "content": '"hi"'}
+
+
+def test_select_and_act():
+    requests = []
+
+    def completion(**kwargs):
+        requests.append(kwargs)
+        if kwargs["function_call"] == "auto":
+            assert [f["name"] for f in kwargs["functions"]] == ["echo", "End"]
+            assert kwargs["functions"][1]["parameters"] == {
+                "type": "object",
+                "properties": {},
+            }
+            return function_call_response("echo", {"text": "hi"})
+        return scripted_completion(**kwargs)
+
+    action_graph = {Start: [echo], echo: [echo, End]}
+    agent = run_agent(action_graph, completion=completion, select_and_act=True)
+    messages = [next(agent) for _ in range(4)][-1]
+    assert len(requests) == 2
+    # The same as without select_and_act, minus the select_next_func messages
+    expected = list(
+        next(
+            itertools.islice(
+                run_agent(action_graph, completion=scripted_completion), 5, None
+            )
+        )
+    )
+    assert list(messages) == expected[:3] + expected[5:]
+
+    # Falls back to select_next_func
+    no_call = {"choices": [{"message": {"role": "assistant", "content": "Hmm"}}]}
+    agent = run_agent(
+        action_graph,
+        completion=lambda **kwargs: no_call
+        if kwargs["function_call"] == "auto"
+        else scripted_completion(**kwargs),
+        select_and_act=True,
+    )
+    messages = [next(agent) for _ in range(4)][-1]
+    assert messages[3]["function_call"]["name"] == "select_next_func"
+
+
+def test_compiled_action_graph():
+    action_graph = dict_to_action_graph_func({Start: [echo], echo: [echo, End]})
+    assert action_graph(current_action=echo, current_action_result="hi") == (echo, End)
+    assert action_graph(current_action=End, current_action_result=None) is None
+    # The selectors (plain and compact) are made up front, not at every step
+    selectors = {
+        compact: action_graph.selector((echo, End), compact) for compact in (False, True)
+    }
+    assert selectors[False] is not selectors[True]
+    with mock.patch.object(make_agents, "select_next_action_factory") as factory:
+        for compact in (False, True):
+            agent = run_agent(
+                action_graph,
+                completion=FakeLLM(choices=["echo"]).completion,
+                compact_prompts=compact,
+            )
+            messages = [next(agent) for _ in range(10)][-1]
+            assert messages[3]["function_call"]["name"] == "select_next_func"
+            assert action_graph.selector((echo, End), compact) is selectors[compact]
+    factory.assert_not_called()
+
+    def not_an_action():
+        pass
+
+    with pytest.raises(ValueError):
+        dict_to_action_graph_func({Start: [not_an_action]})
+
+
+def test_speculation():
+    requests = []
+
+    tracers = []
+    started = threading.Event()  # the speculative completion has started
+
+    def completion(**kwargs):
+        name = kwargs["function_call"]["name"]
+        requests.append(name)
+        tracers.append(tracing.get_tracer())
+        if name == "select_next_func":
+            started.wait(1)
+        else:
+            started.set()
+        return {**scripted_completion(**kwargs), "usage": {"total_tokens": 10}}
+
+    action_graph = {Start: [echo], echo: [echo, End]}
+    speculator = Speculator()
+    with tracing.Tracer(tracing.InMemoryExporter()) as tracer:
+        agent = run_agent(action_graph, completion=completion, speculator=speculator)
+        messages = [next(agent) for _ in range(10)][-1]
+    # The speculative completion runs in the caller's context (e.g. its tracer)
+    assert tracers == [tracer] * len(requests)
+    # No prediction for the first selection, then echo is predicted, and is right
+    assert sorted(requests) == ["echo"] * 3 + ["select_next_func"] * 2
+    assert speculator.stats.attempts == 1 and speculator.stats.hit_rate == 1
+    expected = list(
+        itertools.islice(run_agent(action_graph, completion=scripted_completion), 10)
+    )[-1]
+    assert list(messages) == list(expected)
+
+    # A wrong prediction is discarded
+    @action
+    def shout(arg: EchoArg):
+        return arg.text.upper()
+
+    action_graph = {Start: [echo], echo: [echo, shout]}
+    speculator.selections.clear()
+    speculator.record(echo, [echo, shout], shout)
+    started.clear()
+    agent = run_agent(action_graph, completion=completion, speculator=speculator)
+    messages = [next(agent) for _ in range(6)][-1]
+    assert messages[-1] == {"role": "function", "name": "echo", "content": '"hi"'}
+    assert speculator.stats.misses == 1
+    # It had already started, so it couldn't be cancelled
+    for _ in range(100):
+        if speculator.stats.wasted_tokens:
+            break
+        time.sleep(0.01)
+    assert speculator.stats.wasted_tokens == 10 and speculator.stats.cancelled == 0
+
+
+class DelayArg(BaseModel):
+    seconds: float = Field(description="How long to wait")
+
+
+@action
+def wait(arg: DelayArg):
+    """Wait, then return how long."""
+    time.sleep(arg.seconds)
+    return arg.seconds
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_parallel_actions(use_async):
+    batch = {"calls": [{"name": "wait", "arguments": {"seconds": s}} for s in (0.3, 0.2)]}
+    batch["calls"].insert(1, {"name": "echo", "arguments": {"text": "hi"}})
+
+    def completion(**kwargs):
+        if kwargs["function_call"] == "auto":
+            names = [f["name"] for f in kwargs["functions"]]
+            assert names == ["wait", "echo", "End", "run_in_parallel"]
+            return function_call_response("run_in_parallel", batch)
+        return scripted_completion(**kwargs)
+
+    async def acompletion(**kwargs):
+        return completion(**kwargs)
+
+    async def collect(agent):
+        return [m async for m in agent]
+
+    action_graph = {Start: [echo], echo: [wait, echo, End], wait: [End]}
+    kwargs = dict(parallel_actions=True, action_timeout=0.25)
+    start = time.monotonic()
+    if use_async:
+        agent = arun_agent(action_graph, completion=acompletion, **kwargs)
+        messages = asyncio.run(collect(agent))[-1]
+    else:
+        messages = list(run_agent(action_graph, completion=completion, **kwargs))[-1]
+    assert time.monotonic() - start < 0.5  # not 0.5s, the sum of the waits
+    assert messages[-2]["function_call"]["name"] == "run_in_parallel"
+    # The results are in the order of the calls, and the agent continues from the last
+    assert json.loads(messages[-1]["content"]) == [
+        {"name": "wait", "error": "Timed out after 0.25s."},
+        {"name": "echo", "result": "hi"},
+        {"name": "wait", "result": 0.2},
+    ]
+    assert len(messages) == 5
+
+
+def test_parallel_action_timeouts_are_per_action():
+    # With one worker, the second call only starts once the first finishes
+    calls = [(wait, DelayArg(seconds=0.2))] * 2
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        results = run_funcs(calls, 0.3, executor)
+    assert results == [{"name": "wait", "result": 0.2}] * 2
+
+
+def test_run_agent_rejects_async_actions():
+    action_graph = {Start: [async_echo], async_echo: [End]}
+    with pytest.raises(TypeError, match="arun_agent"):
+        list(run_agent(action_graph, completion=scripted_completion))
+
+
+def test_lazy_imports():
+    code = """
+import sys
+import make_agents
+assert "openai" not in sys.modules and "pydantic" not in sys.modules
+make_agents.action, make_agents.run_agent
+assert "pydantic" in sys.modules and "openai" not in sys.modules
+make_agents.gpt
+assert "openai" in sys.modules
+namespace = {}
+exec("from make_agents import *", namespace)
+assert {"run_agent", "End", "gpt"} <= set(namespace)
+assert "importlib" not in namespace and "TYPE_CHECKING" not in namespace
+"""
+    subprocess.run([sys.executable, "-c", code], check=True)
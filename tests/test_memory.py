@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from make_agents.memory import SummarizingMemory
+
+
+def test_summarising_memory():
+    summarised = []
+    release = threading.Event()
+
+    def completion(messages):
+        release.wait()
+        summarised.append(messages[1]["content"])
+        return {"choices": [{"message": {"content": f"summary {len(summarised)}"}}]}
+
+    system = {"role": "system", "content": "You are..."}
+    messages = [system] + [{"role": "user", "content": str(i)} for i in range(7)]
+    memory = SummarizingMemory(completion, keep_last=3, chunk_size=2)
+    memory(messages)  # starts summarising "0", "1" in the background, without blocking
+    assert len(messages) == 8 and not summarised
+    release.set()
+    memory.wait(messages)
+    assert messages[:2] == [
+        system,
+        {"role": "system", "content": "Summary of the earlier conversation: summary 1"},
+    ]
+    assert [m["content"] for m in messages[2:]] == ["2", "3", "4", "5", "6"]
+    assert '"0"' in summarised[0] and "(none)" in summarised[0]
+
+    memory(messages)  # the next chunk is summarised with the current summary
+    memory.wait(messages)
+    assert messages[1]["content"].endswith("summary 2")
+    assert [m["content"] for m in messages[2:]] == ["4", "5", "6"]
+    assert "summary 1" in summarised[1] and '"3"' in summarised[1]
+    assert memory.summarised_messages == 4
+
+
+def test_summarising_memory_keeps_the_last_messages():
+    def completion(messages):
+        return {"choices": [{"message": {"content": "summary"}}]}
+
+    call = {"role": "assistant", "content": None, "function_call": {"name": "f"}}
+    result = {"role": "function", "name": "f", "content": "1"}
+    messages = [
+        {"role": "system", "content": "You are..."},
+        {"role": "user", "content": "0"},
+        {"role": "user", "content": "1"},
+        call,
+        result,
+        {"role": "user", "content": "2"},
+    ]
+    with SummarizingMemory(completion, keep_last=2, chunk_size=3) as memory:
+        memory(messages)
+        memory.wait(messages)
+        # The call is not summarised, since its result is one of the last 2 messages
+        assert messages[2:] == [call, result, {"role": "user", "content": "2"}]
+        assert memory.summarised_messages == 2
+    with pytest.raises(RuntimeError):  # the executor is shut down
+        memory.executor.submit(print)
@@ -0,0 +1,160 @@
+import asyncio
+import threading
+
+import openai
+import pytest
+import requests
+
+import make_agents as ma
+from make_agents import gpt
+from make_agents.fake import FakeLLM
+from make_agents.fleet import run_fleet
+from make_agents.mock_server import MockOpenAIServer
+
+
+@ma.action
+def noop():
+    """Do nothing."""
+    return "ok"
+
+
+action_graph = {ma.Start: [noop], noop: [noop, ma.End]}
+
+
+def test_mock_server():
+    llm = FakeLLM(choices=["noop", "End"])
+    with MockOpenAIServer(llm) as server:
+        completion = gpt.get_completion_func(api_base=server.url, api_key="mock")
+        messages = list(ma.run_agent(action_graph, completion=completion))[-1]
+        names = [m.get("name") for m in messages[1:]]
+        assert names == [None, "noop", None, "select_next_func"] * 2
+        partials = []
+        list(
+            ma.run_agent(
+                action_graph,
+                completion=completion,
+                on_partial=lambda message, arguments: partials.append(arguments),
+            )
+        )
+        assert partials
+
+        async def collect():
+            acompletion = gpt.get_acompletion_func(api_base=server.url, api_key="mock")
+            messages = [
+                m async for m in ma.arun_agent(action_graph, completion=acompletion)
+            ]
+            await gpt.aclose_pools()
+            return messages
+
+        assert list(asyncio.run(collect())[-1]) == list(messages)
+    assert server.stats.requests == server.stats.completions == 6
+    assert server.stats.connections < server.stats.requests  # keep-alive
+
+
+def test_injected_errors():
+    request = dict(model="gpt-4", messages=[], api_key="mock")
+    with MockOpenAIServer(rate_limit_rate=1.0) as server:
+        with pytest.raises(openai.error.RateLimitError):
+            openai.ChatCompletion.create(api_base=server.url, **request)
+    with MockOpenAIServer(timeout_rate=1.0, timeout_seconds=0.5) as server:
+        with pytest.raises(openai.error.Timeout):
+            openai.ChatCompletion.create(
+                api_base=server.url, request_timeout=0.1, **request
+            )
+    assert server.stats.timeouts == 1
+
+
+def test_connection_pool():
+    pool = gpt.ConnectionPool(max_connections=4)
+    request = dict(messages=[{"role": "user", "content": "hi"}])
+    with MockOpenAIServer() as server:
+        completions = [
+            gpt.get_completion_func(api_base=server.url, api_key="mock", pool=pool)
+            for _ in range(2)
+        ]
+        for completion in completions * 3:
+            completion(**request)
+        assert server.stats.connections == 1
+        pool.close()
+
+        async def run():
+            acompletion = gpt.get_acompletion_func(
+                api_base=server.url, api_key="mock", pool=pool
+            )
+            await asyncio.gather(*(acompletion(**request) for _ in range(8)))
+            await asyncio.gather(*(acompletion(**request) for _ in range(8)))
+            await pool.aclose()
+
+        asyncio.run(run())
+        assert server.stats.requests == 22
+        assert server.stats.connections <= 1 + 4
+
+    with MockOpenAIServer(timeout_rate=1.0, timeout_seconds=0.5) as server:
+        completion = gpt.get_completion_func(
+            api_base=server.url, api_key="mock", read_timeout=0.1
+        )
+        with pytest.raises(openai.error.Timeout):
+            completion.__wrapped__(**request)  # without the retries
+
+
+def test_pool_session(monkeypatch):
+    monkeypatch.setattr(openai, "proxy", "http://localhost:3128")
+    pool = gpt.ConnectionPool(max_connections=4)
+    # Set up like openai's own sessions
+    assert pool.session.proxies == {
+        "http": "http://localhost:3128",
+        "https": "http://localhost:3128",
+    }
+    assert pool.session.get_adapter("https://api.openai.com").max_retries.total == 2
+    pool.use_in_this_thread()
+    assert openai.api_requestor._thread_context.session is pool.session
+    pool.close()
+
+    # Unless openai is given the session to use
+    monkeypatch.setattr(openai, "requestssession", requests.Session())
+    sessions = []
+
+    def use_pool():
+        pool.use_in_this_thread()
+        sessions.append(getattr(openai.api_requestor._thread_context, "session", None))
+
+    thread = threading.Thread(target=use_pool)
+    thread.start()
+    thread.join()
+    assert sessions == [None]
+
+
+def test_default_pool():
+    request = dict(messages=[{"role": "user", "content": "hi"}])
+    with MockOpenAIServer(FakeLLM(choices=["noop", "End"])) as server:
+        completion = gpt.get_completion_func(api_base=server.url, api_key="mock")
+        acompletion = gpt.get_acompletion_func(api_base=server.url, api_key="mock")
+        assert completion.pool is acompletion.pool is gpt.default_pool()
+
+        stats = run_fleet(
+            action_graph,
+            [None] * 4,
+            backend="asyncio",
+            completion_factory=lambda: gpt.get_acompletion_func(
+                api_base=server.url, api_key="mock"
+            ),
+        )
+        assert stats.sessions == 4 and stats.failed == 0
+        assert not gpt.default_pool()._asessions  # closed with the fleet's event loop
+
+        with gpt.ConnectionPool() as pool:
+            completion = gpt.get_completion_func(
+                api_base=server.url, api_key="mock", pool=pool
+            )
+            completion(**request)
+        assert pool._session is None
+
+        async def run():
+            async with gpt.ConnectionPool() as pool:
+                acompletion = gpt.get_acompletion_func(
+                    api_base=server.url, api_key="mock", pool=pool
+                )
+                await acompletion(**request)
+            return pool
+
+        assert not asyncio.run(run())._asessions
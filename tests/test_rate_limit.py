@@ -0,0 +1,46 @@
+import openai
+import pytest
+
+from make_agents.gpt import get_completion_func
+from make_agents.rate_limit import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_requests_per_minute():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=60, max_burst=2 / 60, clock=clock)
+    # A burst of 2, then one request per second, first come first served
+    assert [limiter.reserve(0) for _ in range(4)] == [0, 0, 1, 2]
+    clock.now = 10.0
+    assert limiter.reserve(0) == 0
+    assert limiter.stats.requests == 5 and limiter.stats.max_wait == 2
+
+
+def test_tokens_per_minute_corrected_by_usage():
+    clock = FakeClock()
+    limiter = RateLimiter(tokens_per_minute=600, clock=clock)
+    assert limiter.reserve(600) == 0
+    assert limiter.reserve(60) == pytest.approx(6)
+    # The first request only used 100 tokens
+    limiter.record_usage(600, {"usage": {"total_tokens": 100}})
+    assert limiter.reserve(60) == 0
+    assert limiter.stats.tokens == 220
+
+
+def test_completion_func_uses_rate_limiter(monkeypatch):
+    monkeypatch.setattr(
+        openai.ChatCompletion, "create", lambda **kwargs: {"usage": {"total_tokens": 10}}
+    )
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=10_000)
+    completion = get_completion_func(rate_limiter=limiter)
+    completion(messages=[{"role": "user", "content": "hi"}], max_tokens=50)
+    completion(messages=[{"role": "user", "content": "hi"}], max_tokens=50)
+    assert limiter.stats.requests == 2 and limiter.stats.tokens == 20
+    assert limiter.stats.queue_depth == 0
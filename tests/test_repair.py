@@ -0,0 +1,125 @@
+import itertools
+import json
+
+import pytest
+from pydantic import BaseModel, Field
+
+from make_agents.make_agents import End, Start, action, run_agent
+from make_agents.repair import ArgumentRepairer, RepairStats
+
+
+class EchoArg(BaseModel):
+    text: str = Field(description="Text to echo")
+
+
+@action
+def echo(arg: EchoArg):
+    """Echo the text."""
+    return arg.text
+
+
+@action
+def fail(arg: EchoArg):
+    """Fail, whatever the text."""
+    raise ValueError(arg.text)
+
+
+def scripted_completion(**kwargs):
+    """Selects the first option whenever there is a choice, and echoes "hi"."""
+    name = kwargs["function_call"]["name"]
+    if name == "select_next_func":
+        (options,) = kwargs["functions"][0]["parameters"]["$defs"].values()
+        arguments = {"thought_process": "", "next_function": options["enum"][0]}
+    else:
+        arguments = {"text": "hi"}
+    return {
+        "choices": [
+            {
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "function_call": {"name": name, "arguments": json.dumps(arguments)},
+                }
+            }
+        ]
+    }
+
+
+def test_repair():
+    requests = []
+    bad_arguments = iter(['{"text": "hi",}', '{"txt": "hi"}', '{"txt": "hi"}'])
+
+    def completion(**kwargs):
+        requests.append(list(kwargs["messages"]))
+        response = scripted_completion(**kwargs)
+        if kwargs["function_call"]["name"] == "echo":
+            message = response["choices"][0]["message"]
+            message["function_call"]["arguments"] = next(bad_arguments, '{"text": "hi"}')
+        return {**response, "usage": {"total_tokens": 10}}
+
+    action_graph = {Start: [echo], echo: [echo, End]}
+    with pytest.raises(ValueError):
+        next(run_agent(action_graph, completion=completion))
+
+    # The trailing comma is repaired locally, the missing field by the LLM (twice)
+    requests.clear()
+    bad_arguments = iter(['{"text": "hi",}', '{"txt": "hi"}', '{"txt": "hi"}'])
+    repairer = ArgumentRepairer()
+    agent = run_agent(action_graph, completion=completion, repairer=repairer)
+    messages = [next(agent) for _ in range(6)][-1]
+    echo_calls = [x for x in messages if x.get("function_call", {}).get("name") == "echo"]
+    assert [x["function_call"]["arguments"] for x in echo_calls] == ['{"text": "hi"}'] * 2
+    assert repairer.stats == RepairStats(
+        invalid=2, local_repairs=1, llm_repairs=1, llm_attempts=2, tokens=20
+    )
+    # The repair request has the invalid call and the error, the agent's messages don't
+    assert requests[3][:-2] == requests[2]
+    invalid_call, error = requests[3][-2:]
+    assert invalid_call["function_call"]["arguments"] == '{"txt": "hi"}'
+    assert error["content"].startswith("Error: text: Field required")
+
+    # Giving up, after max_attempts
+    bad_arguments = itertools.repeat('{"txt": "hi"}')
+    repairer = ArgumentRepairer(max_attempts=1)
+    with pytest.raises(ValueError):
+        next(run_agent(action_graph, completion=completion, repairer=repairer))
+    assert repairer.stats.failures == 1 and repairer.stats.llm_attempts == 1
+
+
+def test_repair_only_invalid_arguments():
+    # An error from the action isn't repaired
+    repairer = ArgumentRepairer()
+    agent = run_agent(
+        {Start: [fail], fail: [End]}, completion=scripted_completion, repairer=repairer
+    )
+    with pytest.raises(ValueError, match="hi"):
+        list(agent)
+    assert repairer.stats == RepairStats()
+
+    # Nor is a response without a function call
+    def completion(**kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "hi"}}]}
+
+    repairer = ArgumentRepairer()
+    with pytest.raises(KeyError):
+        next(
+            run_agent(
+                {Start: [echo], echo: [End]}, completion=completion, repairer=repairer
+            )
+        )
+    assert repairer.stats == RepairStats()
+
+    # Arguments that aren't an object fail validation, so are repaired
+    arguments = iter(["[1]"])
+
+    def completion(**kwargs):
+        response = scripted_completion(**kwargs)
+        message = response["choices"][0]["message"]
+        message["function_call"]["arguments"] = next(arguments, '{"text": "hi"}')
+        return response
+
+    repairer = ArgumentRepairer()
+    next(
+        run_agent({Start: [echo], echo: [End]}, completion=completion, repairer=repairer)
+    )
+    assert repairer.stats.invalid == repairer.stats.llm_repairs == 1
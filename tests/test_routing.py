@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from pydantic import BaseModel, Field
+
+import make_agents as ma
+from make_agents.cache import MemoryCache, cached_completion
+from make_agents.fake import FakeLLM
+from make_agents.routing import AsyncCompletionRouter, CompletionRouter
+
+
+class TextArg(BaseModel):
+    text: str = Field(description="Some text")
+
+
+@ma.action
+def draft(arg: TextArg):
+    """Draft some text."""
+    return arg.text
+
+
+@ma.action
+def review(arg: TextArg):
+    """Review some text."""
+    return arg.text
+
+
+action_graph = {ma.Start: [draft], draft: [review], review: [draft, ma.End]}
+
+
+def test_router_sends_each_kind_of_call_to_its_backend():
+    selector = FakeLLM(choices=["draft", "review", "End"], model="cheap")
+    default = FakeLLM(model="default")
+    expensive = FakeLLM(arguments=lambda name, schema, messages: {"text": "polished"})
+    router = CompletionRouter(
+        default.completion,
+        selector=selector.completion,
+        routes={review: expensive.completion},
+    )
+    messages = list(ma.run_agent(action_graph, completion=router))[-1]
+    results = [x["content"] for x in messages if x.get("name") in ("draft", "review")]
+    assert results == ['"fake"', '"polished"'] * 2
+    # The selector is only called when there's a choice, i.e. after review
+    assert selector.calls == 2
+    assert default.calls == 2
+    assert expensive.calls == 2
+    assert router.calls == {"selector": 2, "default": 2, "review": 2}
+
+
+def test_async_router_routes_auto_calls():
+    default = FakeLLM()
+    auto = FakeLLM(choices=["draft", "review", "End"])
+    router = AsyncCompletionRouter(default.acompletion, auto=auto.acompletion)
+
+    async def run():
+        return [
+            x
+            async for x in ma.arun_agent(
+                action_graph, completion=router, select_and_act=True
+            )
+        ]
+
+    messages = asyncio.run(run())[-1]
+    assert [x["name"] for x in messages if x["role"] == "function"] == [
+        "draft",
+        "review",
+    ] * 2
+    assert auto.calls == router.calls["auto"] > 0
+    assert default.calls == router.calls["default"]
+
+    with pytest.raises(TypeError):
+        CompletionRouter(default.completion, auto=auto.acompletion)
+    with pytest.raises(TypeError):
+        AsyncCompletionRouter(default.acompletion, selector=auto.completion)
+
+
+def test_cached_router_keys_requests_by_routed_model():
+    def backend(model: str) -> callable:
+        llm = FakeLLM(choices=["draft", "review", "End"])
+
+        def completion(**kwargs):
+            return llm.completion(model=model, **kwargs)
+
+        completion.request_defaults = {"model": model}
+        completion.llm = llm
+        return completion
+
+    cache = MemoryCache()
+    default = backend("default")
+    for selector_model, expected_calls in [("cheap", 2), ("cheap", 0), ("cheaper", 2)]:
+        selector = backend(selector_model)
+        router = CompletionRouter(default, selector=selector)
+        list(ma.run_agent(action_graph, completion=cached_completion(router, cache)))
+        # Only a new model's requests reach its backend
+        assert selector.llm.calls == expected_calls
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+from pydantic import BaseModel, Field
+
+import make_agents as ma
+from make_agents.partial_json import parse_partial_json, repair_json
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("", None),
+        ("{", {}),
+        ('{"mess', {}),
+        ('{"message":', {"message": None}),
+        ('{"message": "Hel', {"message": "Hel"}),
+        ('{"message": "a\\', {"message": "a"}),
+        ('{"message": "Hello", "n', {"message": "Hello"}),
+        ('{"items": [1, 2', {"items": [1, 2]}),
+        ('{"message": "Hello"}', {"message": "Hello"}),
+    ],
+)
+def test_parse_partial_json(text, expected):
+    assert parse_partial_json(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('{"items": [1, 2,],}', {"items": [1, 2]}),
+        ('{"message": "a, }"}', {"message": "a, }"}),
+        ('```json\n{"message": "Hello"}\n```', {"message": "Hello"}),
+        ('{"message": "Hel', {"message": "Hel"}),
+    ],
+)
+def test_repair_json(text, expected):
+    assert repair_json(text) == expected
+
+
+def test_repair_json_error():
+    with pytest.raises(json.JSONDecodeError):
+        repair_json('{"message": "Hello", "n')
+
+
+class MessageUserArg(BaseModel):
+    message: str = Field(description="Message to send user")
+
+
+@ma.action
+def message_user(arg: MessageUserArg):
+    """Send the user a message."""
+    return "ok"
+
+
+def streamed_completion(stream=False, **kwargs):
+    assert stream
+    arguments = json.dumps({"message": "Hello there"})
+    yield {
+        "choices": [
+            {"delta": {"role": "assistant", "function_call": {"name": "message_user"}}}
+        ]
+    }
+    for i in range(0, len(arguments), 5):
+        yield {
+            "choices": [{"delta": {"function_call": {"arguments": arguments[i : i + 5]}}}]
+        }
+    yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+
+
+def test_run_agent_streaming():
+    partials = []
+    agent = ma.run_agent(
+        {ma.Start: [message_user]},
+        completion=streamed_completion,
+        on_partial=lambda message, arguments: partials.append(arguments),
+    )
+    messages = list(agent)[-1]
+    assert messages[1] == {
+        "role": "assistant",
+        "content": None,
+        "function_call": {
+            "name": "message_user",
+            "arguments": '{"message": "Hello there"}',
+        },
+    }
+    assert partials[0] is None or partials[0] == {}
+    assert {"message": "Hello t"} in partials and partials[-1] == {
+        "message": "Hello there"
+    }
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+from pydantic import BaseModel, Field
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_none
+
+from make_agents.fake import FakeLLM
+from make_agents.gpt import trace_retry
+from make_agents.make_agents import End, Start, action, run_agent
+from make_agents.tracing import InMemoryExporter, JSONLExporter, Tracer, span
+
+
+class EchoArg(BaseModel):
+    text: str = Field(description="Text to echo")
+
+
+@action
+def echo(arg: EchoArg):
+    """Echo the text."""
+    return arg.text
+
+
+completion = FakeLLM(prompt_tokens=10).completion
+
+
+def test_tracing(tmp_path):
+    exporter = InMemoryExporter()
+    path = tmp_path / "spans.jsonl"
+    jsonl_exporter = JSONLExporter(path)
+    action_graph = {Start: [echo], echo: [echo, End]}
+    with Tracer(exporter, jsonl_exporter):
+        agent = run_agent(action_graph, completion=completion)
+        for _ in range(6):
+            next(agent)
+    jsonl_exporter.close()
+    names = {x.name for x in exporter.spans}
+    assert names == {
+        "graph",
+        "selector",
+        "completion",
+        "validation",
+        "action",
+        "snapshot",
+        "pre_llm_callback",
+    }
+    (action_span, *_) = [x for x in exporter.spans if x.name == "action"]
+    assert action_span.attributes == {"action": "echo"}
+    assert action_span.duration >= 0
+    completions = [x for x in exporter.spans if x.name == "completion"]
+    assert [x.attributes["function_call"] for x in completions] == [
+        "echo",
+        "select_next_func",
+        "echo",
+    ]
+    assert all(x.attributes["prompt_tokens"] == 10 for x in completions)
+    # Validation happens outside of the completion
+    assert all(x.parent_id is None for x in exporter.spans)
+    lines = [json.loads(line) for line in open(path)]
+    assert [x["name"] for x in lines] == [x.name for x in exporter.spans]
+
+    # Off by default
+    list(zip(range(6), run_agent(action_graph, completion=completion)))
+    assert len(exporter.spans) == len(lines)
+
+
+def test_events_and_errors():
+    exporter = InMemoryExporter()
+    calls = []
+
+    def flaky():
+        calls.append(None)
+        if len(calls) < 3:
+            raise ValueError("flaky")
+        return "ok"
+
+    retrying = Retrying(
+        retry=retry_if_exception_type(ValueError),
+        wait=wait_none(),
+        stop=stop_after_attempt(3),
+        before_sleep=trace_retry,
+    )
+    with Tracer(exporter):
+        with span("completion") as outer:
+            assert retrying(flaky) == "ok"
+            with pytest.raises(KeyError):
+                with span("inner"):
+                    raise KeyError("x")
+    inner, outer = exporter.spans
+    assert inner.parent_id == outer.span_id
+    assert inner.attributes == {"error": "KeyError('x')"}
+    assert [e["name"] for e in outer.events] == ["retry", "retry"]
+    assert outer.events[0]["attempt"] == 1
+    assert outer.events[0]["error"] == "ValueError('flaky')"